@@ -0,0 +1,54 @@
+"""
+Gunicorn settings (read automatically from the working directory).
+
+Each worker starts loading the AAOIFI knowledge base in the background as
+soon as it boots, instead of on the first question it serves. Loading is
+started after fork, once per worker: threads and memory maps must not be
+created in the master.
+
+With KB_SERVER_SOCKET set, workers query one knowledge base server instead
+of loading their own (see src/kb_server.py). KB_SERVER_SPAWN=true makes the
+master start that server and stop it on exit.
+
+Conversation sessions must be visible to every worker: with more than one
+worker and no SESSION_STORE set, sessions are stored in SQLite instead of
+each worker's memory (see src/sessions.py).
+"""
+
+import os
+import subprocess
+import sys
+
+_kb_server = None
+
+
+def on_starting(server):
+    global _kb_server
+    if server.cfg.workers > 1:
+        # Workers are forked (and import the app) after this, so they see the setting
+        store = os.environ.setdefault('SESSION_STORE', 'sqlite')
+        if store.lower() == 'memory':
+            server.log.warning("SESSION_STORE=memory with %s workers: a session's next question "
+                               "usually reaches a worker without its history", server.cfg.workers)
+    socket_path = os.getenv('KB_SERVER_SOCKET', '')
+    if socket_path and os.getenv('KB_SERVER_SPAWN', 'false').lower() == 'true':
+        # A separate process, not a fork of the master: it starts its own loader threads
+        _kb_server = subprocess.Popen([sys.executable, '-m', 'src.kb_server', '--socket', socket_path])
+        server.log.info("Started knowledge base server (pid %s) on %s", _kb_server.pid, socket_path)
+
+
+def on_exit(server):
+    if _kb_server is not None and _kb_server.poll() is None:
+        _kb_server.terminate()
+        try:
+            _kb_server.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            _kb_server.kill()
+
+
+def post_worker_init(worker):
+    # Runs in the worker after the app is imported (and, for gevent workers,
+    # after monkey-patching, so the loader uses the patched threading module)
+    from src.app import warm_up
+
+    warm_up()
@@ -0,0 +1,118 @@
+"""
+Answer a file of questions offline through the OpenAI Batch API.
+
+Batch jobs finish within 24 hours at half the price of live calls, which
+suits overnight screening runs. The questions go through the same retrieval
+and prompt as /ask; only the model calls are deferred.
+
+  1. Write the requests (one Batch API request per question, JSONL):
+         python scripts/batch_questions.py questions.txt --output batch.jsonl
+  2. Optionally upload them and start the batch:
+         python scripts/batch_questions.py questions.txt --output batch.jsonl --submit
+  3. Once the batch has completed, collect the answers:
+         python scripts/batch_questions.py questions.txt --collect batch_abc123 --output answers.jsonl
+
+The questions file has one question per line (blank lines are skipped), or
+is a JSON list of strings. Answers are written in the /ask/batch NDJSON
+format, {"index", "question", "answer"} or {"index", "question", "error"}.
+
+Usage:
+    python scripts/batch_questions.py QUESTIONS [--model gpt-5.1] [--output PATH] [--no-pdf]
+                                      [--submit | --collect BATCH_ID]
+"""
+
+import argparse
+import json
+import sys
+from pathlib import Path
+from typing import List
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+
+from src.tyc_advisor import get_advisor  # noqa: E402
+
+
+def read_questions(path: str) -> List[str]:
+    text = Path(path).read_text(encoding='utf-8')
+    if text.lstrip().startswith('['):
+        questions = json.loads(text)
+    else:
+        questions = text.splitlines()
+    return [question.strip() for question in questions if question.strip()]
+
+
+def submit(advisor, path: str) -> None:
+    with open(path, 'rb') as f:
+        upload = advisor.client.files.create(file=f, purpose='batch')
+    batch = advisor.client.batches.create(
+        input_file_id=upload.id,
+        endpoint='/v1/chat/completions',
+        completion_window='24h',
+    )
+    print(f"Submitted batch {batch.id} ({batch.status}); collect it with --collect {batch.id}")
+
+
+def collect(advisor, batch_id: str, questions: List[str], path: str) -> None:
+    batch = advisor.client.batches.retrieve(batch_id)
+    if batch.status != 'completed':
+        print(f"Batch {batch_id} is {batch.status}; "
+              f"{batch.request_counts.completed}/{batch.request_counts.total} requests done")
+        sys.exit(1)
+
+    results = []
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+        for line in advisor.client.files.content(file_id).text.splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            index = int(record['custom_id'].rsplit('-', 1)[1])
+            result = {'index': index, 'question': questions[index]}
+            response = record.get('response') or {}
+            if response.get('status_code') == 200:
+                result['answer'] = response['body']['choices'][0]['message']['content']
+            else:
+                error = record.get('error') or (response.get('body') or {}).get('error')
+                result['error'] = json.dumps(error)
+            results.append(result)
+
+    results.sort(key=lambda result: result['index'])
+    with open(path, 'w', encoding='utf-8') as f:
+        for result in results:
+            f.write(json.dumps(result, ensure_ascii=False) + '\n')
+    failed = sum('error' in result for result in results)
+    print(f"Wrote {len(results)} answers ({failed} failed) to {path}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Answer questions through the OpenAI Batch API")
+    parser.add_argument('questions', help="Questions file: one per line, or a JSON list")
+    parser.add_argument('--model', default='gpt-5.1')
+    parser.add_argument('--output', default='batch.jsonl',
+                        help="Batch input file to write, or with --collect the answers file")
+    parser.add_argument('--no-pdf', action='store_true', help="Answer without AAOIFI context")
+    action = parser.add_mutually_exclusive_group()
+    action.add_argument('--submit', action='store_true', help="Upload the file and start the batch")
+    action.add_argument('--collect', metavar='BATCH_ID', help="Download the answers of a completed batch")
+    args = parser.parse_args()
+
+    questions = read_questions(args.questions)
+    if not questions:
+        print(f"No questions in {args.questions}")
+        sys.exit(1)
+    advisor = get_advisor(args.model)
+
+    if args.collect:
+        collect(advisor, args.collect, questions, args.output)
+        return
+
+    count = advisor.write_batch_file(questions, args.output, use_pdf_context=not args.no_pdf)
+    print(f"Wrote {count} requests to {args.output}")
+    if args.submit:
+        submit(advisor, args.output)
+
+
+if __name__ == "__main__":
+    main()
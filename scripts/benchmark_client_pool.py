@@ -0,0 +1,92 @@
+"""
+Load test: per-request advisor vs the shared, pooled OpenAI client.
+
+Runs /ask-style calls (without PDF context) against the local mock OpenAI
+server in two modes:
+
+  - per-request: TYCIslamicFinanceAdvisor(model=...) built for every call,
+                 i.e. a new OpenAI client and connection pool each time
+  - pooled:      get_advisor(model), reusing keep-alive connections
+
+The mock server delays every new connection by --handshake-ms to stand in
+for the TCP+TLS handshake to api.openai.com, and reports how many
+connections each mode opened.
+
+Usage:
+    python scripts/benchmark_client_pool.py [--requests 200] [--concurrency 8] [--handshake-ms 30]
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, List
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+sys.path.insert(0, str(PROJECT_ROOT / 'scripts'))
+
+from mock_openai_server import start_server  # noqa: E402
+
+QUESTION = "Is murabahah to the purchase orderer permissible?"
+MODEL = "gpt-5.1"
+
+
+def percentile(values: List[float], pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def run(call: Callable[[], None], requests: int, concurrency: int) -> List[float]:
+    """Run call() requests times on concurrency threads; return latencies in ms."""
+    def timed(_):
+        start = time.perf_counter()
+        call()
+        return (time.perf_counter() - start) * 1000
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(timed, range(requests)))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Per-request vs pooled OpenAI client")
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--handshake-ms', type=float, default=30.0,
+                        help="Simulated connection setup cost")
+    parser.add_argument('--latency-ms', type=float, default=0.0,
+                        help="Simulated model latency per request")
+    args = parser.parse_args()
+
+    server = start_server(handshake_ms=args.handshake_ms, latency_ms=args.latency_ms)
+    os.environ['OPENAI_BASE_URL'] = server.base_url
+    os.environ.setdefault('OPENAI_API_KEY', 'test')
+
+    from src.tyc_advisor import TYCIslamicFinanceAdvisor, get_advisor
+
+    modes = {
+        'per-request': lambda: TYCIslamicFinanceAdvisor(model=MODEL).ask(QUESTION, use_pdf_context=False),
+        'pooled': lambda: get_advisor(MODEL).ask(QUESTION, use_pdf_context=False),
+    }
+
+    print(f"Requests: {args.requests}, concurrency: {args.concurrency}, "
+          f"handshake: {args.handshake_ms:.0f} ms, model latency: {args.latency_ms:.0f} ms\n")
+    print(f"{'mode':<12} {'p50':>9} {'p99':>9} {'mean':>9} {'req/s':>8} {'connections':>12}")
+    for name, call in modes.items():
+        call()  # Warm up imports (and, when pooled, the first connection)
+        server.reset_counts()
+        start = time.perf_counter()
+        latencies = run(call, args.requests, args.concurrency)
+        elapsed = time.perf_counter() - start
+        print(f"{name:<12} {statistics.median(latencies):>6.1f} ms {percentile(latencies, 99):>6.1f} ms "
+              f"{statistics.fmean(latencies):>6.1f} ms {args.requests / elapsed:>8.0f} "
+              f"{server.connections:>12}")
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
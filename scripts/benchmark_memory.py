@@ -0,0 +1,156 @@
+"""
+Benchmark per-worker memory of the AAOIFI knowledge base.
+
+Starts N worker processes (like gunicorn workers, each loading its own
+knowledge base) and reports RSS, PSS and USS per worker for:
+
+  - legacy: full text held as a str plus a list of overlapping chunk strings
+  - mmap:   PDFKnowledgeBase with the memory-mapped ChunkStore
+  - server: one knowledge base server (src/kb_server.py) that the workers
+            query over a Unix socket; its memory is counted in the total
+
+PSS divides shared pages between the processes that map them, so it shows
+how much of the corpus is actually shared through the page cache. Linux only.
+
+Usage:
+    python scripts/benchmark_memory.py [workers]
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+
+QUERIES = [
+    "Is trading in currencies on the forward market permissible?",
+    "murabahah to the purchase orderer",
+    "zakah on shares of companies",
+]
+
+
+def read_memory(pid: str = 'self') -> Dict[str, int]:
+    """RSS/PSS/USS (kB) of a process from /proc/<pid>/smaps_rollup."""
+    fields = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and parts[1].isdigit():
+                fields[parts[0].rstrip(':')] = int(parts[1])
+    return {
+        'rss': fields.get('Rss', 0),
+        'pss': fields.get('Pss', 0),
+        'uss': fields.get('Private_Clean', 0) + fields.get('Private_Dirty', 0),
+    }
+
+
+def run_worker(mode: str) -> None:
+    """Load the knowledge base, run a few searches and report memory."""
+    # Keep the knowledge base's progress messages off the report channel
+    report, sys.stdout = sys.stdout, sys.stderr
+
+    from src.pdf_knowledge import PDFKnowledgeBase, get_aaoifi_context_with_sources
+    from src.search_index import BM25Index
+
+    kb = PDFKnowledgeBase()
+    if mode == 'server':
+        for query in QUERIES:
+            get_aaoifi_context_with_sources(query)
+    elif mode == 'legacy':
+        content = kb.load_content()
+        chunks = kb.chunk_text(content)
+        index = BM25Index.build(chunks)
+        for query in QUERIES:
+            [chunks[doc_id] for doc_id, _ in index.search(query)]
+    else:
+        for query in QUERIES:
+            kb.search(query)
+
+    print(json.dumps(read_memory()), file=report, flush=True)
+    # Stay alive until the parent has sampled every worker
+    sys.stdin.read()
+
+
+def start_server(socket_path: str) -> subprocess.Popen:
+    """Start a knowledge base server and wait until it has loaded."""
+    from src.kb_server import KnowledgeBaseClient
+
+    server = subprocess.Popen([sys.executable, '-m', 'src.kb_server', '--socket', socket_path],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=str(PROJECT_ROOT))
+    client = KnowledgeBaseClient(socket_path)
+    deadline = time.time() + 300
+    while time.time() < deadline:
+        try:
+            if client.status().get('state') in ('ready', 'unavailable'):
+                return server
+        except Exception:
+            pass  # Not listening yet
+        time.sleep(0.5)
+    server.kill()
+    raise RuntimeError("Knowledge base server did not load")
+
+
+def run_mode(mode: str, workers: int, env: Dict[str, str] = None) -> List[Dict[str, int]]:
+    procs = [
+        subprocess.Popen(
+            [sys.executable, __file__, '--worker', mode],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            cwd=str(PROJECT_ROOT), text=True, env=env,
+        )
+        for _ in range(workers)
+    ]
+    # Wait for every worker to finish loading, then sample them together so
+    # PSS reflects the pages they share
+    for proc in procs:
+        proc.stdout.readline()
+    samples = [read_memory(str(proc.pid)) for proc in procs]
+    for proc in procs:
+        proc.stdin.close()
+        proc.wait()
+    return samples
+
+
+def main(workers: int = 4) -> None:
+    print(f"Workers: {workers}\n")
+    print(f"{'mode':<8} {'RSS/worker':>12} {'PSS/worker':>12} {'USS/worker':>12} {'total PSS':>12}")
+    for mode in ('legacy', 'mmap', 'server'):
+        server_pss = 0
+        if mode == 'server':
+            with tempfile.TemporaryDirectory() as tmp:
+                socket_path = os.path.join(tmp, 'kb.sock')
+                server = start_server(socket_path)
+                try:
+                    samples = run_mode(mode, workers, env=dict(os.environ, KB_SERVER_SOCKET=socket_path))
+                    server_pss = read_memory(str(server.pid))['pss']
+                finally:
+                    server.terminate()
+                    server.wait()
+        else:
+            samples = run_mode(mode, workers)
+        avg = {key: sum(s[key] for s in samples) / len(samples) / 1024 for key in ('rss', 'pss', 'uss')}
+        total_pss = (sum(s['pss'] for s in samples) + server_pss) / 1024
+        print(f"{mode:<8} {avg['rss']:>9.1f} MB {avg['pss']:>9.1f} MB "
+              f"{avg['uss']:>9.1f} MB {total_pss:>9.1f} MB")
+    print("\n(server: total PSS includes the knowledge base server)")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == '--worker':
+        run_worker(sys.argv[2])
+        sys.exit(0)
+
+    workers = 4
+    if len(sys.argv) > 1:
+        try:
+            workers = int(sys.argv[1])
+        except ValueError:
+            print("Usage: python scripts/benchmark_memory.py [workers]")
+            sys.exit(1)
+
+    main(workers)
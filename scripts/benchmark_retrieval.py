@@ -0,0 +1,268 @@
+"""
+Retrieval benchmark and relevance regression check over the AAOIFI corpus.
+
+Runs the labeled queries in data/benchmark_queries.json (each with the
+Shari'ah Standards, and optionally the pages, where the answer is) against
+data/AAOIFI-Standards.txt and reports, for each retrieval mode:
+
+  - build:     seconds to chunk and index the text from scratch (plus the
+               dense index in dense/hybrid mode), and the peak RSS of the run
+  - latency:   p50/p95/p99 of search() and of get_relevant_context()
+               (context cache off, token budget as used by the advisor)
+  - qps:       queries per second with 1, 2, 4 and 8 threads searching
+  - relevance: recall@k (share of queries with a relevant passage in the
+               top k) and MRR (mean reciprocal rank of the first one)
+
+A result is relevant if its standard is one of the query's standards and,
+where the query lists pages, it overlaps one of them. Each mode runs in a
+fresh process, so build time and peak RSS aren't skewed by earlier modes.
+Nothing is fetched from the network: the dense index uses the offline
+'hashing' embedder unless PDF_EMBEDDER says otherwise.
+
+Results are written as JSON so runs can be compared. With --baseline the
+run fails (exit 1) if recall@k or MRR of any mode dropped by more than
+--tolerance against an earlier results file.
+
+Usage:
+    python scripts/benchmark_retrieval.py [--modes lexical,dense,hybrid] [--chunking fixed]
+                                          [--iterations 5] [--threads 1,2,4,8]
+                                          [--output bench_retrieval.json]
+                                          [--baseline previous.json] [--tolerance 0.02]
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+
+QUERIES_PATH = PROJECT_ROOT / 'data' / 'benchmark_queries.json'
+TEXT_PATH = PROJECT_ROOT / 'data' / 'AAOIFI-Standards.txt'
+
+K_VALUES = (1, 3, 5, 10)
+
+# get_relevant_context() budget, as the advisor uses it
+CONTEXT_TOKENS = 800
+
+
+def load_queries(path: Path) -> List[Dict]:
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(timings: List[float]) -> Dict[str, float]:
+    return {
+        'p50': round(percentile(timings, 50), 3),
+        'p95': round(percentile(timings, 95), 3),
+        'p99': round(percentile(timings, 99), 3),
+        'mean': round(statistics.mean(timings), 3),
+        'n': len(timings),
+    }
+
+
+def is_relevant(result: Dict, label: Dict) -> bool:
+    if result.get('standard') not in label['standards']:
+        return False
+    if not label.get('pages'):
+        return True
+    first, _, last = result['page_range'].partition('-')
+    if not first.isdigit():
+        return False
+    first, last = int(first), int(last or first)
+    return any(first <= page_last and page_first <= last for page_first, page_last in label['pages'])
+
+
+def relevance(kb, queries: List[Dict]) -> Dict:
+    """recall@k and MRR over the labeled queries, plus the rank found for each."""
+    depth = max(K_VALUES)
+    ranks = []
+    for label in queries:
+        results = kb.search(label['query'], max_results=depth)
+        rank = next((position + 1 for position, result in enumerate(results) if is_relevant(result, label)),
+                    None)
+        ranks.append(rank)
+
+    scores = {f'recall@{k}': round(sum(1 for rank in ranks if rank and rank <= k) / len(ranks), 4)
+              for k in K_VALUES}
+    scores['mrr'] = round(sum(1 / rank for rank in ranks if rank) / len(ranks), 4)
+    scores['per_query'] = [{'query': label['query'], 'rank': rank} for label, rank in zip(queries, ranks)]
+    return scores
+
+
+def measure(fn, queries: List[Dict], iterations: int) -> List[float]:
+    timings = []
+    for _ in range(iterations):
+        for label in queries:
+            start = time.perf_counter()
+            fn(label['query'])
+            timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def throughput(kb, queries: List[Dict], threads: int, iterations: int) -> float:
+    """Queries per second with ``threads`` threads searching concurrently."""
+    work = [label['query'] for label in queries] * iterations
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        start = time.perf_counter()
+        list(pool.map(kb.search, work))
+        elapsed = time.perf_counter() - start
+    return round(len(work) / elapsed, 1)
+
+
+def run_mode(mode: str, chunking: str, iterations: int, thread_counts: List[int],
+             queries_path: Path) -> Dict:
+    """Benchmark one retrieval mode in this process (a fresh one, see main)."""
+    from src.pdf_knowledge import ContextCache, PDFKnowledgeBase
+
+    queries = load_queries(queries_path)
+    with tempfile.TemporaryDirectory() as artifact_dir:
+        # An empty artifact directory: the index is built from the text, not loaded
+        kb = PDFKnowledgeBase(text_path=str(TEXT_PATH), artifact_path=str(Path(artifact_dir) / 'bench.kbidx'),
+                              chunking=chunking, retrieval=mode, retrieval_budget_ms=60_000,
+                              reload_interval=0)
+        start = time.perf_counter()
+        if not kb.load():
+            raise RuntimeError(f"Could not load {TEXT_PATH}")
+        build_seconds = time.perf_counter() - start
+        kb.context_cache = ContextCache(0)  # Measure retrieval, not cache hits
+
+        for label in queries:
+            kb.search(label['query'])  # Warm up
+
+        search = measure(kb.search, queries, iterations)
+        context = measure(lambda query: kb.get_relevant_context(query, max_tokens=CONTEXT_TOKENS),
+                          queries, iterations)
+        qps = {str(threads): throughput(kb, queries, threads, iterations) for threads in thread_counts}
+        scores = relevance(kb, queries)
+
+        return {
+            'mode': mode,
+            'chunking': chunking,
+            'chunks': len(kb.chunks),
+            'build_seconds': round(build_seconds, 3),
+            # ru_maxrss is in kB on Linux
+            'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            'latency_ms': {'search': summarize(search), 'context': summarize(context)},
+            'qps': qps,
+            'relevance': scores,
+        }
+
+
+def run_in_subprocess(mode: str, args) -> Dict:
+    command = [sys.executable, __file__, '--worker', mode, '--chunking', args.chunking,
+               '--iterations', str(args.iterations), '--threads', args.threads, '--queries', args.queries]
+    output = subprocess.run(command, capture_output=True, text=True, cwd=str(PROJECT_ROOT))
+    if output.returncode != 0:
+        raise RuntimeError(f"{mode} run failed:\n{output.stderr or output.stdout}")
+    # The last line is the result; earlier ones are the knowledge base's progress messages
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def report(run: Dict) -> None:
+    search, context = run['latency_ms']['search'], run['latency_ms']['context']
+    scores = run['relevance']
+    print(f"\n{run['mode']} ({run['chunking']} chunking, {run['chunks']} chunks)")
+    print(f"  build {run['build_seconds']:.2f} s, peak RSS {run['peak_rss_mb']:.0f} MB")
+    print(f"  search  p50={search['p50']:7.3f} ms  p95={search['p95']:7.3f} ms  p99={search['p99']:7.3f} ms")
+    print(f"  context p50={context['p50']:7.3f} ms  p95={context['p95']:7.3f} ms  p99={context['p99']:7.3f} ms")
+    print("  qps     " + "  ".join(f"{threads} thread(s): {qps:.0f}" for threads, qps in run['qps'].items()))
+    print("  " + "  ".join(f"{name}={scores[name]:.3f}" for name in [f'recall@{k}' for k in K_VALUES] + ['mrr']))
+    missed = [entry['query'] for entry in scores['per_query'] if entry['rank'] is None]
+    if missed:
+        print(f"  no relevant passage in the top {max(K_VALUES)}: " + "; ".join(missed))
+
+
+def regressions(runs: List[Dict], baseline_path: str, tolerance: float) -> List[str]:
+    """Relevance scores that dropped by more than ``tolerance`` since the baseline run."""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = {(run['mode'], run['chunking']): run for run in json.load(f)['runs']}
+
+    found = []
+    for run in runs:
+        before = baseline.get((run['mode'], run['chunking']))
+        if before is None:
+            continue
+        for name in [f'recall@{k}' for k in K_VALUES] + ['mrr']:
+            old, new = before['relevance'].get(name), run['relevance'][name]
+            if old is not None and new < old - tolerance:
+                found.append(f"{run['mode']} {name}: {old:.3f} -> {new:.3f}")
+        old_p50 = before['latency_ms']['search']['p50']
+        new_p50 = run['latency_ms']['search']['p50']
+        print(f"{run['mode']}: search p50 {old_p50:.3f} -> {new_p50:.3f} ms, "
+              f"build {before['build_seconds']:.2f} -> {run['build_seconds']:.2f} s")
+    return found
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark AAOIFI retrieval speed and relevance")
+    parser.add_argument('--modes', default='lexical,dense,hybrid',
+                        help="Comma-separated retrieval modes to run")
+    parser.add_argument('--chunking', default='fixed', choices=('fixed', 'structured'))
+    parser.add_argument('--iterations', type=int, default=5,
+                        help="Passes over the queries for latency and throughput")
+    parser.add_argument('--threads', default='1,2,4,8', help="Thread counts for the throughput test")
+    parser.add_argument('--queries', default=str(QUERIES_PATH), help="Labeled queries file")
+    parser.add_argument('--output', default='bench_retrieval.json', help="Where to write the results")
+    parser.add_argument('--baseline', help="Earlier results file to check for relevance regressions")
+    parser.add_argument('--tolerance', type=float, default=0.02,
+                        help="Largest drop in recall@k/MRR accepted against the baseline")
+    parser.add_argument('--worker', help=argparse.SUPPRESS)  # Run one mode and print its JSON
+    args = parser.parse_args()
+
+    thread_counts = [int(threads) for threads in args.threads.split(',')]
+
+    if args.worker:
+        print(json.dumps(run_mode(args.worker, args.chunking, args.iterations, thread_counts,
+                                  Path(args.queries))))
+        return
+
+    if not TEXT_PATH.exists():
+        print(f"{TEXT_PATH} not found; run scripts/convert_pdf_to_text.py first")
+        sys.exit(1)
+
+    runs = []
+    for mode in args.modes.split(','):
+        run = run_in_subprocess(mode.strip(), args)
+        report(run)
+        runs.append(run)
+
+    results = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'embedder': os.getenv('PDF_EMBEDDER', 'hashing'),
+        'queries': len(load_queries(Path(args.queries))),
+        'runs': runs,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nWrote {args.output}")
+
+    if args.baseline:
+        found = regressions(runs, args.baseline, args.tolerance)
+        if found:
+            print("Relevance regressions:\n  " + "\n  ".join(found))
+            sys.exit(1)
+        print("No relevance regressions")
+
+
+if __name__ == "__main__":
+    main()
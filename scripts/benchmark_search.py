@@ -0,0 +1,97 @@
+"""
+Benchmark AAOIFI knowledge base search latency.
+
+Compares the original linear scan (lowercase every chunk and count each
+query term) against the BM25 inverted index used by PDFKnowledgeBase.search.
+
+Usage:
+    python scripts/benchmark_search.py [iterations]
+"""
+
+import re
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+
+from src.pdf_knowledge import PDFKnowledgeBase  # noqa: E402
+
+QUERIES = [
+    "Is trading in currencies on the forward market permissible?",
+    "Can you explain whether a conventional fixed-rate bond is Sharia-compliant?",
+    "murabahah to the purchase orderer",
+    "sukuk",
+    "What are the conditions for a valid ijarah muntahia bittamleek contract?",
+    "credit card late payment penalty charity",
+    "zakah on shares of companies",
+    "guarantees in mudarabah and musharakah",
+]
+
+
+def linear_scan_search(chunks: List[str], query: str, max_results: int = 3) -> List[Dict[str, str]]:
+    """The pre-index implementation of PDFKnowledgeBase.search."""
+    query_terms = query.lower().split()
+    scored_chunks = []
+    for chunk in chunks:
+        chunk_lower = chunk.lower()
+        score = sum(chunk_lower.count(term) for term in query_terms)
+        if score > 0:
+            page_match = re.search(r'--- Page (\d+) ---', chunk)
+            page = page_match.group(1) if page_match else "Unknown"
+            scored_chunks.append({'text': chunk, 'score': score, 'page': page})
+    scored_chunks.sort(key=lambda x: x['score'], reverse=True)
+    return scored_chunks[:max_results]
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def measure(fn, iterations: int) -> List[float]:
+    timings = []
+    for _ in range(iterations):
+        for query in QUERIES:
+            start = time.perf_counter()
+            fn(query)
+            timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def report(name: str, timings: List[float]) -> None:
+    print(f"{name:<14} p50={percentile(timings, 50):8.3f} ms  "
+          f"p99={percentile(timings, 99):8.3f} ms  "
+          f"mean={statistics.mean(timings):8.3f} ms  n={len(timings)}")
+
+
+def main(iterations: int = 20) -> None:
+    kb = PDFKnowledgeBase()
+
+    start = time.perf_counter()
+    kb.search("warm up")
+    print(f"Load + chunk + index build: {(time.perf_counter() - start) * 1000:.1f} ms "
+          f"({len(kb.chunks)} chunks, {kb.index.num_terms} terms)\n")
+
+    scan = measure(lambda q: linear_scan_search(kb.chunks, q), max(1, iterations // 10))
+    indexed = measure(lambda q: kb.search(q), iterations)
+
+    report("linear scan", scan)
+    report("bm25 index", indexed)
+    print(f"\nSpeed-up at p50: {percentile(scan, 50) / percentile(indexed, 50):.1f}x")
+
+
+if __name__ == "__main__":
+    iterations = 20
+    if len(sys.argv) > 1:
+        try:
+            iterations = int(sys.argv[1])
+        except ValueError:
+            print("Usage: python scripts/benchmark_search.py [iterations]")
+            sys.exit(1)
+
+    main(iterations)
@@ -0,0 +1,96 @@
+"""
+Build the precompiled AAOIFI Standards knowledge base artifact.
+
+Chunks and indexes data/AAOIFI-Standards.txt once and writes
+data/AAOIFI-Standards.kbidx, keyed by a hash of the text. Workers load the
+artifact at startup instead of re-chunking; if the text changes, the first
+worker to notice rebuilds it automatically.
+
+If an artifact from an earlier version of the text exists, only the pages
+whose content changed are re-chunked and re-indexed (and, with --embedder,
+re-embedded); pass --full to rebuild everything. Running workers pick up the
+new artifact within PDF_RELOAD_INTERVAL seconds, without a restart.
+
+Pass --embedder to also build the dense (embedding) index used when
+PDF_RETRIEVAL_MODE=dense.
+
+Usage:
+    python scripts/build_knowledge_index.py [text_path] [--embedder hashing|tfidf-svd|openai] [--full]
+"""
+
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Optional
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+
+from src.kb_artifact import content_hash, read_artifact, save_artifact  # noqa: E402
+from src.pdf_knowledge import PDFKnowledgeBase  # noqa: E402
+
+
+def build_knowledge_index(text_path: Optional[str] = None, embedder: Optional[str] = None,
+                          full: bool = False) -> str:
+    """
+    Build (or incrementally update) and save the artifact for a text file.
+
+    :param text_path: Path to the knowledge base text file (default: AAOIFI Standards)
+    :param embedder: Also build the dense index with this embedder
+    :param full: Rebuild from scratch instead of reusing unchanged pages
+    :return: Path of the written artifact
+    """
+    kb = PDFKnowledgeBase(text_path=text_path, embedder=embedder, reload_interval=0)
+
+    start = time.perf_counter()
+    with open(kb.text_path, 'r', encoding='utf-8') as f:
+        content = f.read()
+    source_hash = content_hash(content)
+    previous = None if full else read_artifact(kb.artifact_path, kb._index_params())
+    if previous is not None and previous['source_hash'] == source_hash:
+        print(f"✓ Knowledge base artifact is up to date: {kb.artifact_path}")
+    else:
+        payload = kb.build_index(content, previous)
+        save_artifact(kb.artifact_path, source_hash, payload)
+        elapsed = time.perf_counter() - start
+
+        size_mb = os.path.getsize(kb.artifact_path) / (1024 * 1024)
+        print(f"✓ Knowledge base artifact written: {kb.artifact_path}")
+        print(f"  Chunks: {len(payload['chunk_offsets']) // 2}")
+        print(f"  Size: {size_mb:.1f} MB")
+        print(f"  Build time: {elapsed:.2f} s")
+
+    if embedder is not None:
+        start = time.perf_counter()
+        if full:
+            # Refit the embedder too instead of reusing any stored embeddings
+            from src.dense_index import dense_paths
+            from src.embeddings import get_embedder
+            for path in dense_paths(kb.artifact_path, get_embedder(embedder)):
+                if path.exists():
+                    path.unlink()
+        kb.retrieval = 'dense'
+        if not kb.load() or kb.dense is None:
+            raise RuntimeError("Could not build the dense index")
+        print(f"✓ Dense index built with the {embedder} embedder "
+              f"({kb.dense.matrix.shape[1]} dims) in {time.perf_counter() - start:.2f} s")
+
+    return kb.artifact_path
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    full = '--full' in args
+    if full:
+        args.remove('--full')
+    embedder = None
+    if '--embedder' in args:
+        position = args.index('--embedder')
+        if position + 1 >= len(args):
+            print("Usage: python scripts/build_knowledge_index.py [text_path] [--embedder NAME] [--full]")
+            sys.exit(1)
+        embedder = args[position + 1]
+        del args[position:position + 2]
+
+    build_knowledge_index(args[0] if args else None, embedder=embedder, full=full)
@@ -3,105 +3,233 @@ Convert AAOIFI Standards PDF to text file for faster access.
 
 Run this script once to create AAOIFI-Standards.txt
 The application will then read from the text file instead of parsing PDF.
+
+Pages are extracted in parallel on a process pool and streamed to disk in
+page order, so memory stays bounded. Progress is journalled to
+AAOIFI-Standards.pages.jsonl: one line per page written (page number, byte
+offset and length in the text file) plus a commit line after every batch.
+If the conversion is interrupted, running it again resumes after the last
+committed batch. When it finishes, the journal remains as the page index of
+the text file.
+
+The chunk index is the knowledge base artifact, built from the finished text
+right after (see build_knowledge_index.py). Chunking is not journalled per
+page, as structured chunking reads standard and section headings across
+pages; when a new edition is converted, the artifact of the previous text is
+updated for the changed pages only.
+
+Usage:
+    python scripts/convert_pdf_to_text.py [max_pages] [--workers N] [--batch-size N] [--restart]
 """
 
+import argparse
+import hashlib
+import json
 import os
-from typing import Optional
+import sys
+import time
+from pathlib import Path
+from typing import Dict, Optional
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+
+from src.pdf_extract import PAGE_SEPARATOR, count_pages, format_page, iter_page_batches, pdf_backend  # noqa: E402
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def fsync_directory(path: str) -> None:
+    """Make a rename in a directory durable (a no-op where directories can't be opened)."""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def journal_path_for(output_path: str) -> str:
+    """data/AAOIFI-Standards.txt -> data/AAOIFI-Standards.pages.jsonl"""
+    return str(Path(output_path).with_suffix('.pages.jsonl'))
+
+
+def read_checkpoint(journal_path: str, header: Dict) -> Optional[Dict]:
+    """
+    Last committed position of an earlier run of the same conversion.
+
+    :return: {'next_page', 'bytes', 'pages_written', 'journal_bytes', 'complete'},
+             or None if there is no journal or it belongs to another PDF/settings
+    """
+    if not os.path.exists(journal_path):
+        return None
+    checkpoint = None
+    pages_written = 0
+    offset = 0
+    with open(journal_path, 'rb') as f:
+        for line_number, line in enumerate(f):
+            offset += len(line)
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break  # Torn write at the end of the journal
+            if line_number == 0:
+                if record != header:
+                    return None
+                continue
+            if 'page' in record:
+                pages_written += 1
+            elif 'commit' in record:
+                checkpoint = {
+                    'next_page': record['commit'],
+                    'bytes': record['bytes'],
+                    'pages_written': pages_written,
+                    'journal_bytes': offset,
+                    'complete': record.get('complete', False),
+                }
+    return checkpoint
 
 
-def convert_pdf_to_text(pdf_path: str = "data/AAOIFI-Standards.pdf", 
+def convert_pdf_to_text(pdf_path: str = "data/AAOIFI-Standards.pdf",
                         output_path: str = "data/AAOIFI-Standards.txt",
-                        max_pages: Optional[int] = None):
+                        max_pages: Optional[int] = None,
+                        workers: Optional[int] = None,
+                        batch_size: int = 25,
+                        resume: bool = True,
+                        build_index: bool = True):
     """
     Convert PDF to text file.
-    
+
     :param pdf_path: Path to the PDF file
     :param output_path: Path to output text file
     :param max_pages: Maximum pages to process (None for all)
+    :param workers: Extraction processes (default: CPU count)
+    :param batch_size: Pages per extraction task (and per checkpoint)
+    :param resume: Continue an interrupted conversion instead of starting over
+    :param build_index: Precompile the knowledge base index afterwards
     """
     print(f"Converting {pdf_path} to {output_path}...")
-    
-    # Try PyPDF2 first
-    try:
-        import PyPDF2
-        text_content = []
-        
-        with open(pdf_path, 'rb') as file:
-            pdf_reader = PyPDF2.PdfReader(file)
-            total_pages = len(pdf_reader.pages)
-            pages_to_process = min(total_pages, max_pages) if max_pages else total_pages
-            
-            print(f"Processing {pages_to_process} of {total_pages} pages...")
-            
-            for page_num in range(pages_to_process):
-                try:
-                    page = pdf_reader.pages[page_num]
-                    text = page.extract_text()
-                    if text and text.strip():
-                        text_content.append(f"--- Page {page_num + 1} ---\n{text}")
-                    
-                    if (page_num + 1) % 100 == 0:
-                        print(f"  Processed {page_num + 1} pages...")
-                except Exception as e:
-                    print(f"  Warning: Could not extract page {page_num + 1}: {e}")
+    start_time = time.perf_counter()
+
+    backend = pdf_backend()
+    workers = workers or os.cpu_count() or 1
+    total_pages = count_pages(pdf_path, backend)
+    pages_to_process = min(total_pages, max_pages) if max_pages else total_pages
+
+    partial_path = output_path + ".partial"
+    journal_path = journal_path_for(output_path)
+    header = {
+        'pdf_sha256': file_sha256(pdf_path),
+        'backend': backend,
+        'pages_to_process': pages_to_process,
+    }
+
+    checkpoint = read_checkpoint(journal_path, header) if resume else None
+    if checkpoint and checkpoint['complete'] and os.path.exists(output_path):
+        print(f"✓ {output_path} is already converted from this PDF (use --restart to redo it)")
+        return
+    if checkpoint and not os.path.exists(partial_path):
+        checkpoint = None
+
+    if checkpoint:
+        next_page = checkpoint['next_page']
+        pages_written = checkpoint['pages_written']
+        # Drop anything written after the last commit
+        with open(partial_path, 'r+b') as f:
+            f.truncate(checkpoint['bytes'])
+        with open(journal_path, 'r+b') as f:
+            f.truncate(checkpoint['journal_bytes'])
+        print(f"Resuming at page {next_page + 1} of {pages_to_process} "
+              f"({pages_written} pages already written)")
+    else:
+        next_page = 0
+        pages_written = 0
+        open(partial_path, 'wb').close()
+        with open(journal_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(header) + "\n")
+
+    print(f"Processing {pages_to_process} of {total_pages} pages "
+          f"with {workers} worker{'s' if workers != 1 else ''} ({backend})...")
+
+    with open(partial_path, 'ab') as out, open(journal_path, 'a', encoding='utf-8') as journal:
+        offset = out.tell()
+        reported = next_page // 100
+        for batch in iter_page_batches(pdf_path, next_page, pages_to_process,
+                                       workers=workers, batch_size=batch_size, backend=backend):
+            for page_number, text in batch:
+                if not text.strip():
                     continue
-        
-        full_text = "\n\n".join(text_content)
-        
-    except ImportError:
-        # Try pdfplumber
-        try:
-            import pdfplumber
-            text_content = []
-            
-            with pdfplumber.open(pdf_path) as pdf:
-                total_pages = len(pdf.pages)
-                pages_to_process = min(total_pages, max_pages) if max_pages else total_pages
-                
-                print(f"Processing {pages_to_process} of {total_pages} pages...")
-                
-                for page_num in range(pages_to_process):
-                    try:
-                        page = pdf.pages[page_num]
-                        text = page.extract_text()
-                        if text and text.strip():
-                            text_content.append(f"--- Page {page_num + 1} ---\n{text}")
-                        
-                        if (page_num + 1) % 100 == 0:
-                            print(f"  Processed {page_num + 1} pages...")
-                    except Exception as e:
-                        print(f"  Warning: Could not extract page {page_num + 1}: {e}")
-                        continue
-            
-            full_text = "\n\n".join(text_content)
-            
-        except ImportError:
-            raise ImportError("Please install PyPDF2 or pdfplumber: pip install PyPDF2 pdfplumber")
-    
-    # Write to text file
-    with open(output_path, 'w', encoding='utf-8') as f:
-        f.write(full_text)
-    
+                block = format_page(page_number, text).encode('utf-8')
+                if offset:
+                    out.write(PAGE_SEPARATOR.encode('utf-8'))
+                    offset += len(PAGE_SEPARATOR)
+                out.write(block)
+                journal.write(json.dumps({'page': page_number, 'offset': offset, 'length': len(block)}) + "\n")
+                offset += len(block)
+                pages_written += 1
+
+            # Text first, then the commit that points at it
+            out.flush()
+            os.fsync(out.fileno())
+            next_page = batch[-1][0] if batch else next_page
+            journal.write(json.dumps({'commit': next_page, 'bytes': offset}) + "\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+
+            if next_page // 100 > reported:
+                reported = next_page // 100
+                print(f"  Processed {next_page} pages...")
+
+    if pages_written == 0:
+        raise Exception("No text could be extracted from PDF")
+    # The rename must reach the disk before the record that says it happened
+    os.replace(partial_path, output_path)
+    fsync_directory(os.path.dirname(os.path.abspath(output_path)))
+    with open(journal_path, 'a', encoding='utf-8') as journal:
+        journal.write(json.dumps({'commit': next_page, 'bytes': offset, 'complete': True}) + "\n")
+        journal.flush()
+        os.fsync(journal.fileno())
+
     file_size_mb = os.path.getsize(output_path) / (1024 * 1024)
-    print(f"\n✓ Conversion complete!")
+    print(f"\n✓ Conversion complete in {time.perf_counter() - start_time:.1f}s!")
     print(f"  Output file: {output_path}")
+    print(f"  Page index: {journal_path}")
     print(f"  File size: {file_size_mb:.1f} MB")
-    print(f"  Pages processed: {pages_to_process}")
+    print(f"  Pages processed: {pages_to_process} ({pages_written} with text)")
     print(f"\nThe application will now use {output_path} instead of parsing the PDF.")
 
+    if build_index:
+        # Precompile the chunk/search index so workers don't rebuild it at startup
+        from build_knowledge_index import build_knowledge_index
+        build_knowledge_index(os.path.abspath(output_path))
+
 
 if __name__ == "__main__":
-    import sys
-    
-    # Allow limiting pages for testing
-    max_pages = None
-    if len(sys.argv) > 1:
-        try:
-            max_pages = int(sys.argv[1])
-            print(f"Limiting to first {max_pages} pages for testing...")
-        except ValueError:
-            print("Usage: python convert_pdf_to_text.py [max_pages]")
-            sys.exit(1)
-    
-    convert_pdf_to_text(max_pages=max_pages)
+    parser = argparse.ArgumentParser(description="Convert the AAOIFI Standards PDF to text")
+    parser.add_argument('max_pages', nargs='?', type=int, default=None,
+                        help="Limit to the first N pages (for testing)")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Extraction processes (default: CPU count)")
+    parser.add_argument('--batch-size', type=int, default=25,
+                        help="Pages per task and per checkpoint (default: 25)")
+    parser.add_argument('--restart', action='store_true',
+                        help="Ignore any interrupted conversion and start over")
+    parser.add_argument('--pdf', default="data/AAOIFI-Standards.pdf")
+    parser.add_argument('--output', default="data/AAOIFI-Standards.txt")
+    args = parser.parse_args()
+
+    if args.max_pages:
+        print(f"Limiting to first {args.max_pages} pages for testing...")
 
+    convert_pdf_to_text(args.pdf, args.output, max_pages=args.max_pages, workers=args.workers,
+                        batch_size=args.batch_size, resume=not args.restart)
@@ -0,0 +1,378 @@
+"""
+End-to-end load test of /ask against a local mock OpenAI API.
+
+Starts scripts/mock_openai_server.py and the app under gunicorn (pointed at
+the mock through OPENAI_BASE_URL), then sends questions at each target rate
+for --duration seconds. Arrivals are open-loop: requests go out on schedule
+whether or not earlier ones have finished, as real traffic does, so an
+overloaded server shows up as growing latency and errors rather than as a
+politely slower client.
+
+For every configuration (gunicorn workers x threads, PDF context on/off)
+and rate it reports:
+
+  - latency p50/p90/p99/max and a histogram (time to first token too, with --stream)
+  - error rate, by cause (HTTP status, timeout, connection error)
+  - achieved throughput: completions per second over the second half of
+    the sending window, once the server has reached a steady state
+  - worker saturation: requests in flight (sampled every 50 ms) divided by
+    workers x threads. Above 1.0 requests are queueing for a free thread.
+  - CPU use and RSS of the gunicorn processes (Linux)
+
+A rate counts as sustained if under 1% of requests fail, p99 stays under
+--slo-ms and at least 95% of the target rate completes. The highest
+sustained rate of each configuration is printed at the end; once a rate
+isn't sustained, higher ones are skipped. Each question
+is made unique, so retrieval isn't served from the context cache, and the
+answer cache is off.
+
+Usage:
+    python scripts/loadtest.py [--workers 1,2] [--threads 1,8] [--pdf off,on] [--rps 5,10,20,40]
+                               [--duration 20] [--stream] [--latency-ms 800]
+                               [--tokens-per-second 80] [--answer-tokens 200]
+                               [--slo-ms 5000] [--output loadtest.json]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import httpx
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+
+QUERIES_PATH = PROJECT_ROOT / 'data' / 'benchmark_queries.json'
+
+# Upper bounds (ms) of the latency histogram buckets
+BUCKETS_MS = (100, 250, 500, 1000, 2000, 4000, 8000, 16000, float('inf'))
+
+REQUEST_TIMEOUT = 60.0
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def load_questions() -> List[str]:
+    with open(QUERIES_PATH, encoding='utf-8') as f:
+        return [label['query'] for label in json.load(f)]
+
+
+def wait_for(url: str, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url, timeout=2).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} not ready after {timeout:.0f} s")
+
+
+def process_tree(pid: int) -> List[int]:
+    """pid and its child processes (the gunicorn master and its workers)."""
+    pids = [pid]
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # The command name may contain spaces: fields resume after ')'
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            pids.append(int(entry))
+    return pids
+
+
+def cpu_seconds(pids: List[int]) -> float:
+    total = 0
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            total += int(fields[11]) + int(fields[12])  # utime, stime
+        except OSError:
+            pass
+    return total / os.sysconf('SC_CLK_TCK')
+
+
+def rss_mb(pids: List[int]) -> float:
+    total = 0
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total / 1024
+
+
+class Server:
+    """The app under gunicorn, talking to a mock OpenAI API."""
+
+    def __init__(self, workers: int, threads: int, pdf: bool, openai_base_url: str):
+        self.workers = workers
+        self.threads = threads
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        env = dict(os.environ,
+                   OPENAI_BASE_URL=openai_base_url,
+                   OPENAI_API_KEY=os.getenv('OPENAI_API_KEY', 'test'),
+                   ENABLE_PDF_KNOWLEDGE='true' if pdf else 'false',
+                   ANSWER_CACHE='off')
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--workers', str(workers),
+             '--threads', str(threads), '--bind', f'127.0.0.1:{self.port}', '--timeout', '120',
+             '--log-level', 'warning', 'src.app:app'],
+            cwd=str(PROJECT_ROOT), env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        wait_for(f"{self.url}/ready", timeout=120)
+
+    def pids(self) -> List[int]:
+        return process_tree(self.process.pid) if os.path.isdir('/proc') else []
+
+    def stop(self) -> None:
+        self.process.send_signal(signal.SIGTERM)
+        try:
+            self.process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+async def send_one(client: httpx.AsyncClient, url: str, question: str, stream: bool) -> Dict:
+    """One /ask (or /ask/stream) request; returns its timings and outcome."""
+    start = time.perf_counter()
+    record = {'error': None, 'ttft_ms': None}
+    body = {'question': question}
+    try:
+        if stream:
+            async with client.stream('POST', f"{url}/ask/stream", json=body) as response:
+                if response.status_code != 200:
+                    record['error'] = f"HTTP {response.status_code}"
+                async for line in response.aiter_lines():
+                    if line.startswith('event: delta') and record['ttft_ms'] is None:
+                        record['ttft_ms'] = (time.perf_counter() - start) * 1000
+                    elif line.startswith('event: error'):
+                        record['error'] = 'error event'
+        else:
+            response = await client.post(f"{url}/ask", json=body)
+            if response.status_code != 200:
+                record['error'] = f"HTTP {response.status_code}"
+    except httpx.TimeoutException:
+        record['error'] = 'timeout'
+    except httpx.HTTPError as e:
+        record['error'] = type(e).__name__
+    record['finished'] = time.perf_counter()
+    record['latency_ms'] = (record['finished'] - start) * 1000
+    return record
+
+
+async def run_rate(url: str, rps: float, duration: float, questions: List[str], stream: bool,
+                   pids: List[int]) -> Dict:
+    """Send requests at ``rps`` for ``duration`` seconds and wait for all of them."""
+    in_flight = 0
+    samples = []
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(timeout=REQUEST_TIMEOUT, limits=limits) as client:
+
+        async def tracked(index: int) -> Dict:
+            nonlocal in_flight
+            in_flight += 1
+            try:
+                # Unique questions: no context cache hits
+                question = f"{questions[index % len(questions)]} (product {index})"
+                return await send_one(client, url, question, stream)
+            finally:
+                in_flight -= 1
+
+        async def sample() -> None:
+            while True:
+                samples.append(in_flight)
+                await asyncio.sleep(0.05)
+
+        sampler = asyncio.ensure_future(sample())
+        cpu_start = cpu_seconds(pids)
+        start = time.perf_counter()
+        tasks = []
+        total = int(rps * duration)
+        for index in range(total):
+            # Open loop: the schedule doesn't wait for responses
+            delay = start + index / rps - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.ensure_future(tracked(index)))
+        records = await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+        sampler.cancel()
+        cpu = cpu_seconds(pids) - cpu_start
+
+    ok = [record for record in records if record['error'] is None]
+    latencies = [record['latency_ms'] for record in ok]
+    errors: Dict[str, int] = {}
+    for record in records:
+        if record['error'] is not None:
+            errors[record['error']] = errors.get(record['error'], 0) + 1
+
+    result = {
+        'target_rps': rps,
+        'sent': total,
+        'completed': len(ok),
+        'achieved_rps': round(sum(1 for record in ok
+                                  if duration / 2 <= record['finished'] - start < duration) / (duration / 2), 2),
+        'error_rate': round(1 - len(ok) / total, 4) if total else 0.0,
+        'errors': errors,
+        'in_flight_mean': round(statistics.mean(samples), 2) if samples else 0.0,
+        'in_flight_max': max(samples) if samples else 0,
+        'server_cpu_percent': round(100 * cpu / elapsed, 1) if pids else None,
+        'server_rss_mb': round(rss_mb(pids), 1) if pids else None,
+    }
+    if latencies:
+        result['latency_ms'] = {name: round(percentile(latencies, pct), 1)
+                                for name, pct in (('p50', 50), ('p90', 90), ('p99', 99), ('max', 100))}
+        histogram, previous = {}, 0.0
+        for bound in BUCKETS_MS:
+            label = f"<={bound:g}" if bound != float('inf') else f">{previous:g}"
+            histogram[label] = sum(1 for latency in latencies if previous < latency <= bound)
+            previous = bound
+        result['histogram_ms'] = histogram
+    ttfts = [record['ttft_ms'] for record in ok if record['ttft_ms'] is not None]
+    if ttfts:
+        result['ttft_ms'] = {'p50': round(percentile(ttfts, 50), 1), 'p99': round(percentile(ttfts, 99), 1)}
+    return result
+
+
+def sustained(result: Dict, slo_ms: float) -> bool:
+    return (result['error_rate'] < 0.01
+            and 'latency_ms' in result and result['latency_ms']['p99'] <= slo_ms
+            and result['achieved_rps'] >= 0.95 * result['target_rps'])
+
+
+def report(result: Dict, capacity: int, slo_ms: float) -> None:
+    latency = result.get('latency_ms', {})
+    line = (f"  {result['target_rps']:>6g} rps: achieved {result['achieved_rps']:6.1f}  "
+            f"p50 {latency.get('p50', 0):7.0f} ms  p99 {latency.get('p99', 0):7.0f} ms  "
+            f"errors {100 * result['error_rate']:5.1f}%  "
+            f"saturation {result['in_flight_mean'] / capacity:5.2f} (max {result['in_flight_max']})")
+    if result['server_cpu_percent'] is not None:
+        line += f"  cpu {result['server_cpu_percent']:5.0f}%  rss {result['server_rss_mb']:.0f} MB"
+    if 'ttft_ms' in result:
+        line += f"  ttft p50 {result['ttft_ms']['p50']:.0f} ms"
+    print(line + ("" if sustained(result, slo_ms) else "  [not sustained]"), flush=True)
+    if result['errors']:
+        print(f"           errors: {result['errors']}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Load test /ask against a mock OpenAI API")
+    parser.add_argument('--workers', default='2', help="Comma-separated gunicorn worker counts")
+    parser.add_argument('--threads', default='8', help="Comma-separated threads per worker")
+    parser.add_argument('--pdf', default='off,on', help="AAOIFI context: off, on, or off,on")
+    parser.add_argument('--rps', default='5,10,20,40', help="Comma-separated target request rates")
+    parser.add_argument('--duration', type=float, default=20.0, help="Seconds per rate")
+    parser.add_argument('--stream', action='store_true', help="Use /ask/stream instead of /ask")
+    parser.add_argument('--latency-ms', type=float, default=800.0, help="Mock time to first token")
+    parser.add_argument('--tokens-per-second', type=float, default=80.0, help="Mock generation rate")
+    parser.add_argument('--answer-tokens', type=int, default=200, help="Mock answer length")
+    parser.add_argument('--openai-base-url', help="Use this OpenAI-compatible API instead of starting the mock")
+    parser.add_argument('--slo-ms', type=float, default=5000.0, help="p99 latency a sustained rate must meet")
+    parser.add_argument('--output', default='loadtest.json', help="Where to write the results")
+    args = parser.parse_args()
+
+    mock = None
+    openai_base_url = args.openai_base_url
+    if openai_base_url is None:
+        mock_port = free_port()
+        mock = subprocess.Popen(
+            [sys.executable, str(PROJECT_ROOT / 'scripts' / 'mock_openai_server.py'), '--port', str(mock_port),
+             '--latency-ms', str(args.latency_ms), '--tokens-per-second', str(args.tokens_per_second),
+             '--answer-tokens', str(args.answer_tokens)],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        openai_base_url = f"http://127.0.0.1:{mock_port}/v1"
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', mock_port), timeout=1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+
+    questions = load_questions()
+    rates = [float(rps) for rps in args.rps.split(',')]
+    configs = []
+    try:
+        for pdf in [mode.strip() == 'on' for mode in args.pdf.split(',')]:
+            for workers in [int(w) for w in args.workers.split(',')]:
+                for threads in [int(t) for t in args.threads.split(',')]:
+                    capacity = workers * threads
+                    print(f"\n{workers} worker(s) x {threads} thread(s), PDF context {'on' if pdf else 'off'}",
+                          flush=True)
+                    server = Server(workers, threads, pdf, openai_base_url)
+                    try:
+                        results = []
+                        for rps in rates:
+                            result = asyncio.run(run_rate(server.url, rps, args.duration, questions,
+                                                          args.stream, server.pids()))
+                            report(result, capacity, args.slo_ms)
+                            results.append(result)
+                            if not sustained(result, args.slo_ms):
+                                break  # Higher rates would only queue more
+                    finally:
+                        server.stop()
+                    best = max((result['target_rps'] for result in results if sustained(result, args.slo_ms)),
+                               default=None)
+                    configs.append({'workers': workers, 'threads': threads, 'pdf': pdf,
+                                    'max_sustained_rps': best, 'rates': results})
+    finally:
+        if mock is not None:
+            mock.terminate()
+            mock.wait()
+
+    print("\nHighest sustained rate:")
+    for config in configs:
+        best = config['max_sustained_rps']
+        print(f"  {config['workers']} x {config['threads']}, PDF {'on ' if config['pdf'] else 'off'}: "
+              f"{f'{best:g} rps' if best is not None else 'none of the rates tested'}")
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump({
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'cpus': os.cpu_count(),
+            'mock': None if args.openai_base_url else {
+                'latency_ms': args.latency_ms,
+                'tokens_per_second': args.tokens_per_second,
+                'answer_tokens': args.answer_tokens,
+            },
+            'stream': args.stream,
+            'duration_s': args.duration,
+            'slo_ms': args.slo_ms,
+            'configs': configs,
+        }, f, indent=2)
+    print(f"\nWrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,290 @@
+"""
+Local mock of the OpenAI API for load tests.
+
+Serves POST /v1/chat/completions (plain and streamed) with a canned answer,
+over HTTP/1.1 keep-alive, and counts the TCP connections it accepts. A
+per-connection delay stands in for the TCP+TLS handshake to the real API,
+so tests show what connection reuse saves.
+
+Timing follows the real API's shape: --latency-ms before the first token,
+then the answer generated at --tokens-per-second (streamed chunk by chunk,
+or returned whole once generated). --answer-tokens sets the answer length.
+
+Responses report usage like the real API, including provider-side prompt
+caching: a prompt of at least 1024 tokens whose beginning matches an
+earlier prompt has that prefix (in 128-token steps) reported as
+prompt_tokens_details.cached_tokens. Tokens are approximated as 4 characters.
+
+With --max-concurrent, requests beyond that many in flight are refused with
+429 and a Retry-After, like the real API's rate limits.
+
+Point the OpenAI SDK at it with:
+    OPENAI_BASE_URL=http://127.0.0.1:8099/v1 OPENAI_API_KEY=test
+
+Usage:
+    python scripts/mock_openai_server.py [--port 8099] [--latency-ms 0] [--handshake-ms 0]
+                                         [--tokens-per-second 0] [--answer-tokens 0]
+                                         [--max-concurrent 0] [--retry-after-ms 200]
+"""
+
+import argparse
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+ANSWER = ("Murabahah is a sale at cost plus an agreed profit. The institution must own "
+          "the asset and bear its risk before selling it to the customer.")
+
+# Provider prompt caching: minimum cacheable prompt and cache granularity, in tokens
+CACHE_MIN_TOKENS = 1024
+CACHE_STEP_TOKENS = 128
+CHARS_PER_TOKEN = 4
+
+
+def make_answer(tokens: int = 0) -> str:
+    """The canned answer, repeated to about ``tokens`` tokens (0: as is)."""
+    answer = ANSWER
+    while len(answer) // CHARS_PER_TOKEN < tokens:
+        answer += " " + ANSWER
+    return answer
+
+
+class MockOpenAIServer(ThreadingHTTPServer):
+    """Threaded HTTP server that records connection and request counts."""
+
+    daemon_threads = True
+    request_queue_size = 1024  # Default listen backlog (5) resets connections under load
+
+    def __init__(self, address, latency_ms: float = 0.0, handshake_ms: float = 0.0,
+                 max_concurrent: int = 0, retry_after_ms: float = 200.0,
+                 tokens_per_second: float = 0.0, answer_tokens: int = 0):
+        super().__init__(address, MockOpenAIHandler)
+        self.latency = latency_ms / 1000.0
+        self.handshake = handshake_ms / 1000.0
+        self.tokens_per_second = tokens_per_second
+        self.answer = make_answer(answer_tokens)
+        self.max_concurrent = max_concurrent
+        self.retry_after_ms = retry_after_ms
+        self.connections = 0
+        self.requests = 0
+        self.rate_limited = 0
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        self._cached_prefixes = set()
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def process_request(self, request, client_address):
+        with self._lock:
+            self.connections += 1
+        super().process_request(request, client_address)
+
+    def count_request(self) -> None:
+        with self._lock:
+            self.requests += 1
+
+    def reset_counts(self) -> None:
+        with self._lock:
+            self.connections = 0
+            self.requests = 0
+            self.rate_limited = 0
+
+    def acquire(self) -> bool:
+        """Start a request; False if max_concurrent are already in flight (respond 429)."""
+        with self._lock:
+            if self.max_concurrent and self.in_flight >= self.max_concurrent:
+                self.rate_limited += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self) -> None:
+        with self._lock:
+            self.in_flight -= 1
+
+    def usage(self, messages: list) -> dict:
+        """Token usage for a prompt, with the prefix an earlier prompt shares reported as cached."""
+        prompt = "".join(f"<{m.get('role')}>{m.get('content') or ''}" for m in messages)
+        prompt_tokens = len(prompt) // CHARS_PER_TOKEN
+        step = CACHE_STEP_TOKENS * CHARS_PER_TOKEN
+        digests = [hashlib.sha1(prompt[:end].encode('utf-8')).digest()
+                   for end in range(CACHE_MIN_TOKENS * CHARS_PER_TOKEN, len(prompt) + 1, step)]
+        with self._lock:
+            hits = 0
+            for digest in digests:
+                if digest not in self._cached_prefixes:
+                    break
+                hits += 1
+            self._cached_prefixes.update(digests)
+        cached_tokens = (CACHE_MIN_TOKENS + (hits - 1) * CACHE_STEP_TOKENS) if hits else 0
+        completion_tokens = len(self.answer) // CHARS_PER_TOKEN
+        return {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens,
+            'prompt_tokens_details': {'cached_tokens': cached_tokens},
+        }
+
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive
+
+    def setup(self):
+        super().setup()
+        if self.server.handshake:
+            time.sleep(self.server.handshake)
+
+    def log_message(self, format, *args):
+        pass  # Keep load test output clean
+
+    def _send_json(self, status: int, body: dict, headers: Optional[dict] = None) -> None:
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            self._send_json(400, {'error': {'message': 'Invalid JSON'}})
+            return
+
+        if self.path.rstrip('/') != '/v1/chat/completions':
+            self._send_json(404, {'error': {'message': f'Unknown path {self.path}'}})
+            return
+
+        self.server.count_request()
+        if not self.server.acquire():
+            self._send_json(429, {'error': {'message': 'Rate limit reached', 'type': 'requests',
+                                            'code': 'rate_limit_exceeded'}},
+                            headers={'retry-after-ms': f"{self.server.retry_after_ms:g}"})
+            return
+        try:
+            self._complete(body)
+        finally:
+            self.server.release()
+
+    def _complete(self, body: dict) -> None:
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        model = body.get('model', 'gpt-5.1')
+        usage = self.server.usage(body.get('messages') or [])
+        if body.get('stream'):
+            include_usage = (body.get('stream_options') or {}).get('include_usage', False)
+            self._stream_completion(model, usage if include_usage else None)
+        else:
+            if self.server.tokens_per_second:
+                time.sleep(usage['completion_tokens'] / self.server.tokens_per_second)
+            self._send_json(200, {
+                'id': 'chatcmpl-mock',
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': model,
+                'choices': [{
+                    'index': 0,
+                    'message': {'role': 'assistant', 'content': self.server.answer},
+                    'finish_reason': 'stop',
+                }],
+                'usage': usage,
+            })
+
+    def _stream_completion(self, model: str, usage: Optional[dict] = None) -> None:
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        def send(data: str) -> None:
+            chunk = f"data: {data}\n\n".encode('utf-8')
+            self.wfile.write(f"{len(chunk):X}\r\n".encode('ascii') + chunk + b"\r\n")
+            self.wfile.flush()
+
+        start = time.monotonic()
+        generated = 0
+        for word in self.server.answer.split(' '):
+            if self.server.tokens_per_second:
+                # Each chunk is sent once its tokens would have been generated
+                generated += len(word) + 1
+                delay = start + generated / CHARS_PER_TOKEN / self.server.tokens_per_second - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            send(json.dumps({
+                'id': 'chatcmpl-mock',
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': model,
+                'choices': [{'index': 0, 'delta': {'content': word + ' '}, 'finish_reason': None}],
+            }))
+        if usage is not None:
+            # stream_options.include_usage: a last chunk with usage and no choices
+            send(json.dumps({
+                'id': 'chatcmpl-mock',
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': model,
+                'choices': [],
+                'usage': usage,
+            }))
+        send('[DONE]')
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+def start_server(port: int = 0, latency_ms: float = 0.0, handshake_ms: float = 0.0,
+                 max_concurrent: int = 0, retry_after_ms: float = 200.0,
+                 tokens_per_second: float = 0.0, answer_tokens: int = 0) -> MockOpenAIServer:
+    """Start a mock server on a background thread (port 0 picks a free port)."""
+    server = MockOpenAIServer(('127.0.0.1', port), latency_ms=latency_ms, handshake_ms=handshake_ms,
+                              max_concurrent=max_concurrent, retry_after_ms=retry_after_ms,
+                              tokens_per_second=tokens_per_second, answer_tokens=answer_tokens)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Mock OpenAI API server")
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--latency-ms', type=float, default=0.0,
+                        help="Delay before each response (time to first token)")
+    parser.add_argument('--tokens-per-second', type=float, default=0.0,
+                        help="Answer generation rate after the first token (0: instant)")
+    parser.add_argument('--answer-tokens', type=int, default=0,
+                        help="Answer length in tokens (0: the short canned answer)")
+    parser.add_argument('--handshake-ms', type=float, default=0.0,
+                        help="Delay on each new connection (simulated TCP+TLS setup)")
+    parser.add_argument('--max-concurrent', type=int, default=0,
+                        help="Answer 429 beyond this many requests in flight (0: no limit)")
+    parser.add_argument('--retry-after-ms', type=float, default=200.0,
+                        help="retry-after-ms header of 429 responses")
+    args = parser.parse_args()
+
+    server = MockOpenAIServer(('127.0.0.1', args.port), latency_ms=args.latency_ms,
+                              handshake_ms=args.handshake_ms, max_concurrent=args.max_concurrent,
+                              retry_after_ms=args.retry_after_ms, tokens_per_second=args.tokens_per_second,
+                              answer_tokens=args.answer_tokens)
+    print(f"Mock OpenAI API on {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f"Connections: {server.connections}, requests: {server.requests}, "
+              f"rate limited: {server.rate_limited}")
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,406 @@
+"""
+Answer cache in front of the model call.
+
+Answers are cached under the normalized question plus everything else that
+shapes the reply: the model, a hash of the system prompt, a hash of the
+retrieved AAOIFI context, the chat history and the sampling parameters.
+Entries expire after a TTL and the least recently used are evicted first.
+
+Backends (ANSWER_CACHE env var):
+
+  - memory: per-process LRU dict (default when enabled)
+  - sqlite: on-disk table shared by every worker on the host
+  - redis:  any Redis-compatible server (requires the redis package)
+
+With ANSWER_CACHE_SIMILARITY set (e.g. 0.9), a question with no exact match
+can reuse the answer to a paraphrase: one asked in the same scope (model,
+prompt, context, history, parameters) whose embedding has at least that
+cosine similarity.
+"""
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from src.metrics import counter, gauge
+from src.timing import span
+
+BACKENDS = ('memory', 'sqlite', 'redis')
+
+# Disabled unless ANSWER_CACHE names a backend
+ANSWER_CACHE = os.getenv('ANSWER_CACHE', '').lower()
+ANSWER_CACHE_TTL = int(os.getenv('ANSWER_CACHE_TTL', str(24 * 3600)))
+ANSWER_CACHE_SIZE = int(os.getenv('ANSWER_CACHE_SIZE', '1000'))
+ANSWER_CACHE_PATH = os.getenv(
+    'ANSWER_CACHE_PATH', str(Path(__file__).parent.parent / "data" / "answer_cache.sqlite3"))
+ANSWER_CACHE_URL = os.getenv('ANSWER_CACHE_URL', 'redis://localhost:6379/0')
+# Minimum cosine similarity for a paraphrase hit (0 disables the lookup)
+ANSWER_CACHE_SIMILARITY = float(os.getenv('ANSWER_CACHE_SIMILARITY', '0'))
+
+# Most recent questions per scope compared in a paraphrase lookup
+SIMILARITY_CANDIDATES = 200
+
+CACHE_LOOKUPS = counter(
+    'advisor_answer_cache_lookups_total',
+    'Answer cache lookups by result (hit, similar_hit, miss)',
+    ('backend', 'result'),
+)
+CACHE_ENTRIES = gauge('advisor_answer_cache_entries', 'Answers held by the answer cache', ('backend',))
+
+
+def normalize_question(question: str) -> str:
+    """Case, punctuation and whitespace-insensitive form of a question."""
+    text = unicodedata.normalize('NFKC', question).lower()
+    return re.sub(r"[\W_]+", " ", text).strip()
+
+
+def _digest(value) -> str:
+    if not isinstance(value, str):
+        value = json.dumps(value, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(value.encode('utf-8')).hexdigest()
+
+
+class Entry:
+    """A cached answer plus the data needed for paraphrase lookups."""
+
+    __slots__ = ('answer', 'scope', 'vector', 'expires_at')
+
+    def __init__(self, answer: str, scope: str, vector: Optional[bytes], expires_at: float):
+        self.answer = answer
+        self.scope = scope
+        self.vector = vector
+        self.expires_at = expires_at
+
+
+class CacheBackend:
+    """Storage for cache entries, keyed by the exact-match key."""
+
+    name = "base"
+    # Whether len() is cheap enough for every /metrics scrape
+    counted = True
+
+    def get(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def set(self, key: str, entry: Entry, ttl: int) -> None:
+        raise NotImplementedError
+
+    def candidates(self, scope: str, limit: int) -> List[Tuple[str, bytes]]:
+        """(key, embedding) of the most recent live entries in a scope."""
+        raise NotImplementedError
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+
+class MemoryBackend(CacheBackend):
+    """Per-process LRU dict."""
+
+    name = "memory"
+
+    def __init__(self, max_entries: int = 1000):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Entry]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires_at <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry.answer
+
+    def set(self, key: str, entry: Entry, ttl: int) -> None:
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def candidates(self, scope: str, limit: int) -> List[Tuple[str, bytes]]:
+        now = time.time()
+        found = []
+        with self._lock:
+            for key in reversed(self._entries):
+                entry = self._entries[key]
+                if entry.scope == scope and entry.vector is not None and entry.expires_at > now:
+                    found.append((key, entry.vector))
+                    if len(found) >= limit:
+                        break
+        return found
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SQLiteBackend(CacheBackend):
+    """
+    On-disk cache in a SQLite file (WAL mode), shared by all worker processes
+    on the host and kept across restarts.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path: str, max_entries: int = 1000):
+        self.path = path
+        self.max_entries = max_entries
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=5.0)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS answers ("
+                " key TEXT PRIMARY KEY, scope TEXT NOT NULL, answer TEXT NOT NULL,"
+                " vector BLOB, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS answers_scope ON answers (scope, accessed_at)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS answers_accessed ON answers (accessed_at)")
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT answer FROM answers WHERE key = ? AND expires_at > ?", (key, now)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE answers SET accessed_at = ? WHERE key = ?", (now, key))
+            return row[0]
+
+    def set(self, key: str, entry: Entry, ttl: int) -> None:
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?, ?)",
+                (key, entry.scope, entry.answer, entry.vector, entry.expires_at, now),
+            )
+            self._conn.execute("DELETE FROM answers WHERE expires_at <= ?", (now,))
+            self._conn.execute(
+                "DELETE FROM answers WHERE key IN ("
+                " SELECT key FROM answers ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def candidates(self, scope: str, limit: int) -> List[Tuple[str, bytes]]:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT key, vector FROM answers WHERE scope = ? AND vector IS NOT NULL"
+                " AND expires_at > ? ORDER BY accessed_at DESC LIMIT ?",
+                (scope, time.time(), limit),
+            ).fetchall()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+
+
+class RedisBackend(CacheBackend):
+    """
+    Redis-compatible server. Expiry uses Redis TTLs; LRU eviction is left to
+    the server (configure maxmemory-policy allkeys-lru).
+    """
+
+    name = "redis"
+    prefix = "tyc:answer:"
+    counted = False  # len() scans the server's whole keyspace
+
+    def __init__(self, url: str):
+        import redis  # Optional dependency
+
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, key: str) -> Optional[str]:
+        answer = self.client.hget(self.prefix + key, 'answer')
+        return answer.decode('utf-8') if answer is not None else None
+
+    def set(self, key: str, entry: Entry, ttl: int) -> None:
+        fields = {'answer': entry.answer, 'scope': entry.scope}
+        if entry.vector is not None:
+            fields['vector'] = entry.vector
+        scope_key = f"{self.prefix}scope:{entry.scope}"
+        pipe = self.client.pipeline()
+        pipe.hset(self.prefix + key, mapping=fields)
+        pipe.expire(self.prefix + key, ttl)
+        if entry.vector is not None:
+            pipe.lrem(scope_key, 0, key)
+            pipe.lpush(scope_key, key)
+            pipe.ltrim(scope_key, 0, SIMILARITY_CANDIDATES - 1)
+            pipe.expire(scope_key, ttl)
+        pipe.execute()
+
+    def candidates(self, scope: str, limit: int) -> List[Tuple[str, bytes]]:
+        keys = [k.decode('utf-8') for k in self.client.lrange(f"{self.prefix}scope:{scope}", 0, limit - 1)]
+        if not keys:
+            return []
+        pipe = self.client.pipeline()
+        for key in keys:
+            pipe.hget(self.prefix + key, 'vector')
+        # Expired entries come back as None
+        return [(key, vector) for key, vector in zip(keys, pipe.execute()) if vector is not None]
+
+    def __len__(self) -> int:
+        scope_prefix = f"{self.prefix}scope:".encode('utf-8')
+        return sum(1 for key in self.client.scan_iter(match=self.prefix + "*", count=1000)
+                   if not key.startswith(scope_prefix))
+
+
+class AnswerCache:
+    """Exact and (optionally) paraphrase lookups over a backend."""
+
+    def __init__(self, backend: CacheBackend, ttl: int = ANSWER_CACHE_TTL,
+                 similarity: float = ANSWER_CACHE_SIMILARITY):
+        self.backend = backend
+        self.ttl = ttl
+        self.similarity = similarity
+        self._embedder = None
+
+        if similarity > 0:
+            from src.embeddings import HashingEmbedder  # numpy is only needed for paraphrase lookups
+
+            self._embedder = HashingEmbedder()
+
+    @staticmethod
+    def scope(model: str, system_prompt: str, context: str,
+              history: Optional[List[Dict]] = None, params: Optional[Dict] = None) -> str:
+        """Hash of everything except the question that determines the answer."""
+        return _digest([model, _digest(system_prompt), _digest(context or ""),
+                        history or [], params or {}])
+
+    @staticmethod
+    def key(scope: str, question: str) -> str:
+        return _digest(f"{scope}\0{normalize_question(question)}")
+
+    def _embed(self, question: str) -> Optional[bytes]:
+        if self._embedder is None:
+            return None
+        vector = self._embedder.embed([normalize_question(question)])[0]
+        return vector.tobytes() if vector.any() else None
+
+    @span('answer_cache')
+    def get(self, question: str, scope: str) -> Optional[str]:
+        """Cached answer for a question in a scope, or None (backend errors count as misses)."""
+        try:
+            answer = self.backend.get(self.key(scope, question))
+            if answer is not None:
+                CACHE_LOOKUPS.inc(backend=self.backend.name, result='hit')
+                return answer
+
+            if self._embedder is not None:
+                answer = self._similar(question, scope)
+                if answer is not None:
+                    CACHE_LOOKUPS.inc(backend=self.backend.name, result='similar_hit')
+                    return answer
+        except Exception as e:
+            print(f"Answer cache lookup failed: {e}")
+
+        CACHE_LOOKUPS.inc(backend=self.backend.name, result='miss')
+        return None
+
+    def _similar(self, question: str, scope: str) -> Optional[str]:
+        import numpy as np
+
+        query = self._embed(question)
+        candidates = self.backend.candidates(scope, SIMILARITY_CANDIDATES)
+        if query is None or not candidates:
+            return None
+        matrix = np.vstack([np.frombuffer(vector, dtype=np.float32) for _, vector in candidates])
+        scores = matrix @ np.frombuffer(query, dtype=np.float32)
+        best = int(np.argmax(scores))
+        if scores[best] < self.similarity:
+            return None
+        return self.backend.get(candidates[best][0])
+
+    @span('answer_cache')
+    def set(self, question: str, scope: str, answer: str) -> None:
+        """Cache an answer (empty answers are not cached)."""
+        if not answer:
+            return
+        try:
+            entry = Entry(answer, scope, self._embed(question), time.time() + self.ttl)
+            self.backend.set(self.key(scope, question), entry, self.ttl)
+        except Exception as e:
+            print(f"Answer cache store failed: {e}")
+
+    def stats(self) -> Dict[str, object]:
+        hits = similar = misses = 0
+        for (backend, result), count in CACHE_LOOKUPS.snapshot().items():
+            if backend != self.backend.name:
+                continue
+            if result == 'hit':
+                hits += count
+            elif result == 'similar_hit':
+                similar += count
+            else:
+                misses += count
+        lookups = hits + similar + misses
+        return {
+            'backend': self.backend.name,
+            'entries': len(self.backend),
+            'hits': int(hits),
+            'similar_hits': int(similar),
+            'misses': int(misses),
+            'hit_ratio': round((hits + similar) / lookups, 4) if lookups else 0.0,
+        }
+
+
+def create_backend(name: str) -> CacheBackend:
+    """Backend by name (one of BACKENDS), configured from the environment."""
+    if name == 'memory':
+        return MemoryBackend(ANSWER_CACHE_SIZE)
+    if name == 'sqlite':
+        return SQLiteBackend(ANSWER_CACHE_PATH, ANSWER_CACHE_SIZE)
+    if name == 'redis':
+        return RedisBackend(ANSWER_CACHE_URL)
+    raise ValueError(f"Unknown answer cache backend {name!r}, expected one of {BACKENDS}")
+
+
+# Global instance
+_answer_cache: Optional[AnswerCache] = None
+_answer_cache_lock = threading.Lock()
+_answer_cache_disabled = not ANSWER_CACHE or ANSWER_CACHE in ('0', 'false', 'off', 'none')
+
+
+def get_answer_cache() -> Optional[AnswerCache]:
+    """The process-wide answer cache, or None if caching is disabled."""
+    global _answer_cache, _answer_cache_disabled
+    if _answer_cache is None and not _answer_cache_disabled:
+        with _answer_cache_lock:
+            if _answer_cache is None and not _answer_cache_disabled:
+                name = 'memory' if ANSWER_CACHE in ('1', 'true', 'on') else ANSWER_CACHE
+                try:
+                    _answer_cache = AnswerCache(create_backend(name))
+                    print(f"Answer cache enabled ({name})")
+                except Exception as e:
+                    # The app works without a cache
+                    print(f"Warning: answer cache disabled: {e}")
+                    _answer_cache_disabled = True
+    return _answer_cache
+
+
+def get_answer_cache_stats() -> Dict[str, object]:
+    """Hit/miss counts, hit ratio and size of the answer cache (empty if disabled)."""
+    cache = get_answer_cache()
+    return cache.stats() if cache is not None else {}
+
+
+def _entries_gauge() -> Dict[Tuple[str], int]:
+    cache = get_answer_cache()
+    if cache is None or not cache.backend.counted:
+        return {}
+    return {(cache.backend.name,): len(cache.backend)}
+
+
+CACHE_ENTRIES.set_function(_entries_gauge)
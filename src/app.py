@@ -1,13 +1,110 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, g, render_template, request, jsonify, stream_with_context
 from flask_cors import CORS
-from src.tyc_advisor import TYCIslamicFinanceAdvisor
+from src.metrics import PROMETHEUS_CONTENT_TYPE, histogram, render_prometheus
+from src.pdf_knowledge import get_knowledge_base_status, warm_knowledge_base
+from src.profiling import finish_profile, start_profile
+from src.sessions import SESSION_SUMMARY_MODEL, get_session_store, is_valid_session_id, new_session_id
+from src.timing import start_timing, stop_timing
+from src.token_budget import warm_token_counters
+from src.tyc_advisor import get_advisor
+import json
 import os
+import re
+import uuid
+from typing import Dict, Optional
 
 app = Flask(__name__)
 # Enable CORS for all routes
 CORS(app)
 
-# Advisor will be created per request with selected model
+# Advisors (and their pooled OpenAI connections) are shared per model, see get_advisor
+
+# Models a question may ask for; anything else falls back to the first
+VALID_MODELS = ('gpt-5.1', 'gpt-5-mini')
+
+ERROR_MESSAGE = 'An error occurred while processing your question. Please try again.'
+
+# If set, /metrics requires "Authorization: Bearer <METRICS_TOKEN>"
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
+# Routes whose time per stage is sent in a Server-Timing header
+TIMED_PATHS = ('/ask', '/ask/stream', '/ask/batch')
+
+# Routes that may be profiled (see src/profiling.py); a batch's work runs on other threads
+PROFILED_PATHS = ('/ask', '/ask/stream')
+
+# A client's X-Request-ID is kept if it looks like this, else one is generated
+REQUEST_ID_PATTERN = re.compile(r'[A-Za-z0-9_-]{1,64}')
+
+REQUEST_SECONDS = histogram(
+    'http_request_duration_seconds',
+    'Time to respond to non-streamed question requests (/ask, rejected /ask/stream), by route and status',
+    ('route', 'status'),
+)
+
+
+class RequestTrace:
+    """
+    What happens around each question request, on Flask (the hooks below)
+    and on ASGI (src/asgi.py) alike: a request ID, stage timings, an
+    optional profile, and the request's duration in REQUEST_SECONDS.
+    """
+
+    def __init__(self, path: str, request_id: str = '', profile_header: Optional[str] = None):
+        self.path = path
+        # The client's X-Request-ID if it looks like one, else a new one
+        self.request_id = request_id if REQUEST_ID_PATTERN.fullmatch(request_id) else uuid.uuid4().hex
+        self.timings = start_timing()
+        self.profile = start_profile(self.request_id, profile_header) if path in PROFILED_PATHS else None
+
+    def response_headers(self, streamed: bool = False) -> Dict[str, str]:
+        """Headers for the response; streamed answers report their timings in the 'done' event instead."""
+        headers = {'X-Request-ID': self.request_id}
+        if not streamed:
+            headers['Server-Timing'] = self.timings.server_timing()
+        return headers
+
+    def observe(self, status: int) -> None:
+        """Count a non-streamed response in REQUEST_SECONDS."""
+        REQUEST_SECONDS.observe(self.timings.as_ms()['total'] / 1000, route=self.path, status=str(status))
+
+    def finish(self) -> None:
+        """Stop timing and write the profile, once the response is complete."""
+        stop_timing()
+        profile, self.profile = self.profile, None
+        if profile is not None:
+            finish_profile(profile)
+
+
+@app.before_request
+def _start_trace():
+    if request.path in TIMED_PATHS:
+        g.trace = RequestTrace(request.path, request.headers.get('X-Request-ID', ''),
+                               request.headers.get('X-Profile'))
+
+
+@app.after_request
+def _add_trace_headers(response):
+    trace = g.get('trace')
+    if trace is not None:
+        response.headers.update(trace.response_headers(streamed=response.is_streamed))
+        # stream_with_context tears the request down twice: when the view
+        # returns and after the last chunk; only the second one finishes the trace
+        g.streaming = response.is_streamed
+        if not response.is_streamed:
+            trace.observe(response.status_code)
+    return response
+
+
+@app.teardown_request
+def _finish_trace(exc=None):
+    if g.pop('streaming', False):
+        return  # The stream is about to start
+    trace = g.pop('trace', None)
+    if trace is not None:
+        trace.finish()
+    else:
+        stop_timing()
 
 
 @app.route('/')
@@ -15,43 +112,252 @@ def index():
     return render_template('index.html')
 
 
+def _parse_ask_request():
+    """
+    Read the question, model and session ID from an /ask-style JSON body.
+    Returns (question, model, session_id); question is empty if missing,
+    session_id is None if missing.
+    """
+    return _parse_ask_payload(request.get_json(silent=True))
+
+
+def _parse_ask_payload(data):
+    """(question, model, session_id) from a decoded /ask JSON body (any type)."""
+    if not isinstance(data, dict):
+        data = {}
+    question = data.get('question')
+    # A missing or non-string question is rejected by the caller as empty
+    question = question.strip() if isinstance(question, str) else ''
+    session_id = data.get('session_id')
+    # Default to gpt-5.1
+    model = data.get('model', 'gpt-5.1')
+
+    # Validate model
+    if model not in VALID_MODELS:
+        model = 'gpt-5.1'  # Fallback to default
+
+    return question, model, session_id
+
+
+INVALID_SESSION_MESSAGE = 'session_id must be 1-128 letters, digits, "-" or "_"'
+
+# Most questions accepted by one /ask/batch request
+ADVISOR_BATCH_MAX_QUESTIONS = int(os.getenv('ADVISOR_BATCH_MAX_QUESTIONS', '100'))
+
+
+def _parse_batch_payload(data):
+    """
+    (questions, model, error) from a decoded /ask/batch JSON body (any type):
+    {"questions": ["...", ...], "model": "..."}. error is a message for a
+    400 response, or None.
+    """
+    if not isinstance(data, dict):
+        data = {}
+    questions = data.get('questions')
+    _, model, _ = _parse_ask_payload({'model': data.get('model', 'gpt-5.1')})
+
+    if not isinstance(questions, list) or not questions:
+        return [], model, 'Please provide a list of questions'
+    if len(questions) > ADVISOR_BATCH_MAX_QUESTIONS:
+        return [], model, f'At most {ADVISOR_BATCH_MAX_QUESTIONS} questions per batch'
+    if not all(isinstance(question, str) and question.strip() for question in questions):
+        return [], model, 'Every question must be a non-empty string'
+
+    return [question.strip() for question in questions], model, None
+
+
+def _batch_line(result: dict) -> str:
+    """One NDJSON line of an /ask/batch response; errors are logged, not returned."""
+    if 'error' in result:
+        print(f"Error in /ask/batch question {result['index']}: {result['error']}")
+        result = dict(result, error=ERROR_MESSAGE)
+    return json.dumps(result) + '\n'
+
+
+# Whether warm_up() has started loading the tokenizers in this process
+_tokenizers_warmed = False
+
+
+def _pdf_context_enabled() -> bool:
+    # PDF context disabled by default on Render due to memory constraints
+    # Set ENABLE_PDF_KNOWLEDGE=true to enable (not recommended on free tier)
+    return os.getenv('ENABLE_PDF_KNOWLEDGE', 'false').lower() == 'true'
+
+
+def warm_up():
+    """
+    Start loading the tokenizers, and the AAOIFI knowledge base if answers
+    use it, in the background.
+    """
+    global _tokenizers_warmed
+    if not _tokenizers_warmed:
+        _tokenizers_warmed = True
+        warm_token_counters(sorted(set(VALID_MODELS) | {SESSION_SUMMARY_MODEL}))
+    if _pdf_context_enabled():
+        warm_knowledge_base()
+
+
+@app.route('/metrics')
+def metrics():
+    """
+    This worker's metrics in the Prometheus text format. Metrics are kept
+    per process, so with several gunicorn workers each scrape sees one of them.
+    """
+    if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+        return jsonify({'error': 'Unauthorized'}), 401
+    return Response(render_prometheus(), content_type=PROMETHEUS_CONTENT_TYPE)
+
+
+@app.route('/ready')
+def ready():
+    """
+    Readiness probe: 503 while the AAOIFI knowledge base is loading, 200 once
+    it has loaded (or failed to, in which case answers go without context).
+    """
+    if not _pdf_context_enabled():
+        return jsonify({'ready': True, 'knowledge_base': {'state': 'disabled'}})
+
+    warm_up()  # In case no startup hook ran
+    status = get_knowledge_base_status()
+    is_ready = status['state'] in ('ready', 'unavailable', 'disabled')
+    return jsonify({'ready': is_ready, 'knowledge_base': status}), 200 if is_ready else 503
+
+
 @app.route('/ask', methods=['POST'])
 def ask():
     try:
-        data = request.get_json()
-        question = data.get('question', '').strip()
-        # Default to gpt-5.1
-        model = data.get('model', 'gpt-5.1')
+        question, model, session_id = _parse_ask_request()
 
         if not question:
             return jsonify({'error': 'Please provide a question'}), 400
 
-        # Validate model
-        valid_models = ['gpt-5.1', 'gpt-5-mini']
-        if model not in valid_models:
-            model = 'gpt-5.1'  # Fallback to default
+        if session_id is not None and not is_valid_session_id(session_id):
+            return jsonify({'error': INVALID_SESSION_MESSAGE}), 400
 
-        # Create advisor with selected model
-        advisor = TYCIslamicFinanceAdvisor(model=model)
+        # Shared advisor for the selected model
+        advisor = get_advisor(model)
 
         # Get the answer from the advisor
-        # PDF context disabled by default on Render due to memory constraints
-        # Set ENABLE_PDF_KNOWLEDGE=true to enable (not recommended on free tier)
-        use_pdf = os.getenv('ENABLE_PDF_KNOWLEDGE', 'false').lower() == 'true'
-        answer = advisor.ask(question, use_pdf_context=use_pdf)
+        answer, usage = advisor.ask_with_usage(question, use_pdf_context=_pdf_context_enabled(),
+                                               session_id=session_id)
 
-        return jsonify({
+        body = {
             'question': question,
-            'answer': answer
-        })
+            'answer': answer,
+            'usage': usage,
+        }
+        if session_id is not None:
+            body['session_id'] = session_id
+        return jsonify(body)
     except Exception as e:
         # Log error but return user-friendly message
         print(f"Error in /ask endpoint: {e}")
-        return jsonify({'error': 'An error occurred while processing your question. Please try again.'}), 500
+        return jsonify({'error': ERROR_MESSAGE}), 500
+
+
+def _sse(event: str, data: dict) -> str:
+    """Format one server-sent event."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.route('/ask/stream', methods=['POST'])
+def ask_stream():
+    """
+    Stream the answer as server-sent events:
+    'citations' (AAOIFI passages used), then one 'delta' per token chunk,
+    then 'done' with timing and prompt token usage (or 'error').
+    """
+    question, model, session_id = _parse_ask_request()
+
+    if not question:
+        return jsonify({'error': 'Please provide a question'}), 400
+
+    if session_id is not None and not is_valid_session_id(session_id):
+        return jsonify({'error': INVALID_SESSION_MESSAGE}), 400
+
+    advisor = get_advisor(model)
+    use_pdf = _pdf_context_enabled()
+
+    def generate():
+        try:
+            for event in advisor.ask_stream(question, use_pdf_context=use_pdf, session_id=session_id):
+                yield _sse(event.pop('type'), event)
+        except Exception as e:
+            print(f"Error in /ask/stream endpoint: {e}")
+            yield _sse('error', {'error': ERROR_MESSAGE})
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',  # Stop reverse proxies from buffering the stream
+        },
+    )
+
+
+@app.route('/ask/batch', methods=['POST'])
+def ask_batch():
+    """
+    Answer a list of independent questions concurrently. The response is
+    NDJSON, one line per question as it is answered (so not in order):
+    {"index", "question", "answer", "citations", "usage"} or
+    {"index", "question", "error"}.
+    """
+    questions, model, error = _parse_batch_payload(request.get_json(silent=True))
+    if error:
+        return jsonify({'error': error}), 400
+
+    advisor = get_advisor(model)
+    use_pdf = _pdf_context_enabled()
+
+    def generate():
+        results = advisor.ask_many(questions, use_pdf_context=use_pdf)
+        try:
+            for result in results:
+                yield _batch_line(result)
+        except Exception as e:
+            print(f"Error in /ask/batch endpoint: {e}")
+            yield json.dumps({'error': ERROR_MESSAGE}) + '\n'
+        finally:
+            results.close()
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='application/x-ndjson',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',
+        },
+    )
+
+
+@app.route('/sessions', methods=['POST'])
+def create_session():
+    """
+    Start a conversation: returns a new session_id to send with each /ask,
+    which then only needs the new question (the history is kept server-side).
+    """
+    if get_session_store() is None:
+        return jsonify({'error': 'Sessions are disabled'}), 404
+    return jsonify({'session_id': new_session_id()}), 201
+
+
+@app.route('/sessions/<session_id>', methods=['DELETE'])
+def delete_session(session_id):
+    """Forget a conversation."""
+    store = get_session_store()
+    if store is None:
+        return jsonify({'error': 'Sessions are disabled'}), 404
+    if not is_valid_session_id(session_id):
+        return jsonify({'error': INVALID_SESSION_MESSAGE}), 400
+    store.delete(session_id)
+    return '', 204
 
 
 if __name__ == '__main__':
     # Get port from environment variable (for cloud deployment) or default to 5000
     port = int(os.environ.get('PORT', 5000))
+    warm_up()
     # Run on all interfaces so it can be accessed from other devices
     app.run(host='0.0.0.0', port=port, debug=False)
@@ -0,0 +1,267 @@
+"""
+ASGI entry point.
+
+/ask, /ask/stream and /ask/batch are served natively on asyncio with the async advisor,
+so one process holds many concurrent model calls (each is a coroutine, not
+a worker) and shares one knowledge base. Every other route (the web page,
+static files) is handed to the Flask app.
+
+Run with:
+    uvicorn src.asgi:app --host 0.0.0.0 --port 5000
+or under gunicorn:
+    gunicorn -k uvicorn.workers.UvicornWorker src.asgi:app
+"""
+
+import asyncio
+import json
+from typing import Dict, List, Optional, Tuple
+
+from asgiref.wsgi import WsgiToAsgi
+
+from src.app import (ERROR_MESSAGE, INVALID_SESSION_MESSAGE, RequestTrace, _batch_line, _parse_ask_payload,
+                     _parse_batch_payload, _pdf_context_enabled, _sse, warm_up)
+from src.app import app as flask_app
+from src.sessions import is_valid_session_id
+from src.tyc_advisor import close_async_clients, get_async_advisor
+
+# Largest accepted request body
+MAX_BODY_BYTES = 1024 * 1024
+
+# Same as flask_cors.CORS(app) adds to every Flask response
+CORS_HEADERS = [(b'access-control-allow-origin', b'*')]
+
+wsgi_app = WsgiToAsgi(flask_app)
+
+
+async def _read_body(receive) -> bytes:
+    """Read the request body; raises ValueError if it exceeds MAX_BODY_BYTES."""
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise ConnectionError("Client disconnected")
+        body.extend(message.get('body', b''))
+        if len(body) > MAX_BODY_BYTES:
+            raise ValueError("Request body too large")
+        if not message.get('more_body', False):
+            return bytes(body)
+
+
+async def _read_ask_request(receive) -> Tuple[str, str, Optional[str]]:
+    """(question, model, session_id) from the JSON body, like app._parse_ask_request."""
+    body = await _read_body(receive)
+    try:
+        data = json.loads(body) if body else None
+    except ValueError:
+        data = None
+    return _parse_ask_payload(data)
+
+
+def _trace_headers(trace: RequestTrace, streamed: bool = False) -> List[Tuple[bytes, bytes]]:
+    return [(name.lower().encode('latin-1'), value.encode('latin-1'))
+            for name, value in trace.response_headers(streamed).items()]
+
+
+async def _send_json(send, status: int, body: Dict, trace: RequestTrace) -> None:
+    """A complete JSON response, with the trace's headers, counted in REQUEST_SECONDS."""
+    payload = json.dumps(body).encode('utf-8')
+    trace.observe(status)
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(payload)).encode('ascii')),
+        ] + CORS_HEADERS + _trace_headers(trace),
+    })
+    await send({'type': 'http.response.body', 'body': payload})
+
+
+async def ask(scope, receive, send, trace: RequestTrace) -> None:
+    """Async /ask: same request and response JSON (and Server-Timing header) as the Flask route."""
+    try:
+        question, model, session_id = await _read_ask_request(receive)
+    except ValueError:
+        await _send_json(send, 413, {'error': 'Request body too large'}, trace)
+        return
+    except ConnectionError:
+        return
+
+    if not question:
+        await _send_json(send, 400, {'error': 'Please provide a question'}, trace)
+        return
+
+    if session_id is not None and not is_valid_session_id(session_id):
+        await _send_json(send, 400, {'error': INVALID_SESSION_MESSAGE}, trace)
+        return
+
+    try:
+        advisor = get_async_advisor(model)
+        answer, usage = await advisor.ask_with_usage(question, use_pdf_context=_pdf_context_enabled(),
+                                                     session_id=session_id)
+    except Exception as e:
+        print(f"Error in /ask endpoint: {e}")
+        await _send_json(send, 500, {'error': ERROR_MESSAGE}, trace)
+        return
+
+    body = {'question': question, 'answer': answer, 'usage': usage}
+    if session_id is not None:
+        body['session_id'] = session_id
+    await _send_json(send, 200, body, trace)
+
+
+async def ask_stream(scope, receive, send, trace: RequestTrace) -> None:
+    """Async /ask/stream: the same server-sent events as the Flask route."""
+    try:
+        question, model, session_id = await _read_ask_request(receive)
+    except ValueError:
+        await _send_json(send, 413, {'error': 'Request body too large'}, trace)
+        return
+    except ConnectionError:
+        return
+
+    if not question:
+        await _send_json(send, 400, {'error': 'Please provide a question'}, trace)
+        return
+
+    if session_id is not None and not is_valid_session_id(session_id):
+        await _send_json(send, 400, {'error': INVALID_SESSION_MESSAGE}, trace)
+        return
+
+    # Stop generating (and release the OpenAI stream) as soon as the client goes away
+    disconnected = asyncio.Event()
+
+    async def watch_disconnect():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        disconnected.set()
+
+    watcher = asyncio.ensure_future(watch_disconnect())
+
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', b'text/event-stream; charset=utf-8'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),  # Stop reverse proxies from buffering the stream
+        ] + CORS_HEADERS + _trace_headers(trace, streamed=True),  # Timings go in the 'done' event
+    })
+
+    events = get_async_advisor(model).ask_stream(question, use_pdf_context=_pdf_context_enabled(),
+                                                 session_id=session_id)
+    try:
+        async for event in events:
+            if disconnected.is_set():
+                break
+            chunk = _sse(event.pop('type'), event).encode('utf-8')
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+    except Exception as e:
+        print(f"Error in /ask/stream endpoint: {e}")
+        if not disconnected.is_set():
+            chunk = _sse('error', {'error': ERROR_MESSAGE}).encode('utf-8')
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+    finally:
+        await events.aclose()
+        watcher.cancel()
+
+    if not disconnected.is_set():
+        await send({'type': 'http.response.body', 'body': b''})
+
+
+async def ask_batch(scope, receive, send, trace: RequestTrace) -> None:
+    """Async /ask/batch: the same NDJSON lines as the Flask route."""
+    try:
+        body = await _read_body(receive)
+    except ValueError:
+        await _send_json(send, 413, {'error': 'Request body too large'}, trace)
+        return
+    except ConnectionError:
+        return
+    try:
+        data = json.loads(body) if body else None
+    except ValueError:
+        data = None
+
+    questions, model, error = _parse_batch_payload(data)
+    if error:
+        await _send_json(send, 400, {'error': error}, trace)
+        return
+
+    # Stop the batch (and its model calls) as soon as the client goes away
+    disconnected = asyncio.Event()
+
+    async def watch_disconnect():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        disconnected.set()
+
+    watcher = asyncio.ensure_future(watch_disconnect())
+
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', b'application/x-ndjson'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),
+        ] + CORS_HEADERS + _trace_headers(trace, streamed=True),
+    })
+
+    results = get_async_advisor(model).ask_many(questions, use_pdf_context=_pdf_context_enabled())
+    try:
+        async for result in results:
+            if disconnected.is_set():
+                break
+            await send({'type': 'http.response.body', 'body': _batch_line(result).encode('utf-8'),
+                        'more_body': True})
+    except Exception as e:
+        print(f"Error in /ask/batch endpoint: {e}")
+        if not disconnected.is_set():
+            chunk = (json.dumps({'error': ERROR_MESSAGE}) + '\n').encode('utf-8')
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+    finally:
+        await results.aclose()
+        watcher.cancel()
+
+    if not disconnected.is_set():
+        await send({'type': 'http.response.body', 'body': b''})
+
+
+ROUTES = {
+    '/ask': ask,
+    '/ask/stream': ask_stream,
+    '/ask/batch': ask_batch,
+}
+
+
+async def _lifespan(receive, send) -> None:
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            warm_up()  # Loads on a background thread; startup doesn't wait for it
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await close_async_clients()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send) -> None:
+    """The ASGI application."""
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+
+    handler = ROUTES.get(scope.get('path'))
+    if scope['type'] == 'http' and handler is not None and scope['method'] == 'POST':
+        headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+        # This request's task has its own context, so timings don't mix with other requests'
+        trace = RequestTrace(scope['path'], headers.get('x-request-id', ''), headers.get('x-profile'))
+        try:
+            await handler(scope, receive, send, trace)
+        finally:
+            trace.finish()
+        return
+
+    await wsgi_app(scope, receive, send)
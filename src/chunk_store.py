@@ -0,0 +1,151 @@
+"""
+Zero-copy chunk storage for the knowledge base.
+
+Chunks are (start, end) byte ranges into the UTF-8 text file. The text file is
+memory-mapped read-only, so every gunicorn worker shares the same page-cache
+copy, and a chunk is only decoded to a Python str when it is actually
+returned from a search.
+
+Page numbers are resolved the same way: PageIndex records the byte offset of
+every page marker once, and a chunk's pages are found by bisecting its span.
+"""
+
+import mmap
+import re
+from array import array
+from bisect import bisect_right
+from typing import Iterator, List, Optional, Sequence, Tuple, Union
+
+
+def byte_offsets(text: str, char_offsets: Sequence[Tuple[int, int]]) -> array:
+    """
+    Convert (start, end) character offsets into a flat array of UTF-8 byte
+    offsets ``[start0, end0, start1, end1, ...]``.
+
+    :param text: The text the character offsets refer to
+    :param char_offsets: (start, end) character offsets
+    :return: array('I') of byte offsets
+    """
+    boundaries = sorted({pos for span in char_offsets for pos in span})
+    positions = {}
+    char_pos = byte_pos = 0
+    for boundary in boundaries:
+        byte_pos += len(text[char_pos:boundary].encode('utf-8'))
+        char_pos = boundary
+        positions[boundary] = byte_pos
+
+    flat = array('I')
+    for start, end in char_offsets:
+        flat.append(positions[start])
+        flat.append(positions[end])
+    return flat
+
+
+class ChunkStore:
+    """
+    Read-only sequence of chunk strings backed by a byte buffer.
+
+    Behaves like the old ``List[str]`` of chunks (``len``, indexing,
+    iteration), but slices and decodes the buffer on access instead of
+    holding every chunk in memory.
+    """
+
+    def __init__(self, buffer: Union[mmap.mmap, bytes], offsets: Sequence[int]):
+        """
+        :param buffer: UTF-8 text (an mmap for file-backed stores)
+        :param offsets: Flat [start0, end0, start1, end1, ...] byte offsets
+        """
+        self._buffer = buffer
+        self._view = memoryview(buffer)
+        self._offsets = offsets
+
+    @classmethod
+    def from_text(cls, text: str, offsets: Sequence[int]) -> "ChunkStore":
+        """Create an in-memory store (used when content came from the PDF)."""
+        return cls(text.encode('utf-8'), offsets)
+
+    def __len__(self) -> int:
+        return len(self._offsets) // 2
+
+    def span(self, chunk_id: int) -> Tuple[int, int]:
+        """(start, end) byte offsets of a chunk."""
+        if chunk_id < 0:
+            chunk_id += len(self)
+        if not 0 <= chunk_id < len(self):
+            raise IndexError("chunk index out of range")
+        return self._offsets[2 * chunk_id], self._offsets[2 * chunk_id + 1]
+
+    def raw(self, chunk_id: int) -> memoryview:
+        """Zero-copy view of a chunk's UTF-8 bytes."""
+        start, end = self.span(chunk_id)
+        return self._view[start:end]
+
+    def __getitem__(self, chunk_id: int) -> str:
+        return str(self.raw(chunk_id), 'utf-8')
+
+    def __iter__(self) -> Iterator[str]:
+        for chunk_id in range(len(self)):
+            yield self[chunk_id]
+
+
+PAGE_MARKER = re.compile(rb'--- Page (\d+) ---')
+
+
+class PageIndex:
+    """
+    Sorted byte offsets of the ``--- Page N ---`` markers in the text.
+
+    Built in a single pass at load time; resolving the page of any byte
+    offset is then a bisect instead of a regex over the chunk.
+    """
+
+    def __init__(self, offsets: Sequence[int] = (), numbers: Sequence[int] = ()):
+        self.offsets = array('I', offsets)
+        self.numbers = array('I', numbers)
+
+    @classmethod
+    def build(cls, buffer: Union[bytes, memoryview, mmap.mmap]) -> "PageIndex":
+        """Scan UTF-8 text for page markers."""
+        index = cls()
+        for match in PAGE_MARKER.finditer(buffer):
+            index.offsets.append(match.start())
+            index.numbers.append(int(match.group(1)))
+        return index
+
+    def page_at(self, offset: int) -> Optional[int]:
+        """Page number containing a byte offset (None before the first marker)."""
+        position = bisect_right(self.offsets, offset) - 1
+        return self.numbers[position] if position >= 0 else None
+
+    def page_range(self, start: int, end: int) -> Tuple[Optional[int], Optional[int]]:
+        """First and last page touched by the byte range [start, end)."""
+        first = self.page_at(start)
+        last = self.page_at(max(start, end - 1))
+        return first, last if last is not None else first
+
+
+def page_segments(buffer: Union[bytes, memoryview, mmap.mmap]) -> List[Tuple[int, int]]:
+    """
+    Byte spans of the page bodies: the text after each ``--- Page N ---``
+    line up to the next marker, without trailing whitespace. Text before the
+    first marker is a segment of its own (the whole text if there are no
+    markers). Empty pages are skipped.
+
+    The marker line is left out so a page's body, and its content hash, stay
+    the same when pages before it are inserted or removed.
+    """
+    starts, ends = [0], []
+    for match in PAGE_MARKER.finditer(buffer):
+        ends.append(match.start())
+        body = match.end()
+        if buffer[body:body + 1] == b'\n':
+            body += 1
+        starts.append(body)
+    ends.append(len(buffer))
+
+    segments = []
+    for start, end in zip(starts, ends):
+        end = start + len(bytes(buffer[start:end]).rstrip())
+        if end > start:
+            segments.append((start, end))
+    return segments
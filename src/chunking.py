@@ -0,0 +1,177 @@
+"""
+Chunking strategies for the AAOIFI Standards text.
+
+Two modes are supported:
+
+  - fixed:      overlapping fixed-size character windows (the original chunker)
+  - structured: variable-length, non-overlapping chunks cut at the standard /
+                section / clause numbering of the AAOIFI text
+
+Both return (start, end) character offsets. parse_structure() also gives every
+chunk its standard number and clause so search results can cite them.
+"""
+
+import re
+from bisect import bisect_right
+from typing import List, NamedTuple, Optional, Tuple
+
+CHUNKING_MODES = ('fixed', 'structured')
+
+# "Shari’ah Standard No. (12)" on the first non-empty line of a page (after its
+# "--- Page N ---" marker, or at the start of a page's text), optionally preceded
+# by the printed page number the PDF extraction glues onto running headers.
+# Cross-references such as "Shari’ah Standard No. (5) on Guarantees." can also
+# start a line, but never the first one of a page.
+STANDARD_HEADING = re.compile(r"(?:\A|^--- Page \d+ ---\n)\s*^(\d*Shari\S{0,2}ah Standard No\. ?\((\d+)\))",
+                              re.MULTILINE)
+
+# Clause numbering: "2. Shari’ah Ruling", "2/1 It is permissible", "2/6/1 When ..."
+CLAUSE_START = re.compile(r"^[ \t]*(\d{1,2}(?:/\d{1,2})*)(?:\.[ \t]|[ \t])[ \t]*\S", re.MULTILINE)
+
+
+class Boundary(NamedTuple):
+    """A structural position in the text."""
+    offset: int                # character offset of the start of the line
+    standard: Optional[int]    # standard number in force at this position
+    section: Optional[str]     # clause number, e.g. "2/6/1" (None for headings)
+    new_standard: bool         # True where a different standard begins
+
+
+def parse_structure(text: str) -> List[Boundary]:
+    """
+    Find standard headings and clause starts, in document order.
+
+    Running page headers repeat the current standard's heading on every page;
+    only a change of standard number is flagged as ``new_standard``.
+
+    :param text: Full knowledge base text
+    :return: Sorted list of boundaries
+    """
+    events = []
+    for match in STANDARD_HEADING.finditer(text):
+        events.append((match.start(1), int(match.group(2)), None))
+    for match in CLAUSE_START.finditer(text):
+        line_start = text.rfind('\n', 0, match.start()) + 1
+        events.append((line_start, None, match.group(1)))
+    events.sort(key=lambda event: event[0])
+
+    boundaries = []
+    standard = None
+    for offset, heading, section in events:
+        new_standard = heading is not None and heading != standard
+        if heading is not None:
+            standard = heading
+            if not new_standard:
+                continue
+        boundaries.append(Boundary(offset, standard, section, new_standard))
+    return boundaries
+
+
+def fixed_chunks(text: str, chunk_size: int = 1000, overlap: int = 200) -> List[Tuple[int, int]]:
+    """
+    Overlapping fixed-size windows.
+
+    :param text: The text to chunk
+    :param chunk_size: Size of each chunk in characters
+    :param overlap: Overlap between chunks in characters
+    :return: List of (start, end) offsets into text
+    """
+    offsets = []
+    start = 0
+
+    while start < len(text):
+        end = min(start + chunk_size, len(text))
+        offsets.append((start, end))
+        start = start + chunk_size - overlap  # Overlap for context
+
+    return offsets
+
+
+def _split_long(text: str, start: int, end: int, max_size: int) -> List[Tuple[int, int]]:
+    """Split [start, end) into pieces of at most max_size, cutting at whitespace."""
+    pieces = []
+    while end - start > max_size:
+        cut = max(text.rfind('\n', start, start + max_size),
+                  text.rfind(' ', start, start + max_size))
+        if cut <= start:
+            cut = start + max_size  # No whitespace at all: hard cut
+        else:
+            cut += 1
+        pieces.append((start, cut))
+        start = cut
+    pieces.append((start, end))
+    return pieces
+
+
+def structured_chunks(text: str, max_size: int = 1500, min_size: int = 400,
+                      boundaries: Optional[List[Boundary]] = None) -> List[Tuple[int, int]]:
+    """
+    Non-overlapping chunks aligned to standard/section/clause boundaries.
+
+    Consecutive clauses are packed together up to ``max_size`` characters.
+    A new chunk always starts at a new standard, and at a top-level section
+    (e.g. "3. Date of Issuance") once the current chunk has ``min_size``
+    characters. Clauses longer than ``max_size`` are split at whitespace.
+
+    :param text: The text to chunk
+    :param max_size: Maximum chunk size in characters
+    :param min_size: Minimum size before a top-level section forces a cut
+    :param boundaries: Precomputed parse_structure(text) output
+    :return: List of (start, end) offsets into text
+    """
+    if boundaries is None:
+        boundaries = parse_structure(text)
+
+    # Units are the spans between consecutive structural boundaries
+    starts = sorted({0} | {b.offset for b in boundaries})
+    kinds = {b.offset: b for b in boundaries}
+    units = [(s, e) for s, e in zip(starts, starts[1:] + [len(text)]) if e > s]
+
+    chunks = []
+    chunk_start = chunk_end = None
+    for unit_start, unit_end in units:
+        boundary = kinds.get(unit_start)
+        hard_cut = boundary is not None and (
+            boundary.new_standard
+            or (boundary.section is not None and '/' not in boundary.section
+                and chunk_end is not None and chunk_end - chunk_start >= min_size)
+        )
+
+        if chunk_start is not None and (hard_cut or unit_end - chunk_start > max_size):
+            chunks.extend(_split_long(text, chunk_start, chunk_end, max_size))
+            chunk_start = None
+
+        if chunk_start is None:
+            chunk_start = unit_start
+        chunk_end = unit_end
+
+    if chunk_start is not None:
+        chunks.extend(_split_long(text, chunk_start, chunk_end, max_size))
+
+    # Skip whitespace-only pieces
+    return [(s, e) for s, e in chunks if text[s:e].strip()]
+
+
+def chunk_metadata(boundaries: List[Boundary],
+                   offsets: List[Tuple[int, int]]) -> Tuple[List[int], List[str]]:
+    """
+    Standard number and clause in force at the start of each chunk.
+
+    :param boundaries: parse_structure() output
+    :param offsets: (start, end) character offsets of the chunks
+    :return: (standards, sections); 0 / "" where unknown
+    """
+    positions = [b.offset for b in boundaries]
+    standards, sections = [], []
+    for start, _ in offsets:
+        i = bisect_right(positions, start) - 1
+        standard = boundaries[i].standard if i >= 0 else None
+        section = None
+        # Walk back to the nearest clause within the same standard
+        while i >= 0 and boundaries[i].section is None and not boundaries[i].new_standard:
+            i -= 1
+        if i >= 0 and boundaries[i].section is not None:
+            section = boundaries[i].section
+        standards.append(standard or 0)
+        sections.append(section or "")
+    return standards, sections
@@ -0,0 +1,205 @@
+"""
+Dense (embedding) index over knowledge base chunks.
+
+Chunk embeddings are stored as one contiguous float32 matrix in a .npy file
+and memory-mapped at load time. A query is scored with a single
+matrix-vector product, and the top-k rows are selected with argpartition.
+
+Files, next to the knowledge base artifact (e.g. for the hashing embedder):
+    AAOIFI-Standards.hashing.npy   (n_chunks, dim) float32 embedding matrix
+    AAOIFI-Standards.hashing.npz   fitted embedder state + metadata
+"""
+
+import json
+import os
+import tempfile
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from src.embeddings import Embedder
+
+DENSE_VERSION = 3
+
+
+def dense_paths(artifact_path: Union[str, Path], embedder: Embedder) -> Tuple[Path, Path]:
+    """(matrix path, metadata path) for an artifact and embedder."""
+    base = Path(artifact_path).with_suffix('')
+    return (base.with_name(f"{base.name}.{embedder.name}.npy"),
+            base.with_name(f"{base.name}.{embedder.name}.npz"))
+
+
+def _atomic_write(path: Path, write) -> None:
+    fd, tmp_path = tempfile.mkstemp(dir=str(path.parent), prefix=path.name, suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.chmod(tmp_path, 0o644)  # mkstemp creates 0600; workers may run as another user
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+class DenseIndex:
+    """A matrix of unit-length chunk embeddings plus the embedder that made it."""
+
+    def __init__(self, embedder: Embedder, matrix: np.ndarray):
+        self.embedder = embedder
+        self.matrix = matrix
+
+    def __len__(self) -> int:
+        return self.matrix.shape[0]
+
+    @classmethod
+    def build(cls, embedder: Embedder, texts: Iterable[str], batch_size: int = 512) -> "DenseIndex":
+        """
+        Fit the embedder on the chunks and embed them.
+
+        :param embedder: Embedding backend
+        :param texts: Chunk texts in chunk id order
+        :param batch_size: Texts embedded per call
+        :return: A DenseIndex holding the embedding matrix in memory
+        """
+        texts = list(texts)
+        embedder.fit(texts)
+        batches = [embedder.embed(texts[i:i + batch_size])
+                   for i in range(0, len(texts), batch_size)]
+        matrix = np.vstack(batches) if batches else np.zeros((0, embedder.dim), dtype=np.float32)
+        return cls(embedder, np.ascontiguousarray(matrix, dtype=np.float32))
+
+    @classmethod
+    def update(cls, previous: "DenseIndex", reused: Sequence[int], texts: Iterable[str],
+               batch_size: int = 512) -> "DenseIndex":
+        """
+        Carry embeddings over from a previous index and embed only new chunks.
+
+        The previous embedder is used as fitted (it is not refitted on the new
+        chunks), so carried-over and new rows stay comparable. A full rebuild
+        refits it.
+
+        :param previous: Index the reused rows come from
+        :param reused: For every chunk id, the previous row it is a copy of,
+                       or -1 for a new chunk
+        :param texts: Texts of the new (-1) chunks, in chunk id order
+        :param batch_size: Texts embedded per call
+        :return: A DenseIndex holding the embedding matrix in memory
+        """
+        reused = np.asarray(reused, dtype=np.int64)
+        matrix = np.zeros((len(reused), previous.matrix.shape[1]), dtype=np.float32)
+        kept = reused >= 0
+        matrix[kept] = previous.matrix[reused[kept]]
+
+        new_rows = np.flatnonzero(~kept)
+        texts = list(texts)
+        for i in range(0, len(texts), batch_size):
+            matrix[new_rows[i:i + batch_size]] = previous.embedder.embed(texts[i:i + batch_size])
+        return cls(previous.embedder, matrix)
+
+    def save(self, matrix_path: Path, meta_path: Path, source_hash: str,
+             chunk_params: Dict[str, object]) -> None:
+        """Write the matrix and metadata atomically."""
+        meta = json.dumps({
+            'version': DENSE_VERSION,
+            'source_hash': source_hash,
+            'chunk_params': chunk_params,
+            'embedder': self.embedder.params(),
+            'rows': len(self),
+            'dim': self.matrix.shape[1],
+        }, sort_keys=True)
+        _atomic_write(matrix_path, lambda f: np.save(f, self.matrix))
+        _atomic_write(meta_path, lambda f: np.savez(f, meta=np.array(meta), **self.embedder.state()))
+
+    @classmethod
+    def load(cls, matrix_path: Path, meta_path: Path, embedder: Embedder, source_hash: str,
+             chunk_params: Dict[str, object]) -> Optional["DenseIndex"]:
+        """
+        Memory-map a stored index if it matches the current chunks and embedder.
+
+        :return: The index, or None if missing or stale
+        """
+        if not (matrix_path.exists() and meta_path.exists()):
+            return None
+        try:
+            with np.load(meta_path) as stored:
+                meta = json.loads(str(stored['meta']))
+                state = {key: stored[key] for key in stored.files if key != 'meta'}
+            expected = {
+                'version': DENSE_VERSION,
+                'source_hash': source_hash,
+                'chunk_params': chunk_params,
+                'embedder': embedder.params(),
+            }
+            if any(meta.get(key) != value for key, value in expected.items()):
+                print(f"Dense index {matrix_path} is stale")
+                return None
+            matrix = np.load(matrix_path, mmap_mode='r')
+        except Exception as e:
+            print(f"Could not read dense index {matrix_path}: {e}")
+            return None
+
+        if matrix.shape != (meta.get('rows'), meta.get('dim')):
+            return None
+        if embedder.dim and embedder.dim != matrix.shape[1]:
+            print(f"Dense index {matrix_path} has {matrix.shape[1]}-dimensional rows, "
+                  f"the embedder makes {embedder.dim}")
+            return None
+        embedder.dim = matrix.shape[1]  # Queries must match, e.g. an unknown OpenAI model's width
+        embedder.load_state(state)
+        return cls(embedder, matrix)
+
+    def search(self, query: str, top_k: int = 3,
+               ranges: Optional[Sequence[Tuple[int, int]]] = None,
+               min_score: Optional[float] = None) -> List[Tuple[int, float]]:
+        """
+        Cosine similarity search.
+
+        :param query: Free-text query
+        :param top_k: Number of results to return
+        :param ranges: Only score rows in these [start, end) chunk id ranges
+        :param min_score: Drop rows scoring below this (default: the
+                          embedder's min_score), so an unrelated query can
+                          return nothing, as it does from BM25
+        :return: List of (chunk_id, score) pairs, best first
+        """
+        return self.search_many([query], top_k, ranges, min_score)[0]
+
+    def search_many(self, queries: Sequence[str], top_k: int = 3,
+                    ranges: Optional[Sequence[Tuple[int, int]]] = None,
+                    min_score: Optional[float] = None) -> List[List[Tuple[int, float]]]:
+        """
+        search() for several queries at once: one embedding call for all of
+        them and one matrix product, instead of one of each per query.
+
+        :return: One result list per query, in order
+        """
+        if min_score is None:
+            min_score = self.embedder.min_score
+        if top_k <= 0 or len(self) == 0 or not queries:
+            return [[] for _ in queries]
+        query_matrix = self.embedder.embed(list(queries))
+
+        if ranges is None:
+            ids = None
+            scores = self.matrix @ query_matrix.T
+        else:
+            ranges = [(start, end) for start, end in ranges if end > start]
+            if not ranges:
+                return [[] for _ in queries]
+            ids = np.concatenate([np.arange(start, end) for start, end in ranges])
+            scores = np.concatenate([self.matrix[start:end] @ query_matrix.T for start, end in ranges])
+
+        k = min(top_k, scores.shape[0])
+        results = []
+        for column in range(len(queries)):
+            if not query_matrix[column].any():
+                results.append([])
+                continue
+            column_scores = scores[:, column]
+            top = np.argpartition(-column_scores, k - 1)[:k]
+            top = top[np.argsort(-column_scores[top])]
+            results.append([(int(i if ids is None else ids[i]), float(column_scores[i]))
+                            for i in top if column_scores[i] > 0 and column_scores[i] >= min_score])
+        return results
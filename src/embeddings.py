@@ -0,0 +1,255 @@
+"""
+Embedding backends for dense (semantic) retrieval.
+
+All embedders turn a list of texts into an L2-normalised float32 matrix, so
+cosine similarity is a plain dot product:
+
+  - hashing:   hashed TF-IDF of words and word bigrams (offline, fast to fit)
+  - tfidf-svd: hashed TF-IDF projected onto its top singular vectors (offline LSA)
+  - openai:    OpenAI embeddings API (requires OPENAI_API_KEY)
+
+Select one with get_embedder(name).
+"""
+
+import math
+import os
+import zlib
+from collections import Counter
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+from src.search_index import tokenize
+
+EMBEDDERS = ('hashing', 'tfidf-svd', 'openai')
+
+# Native output width of OpenAI embedding models; other models (or a
+# `dimensions` setting) are sized by their first response
+OPENAI_EMBEDDING_DIMS = {
+    'text-embedding-3-small': 1536,
+    'text-embedding-3-large': 3072,
+    'text-embedding-ada-002': 1536,
+}
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    """L2-normalise rows in place (zero rows stay zero)."""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    matrix /= norms
+    return matrix
+
+
+class Embedder:
+    """Base class for embedding backends."""
+
+    name = "base"
+    dim = 0
+    # Cosine similarity below which a chunk is not a match (see DenseIndex.search_many)
+    min_score = 0.0
+    # True if texts only score through shared words, as with hashed features:
+    # a query with no word of the corpus then matches nothing
+    lexical = False
+
+    def fit(self, texts: Iterable[str]) -> None:
+        """Learn corpus statistics (no-op for pretrained backends)."""
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """Embed texts into an (len(texts), dim) float32 matrix of unit rows."""
+        raise NotImplementedError
+
+    def state(self) -> Dict[str, np.ndarray]:
+        """Arrays needed to recreate a fitted embedder (see load_state)."""
+        return {}
+
+    def load_state(self, state: Dict[str, np.ndarray]) -> None:
+        """Restore fitted state saved with state()."""
+
+    def params(self) -> Dict[str, object]:
+        """Settings that must match for a stored embedding matrix to be reused."""
+        return {'name': self.name, 'dim': self.dim}
+
+
+class HashingEmbedder(Embedder):
+    """
+    Hashed TF-IDF of word unigrams and bigrams.
+
+    Tokens are hashed (with a stable CRC32, not Python's salted hash()) into
+    ``dim`` signed buckets; IDF weights per bucket are learned by fit().
+    """
+
+    name = "hashing"
+    min_score = 0.1
+    lexical = True
+
+    def __init__(self, dim: int = 1024, signed: bool = True):
+        self.dim = dim
+        self.signed = signed
+        self.idf = np.ones(dim, dtype=np.float32)
+
+    def _features(self, text: str) -> Counter:
+        tokens = tokenize(text)
+        features = Counter(tokens)
+        features.update(f"{a} {b}" for a, b in zip(tokens, tokens[1:]))
+        return features
+
+    def _bucket(self, feature: str):
+        h = zlib.crc32(feature.encode('utf-8'))
+        sign = -1.0 if self.signed and (h >> 31) else 1.0
+        return h % self.dim, sign
+
+    def _term_frequencies(self, texts: Iterable[str]) -> np.ndarray:
+        rows = []
+        for text in texts:
+            row = np.zeros(self.dim, dtype=np.float32)
+            for feature, tf in self._features(text).items():
+                bucket, sign = self._bucket(feature)
+                row[bucket] += sign * (1.0 + math.log(tf))
+            rows.append(row)
+        if not rows:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return np.vstack(rows)
+
+    def fit(self, texts: Iterable[str]) -> None:
+        tf = self._term_frequencies(texts)
+        df = np.count_nonzero(tf, axis=0).astype(np.float32)
+        self.idf = (np.log((1.0 + len(tf)) / (1.0 + df)) + 1.0).astype(np.float32)
+
+    def _weighted(self, texts: Iterable[str]) -> np.ndarray:
+        return self._term_frequencies(texts) * self.idf
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        return _normalize(self._weighted(texts))
+
+    def state(self) -> Dict[str, np.ndarray]:
+        return {'idf': self.idf}
+
+    def load_state(self, state: Dict[str, np.ndarray]) -> None:
+        self.idf = np.asarray(state['idf'], dtype=np.float32)
+
+    def params(self) -> Dict[str, object]:
+        return {'name': self.name, 'dim': self.dim, 'signed': self.signed}
+
+
+class TfidfSvdEmbedder(Embedder):
+    """
+    Latent semantic analysis: hashed TF-IDF reduced with a truncated SVD.
+
+    The SVD is computed with a randomised range finder, which keeps fitting
+    to a few seconds on the full corpus without scikit-learn.
+    """
+
+    name = "tfidf-svd"
+    min_score = 0.1
+    lexical = True
+
+    def __init__(self, dim: int = 256, n_features: int = 4096, seed: int = 0):
+        self.dim = dim
+        self.n_features = n_features
+        self.seed = seed
+        self.vectorizer = HashingEmbedder(dim=n_features, signed=False)
+        self.components = np.zeros((dim, n_features), dtype=np.float32)
+
+    def fit(self, texts: Iterable[str]) -> None:
+        texts = list(texts)
+        self.vectorizer.fit(texts)
+        matrix = self.vectorizer.embed(texts)
+
+        rng = np.random.default_rng(self.seed)
+        k = min(self.dim, *matrix.shape)
+        sketch = matrix @ rng.standard_normal((self.n_features, k + 10)).astype(np.float32)
+        for _ in range(2):  # Power iterations sharpen the spectrum
+            sketch = matrix @ (matrix.T @ sketch)
+        basis, _ = np.linalg.qr(sketch)
+        _, _, vt = np.linalg.svd(basis.T @ matrix, full_matrices=False)
+        self.components = np.zeros((self.dim, self.n_features), dtype=np.float32)
+        self.components[:k] = vt[:k]
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        return _normalize(self.vectorizer.embed(texts) @ self.components.T)
+
+    def state(self) -> Dict[str, np.ndarray]:
+        return {'idf': self.vectorizer.idf, 'components': self.components}
+
+    def load_state(self, state: Dict[str, np.ndarray]) -> None:
+        self.vectorizer.load_state(state)
+        self.components = np.asarray(state['components'], dtype=np.float32)
+
+    def params(self) -> Dict[str, object]:
+        return {'name': self.name, 'dim': self.dim,
+                'n_features': self.n_features, 'seed': self.seed}
+
+
+class OpenAIEmbedder(Embedder):
+    """
+    Embeddings from the OpenAI API (pretrained, nothing to fit).
+
+    The width is the model's (OPENAI_EMBEDDING_DIMS), or ``dimensions`` if
+    set (text-embedding-3 models can shorten their output); for an unknown
+    model it is taken from the first response.
+    """
+
+    name = "openai"
+    min_score = 0.2
+
+    def __init__(self, model: str = "text-embedding-3-small", dimensions: Optional[int] = None,
+                 client=None, batch_size: int = 256):
+        self.model = model
+        self.dimensions = dimensions
+        self.dim = dimensions or OPENAI_EMBEDDING_DIMS.get(model, 0)
+        self.batch_size = batch_size
+        self._client = client
+
+    @property
+    def client(self):
+        if self._client is None:
+            from openai import OpenAI
+            self._client = OpenAI()
+        return self._client
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        options = {'dimensions': self.dimensions} if self.dimensions else {}
+        vectors = []
+        for i in range(0, len(texts), self.batch_size):
+            batch = texts[i:i + self.batch_size]
+            response = self.client.embeddings.create(model=self.model, input=batch, **options)
+            vectors.extend(item.embedding for item in response.data)
+        if not vectors:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        matrix = np.asarray(vectors, dtype=np.float32)
+        if not self.dim:
+            self.dim = matrix.shape[1]
+        elif matrix.shape[1] != self.dim:
+            raise ValueError(f"{self.model} returned {matrix.shape[1]}-dimensional embeddings, "
+                             f"expected {self.dim}")
+        return _normalize(matrix)
+
+    def params(self) -> Dict[str, object]:
+        # The width is stored with the matrix (see DenseIndex.save), as it may
+        # not be known before the first call
+        return {'name': self.name, 'model': self.model, 'dimensions': self.dimensions}
+
+
+def get_embedder(name: Optional[str] = None) -> Embedder:
+    """
+    Create an embedder by name (default: PDF_EMBEDDER env var, else 'hashing').
+
+    :param name: One of EMBEDDERS
+    :return: An unfitted embedder
+    """
+    if name is None:
+        name = os.getenv('PDF_EMBEDDER', 'hashing').lower()
+    if name == 'hashing':
+        embedder = HashingEmbedder()
+    elif name == 'tfidf-svd':
+        embedder = TfidfSvdEmbedder()
+    elif name == 'openai':
+        embedder = OpenAIEmbedder(model=os.getenv('OPENAI_EMBEDDING_MODEL', 'text-embedding-3-small'),
+                                  dimensions=int(os.getenv('OPENAI_EMBEDDING_DIMENSIONS', '0')) or None)
+    else:
+        raise ValueError(f"Unknown embedder {name!r}, expected one of {EMBEDDERS}")
+    # Overrides the embedder's own cutoff (Embedder.min_score)
+    min_score = os.getenv('PDF_DENSE_MIN_SCORE')
+    if min_score:
+        embedder.min_score = float(min_score)
+    return embedder
@@ -0,0 +1,137 @@
+"""
+Precompiled knowledge base artifact.
+
+Chunking and indexing the AAOIFI Standards text is done once (at build time,
+or by the first worker that finds the artifact missing or stale) and written
+to a versioned binary file next to the text file. Workers then load the
+artifact instead of re-chunking on every start.
+
+File layout (little-endian):
+    8 bytes   magic (b"TYCKBIDX")
+    4 bytes   format version (uint32)
+    4 bytes   reserved
+    32 bytes  SHA-256 of the UTF-8 source text
+    8 bytes   number of chunks N (uint64)
+    8*N bytes chunk byte offsets as uint32 pairs [start0, end0, start1, ...]
+    rest      pickled payload (page marker offsets, page content hashes,
+              index, build params)
+
+The offsets table is memory-mapped rather than unpickled, so it is shared
+between workers through the page cache like the text file itself.
+
+When the text changes, the stale artifact is still useful: its per-page
+content hashes tell which pages are unchanged, and their chunks and postings
+are carried over instead of being rebuilt (see PDFKnowledgeBase.build_index).
+"""
+
+import hashlib
+import mmap
+import os
+import pickle
+import struct
+import sys
+import tempfile
+from array import array
+from pathlib import Path
+from typing import Any, Dict, Optional, Union
+
+ARTIFACT_MAGIC = b"TYCKBIDX"
+ARTIFACT_VERSION = 6
+ARTIFACT_SUFFIX = ".kbidx"
+
+_HEADER = struct.Struct("<8sII32sQ")
+
+
+def content_hash(text: Union[str, bytes, memoryview, mmap.mmap]) -> str:
+    """SHA-256 hex digest of the source text (str is hashed as UTF-8)."""
+    if isinstance(text, str):
+        text = text.encode('utf-8')
+    return hashlib.sha256(text).hexdigest()
+
+
+def artifact_path_for(text_path: Union[str, Path]) -> Path:
+    """Default artifact location for a text file, e.g. AAOIFI-Standards.kbidx."""
+    return Path(text_path).with_suffix(ARTIFACT_SUFFIX)
+
+
+def save_artifact(path: Union[str, Path], source_hash: str, payload: Dict[str, Any]) -> None:
+    """
+    Write an artifact atomically (temp file + rename) so concurrent workers
+    never observe a half-written file.
+
+    :param path: Destination path
+    :param source_hash: content_hash() of the text the payload was built from
+    :param payload: Dict of index data; 'chunk_offsets' (flat uint32 byte
+                    offsets) is written as a raw table, the rest is pickled
+    """
+    path = Path(path)
+    payload = dict(payload)
+    payload.pop('source_hash', None)  # Stored in the header
+    offsets = array('I', payload.pop('chunk_offsets'))
+    if array('I').itemsize != 4:
+        raise RuntimeError("unsupported platform: array('I') is not 32-bit")
+    if sys.byteorder != 'little':
+        offsets.byteswap()
+
+    header = _HEADER.pack(ARTIFACT_MAGIC, ARTIFACT_VERSION, 0,
+                          bytes.fromhex(source_hash), len(offsets) // 2)
+    body = pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL)
+
+    fd, tmp_path = tempfile.mkstemp(dir=str(path.parent), prefix=path.name, suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(header)
+            f.write(offsets.tobytes())
+            f.write(body)
+        os.chmod(tmp_path, 0o644)  # mkstemp creates 0600; workers may run as another user
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def read_artifact(path: Union[str, Path],
+                  params: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+    """
+    Load an artifact whatever text it was built from.
+
+    :param path: Artifact path
+    :param params: Build parameters that must match the stored ones
+    :return: The payload dict with 'source_hash' (the text it was built from)
+             and 'chunk_offsets' as a zero-copy view into the memory-mapped
+             file, or None if missing, of an old format, built with other
+             params or unreadable
+    """
+    path = Path(path)
+    if not path.exists():
+        return None
+
+    try:
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(mapped) < _HEADER.size:
+            return None
+        magic, version, _, digest, num_chunks = _HEADER.unpack_from(mapped)
+        if magic != ARTIFACT_MAGIC or version != ARTIFACT_VERSION:
+            print(f"Knowledge base artifact {path} has an old format, rebuilding...")
+            return None
+
+        offsets_end = _HEADER.size + 8 * num_chunks
+        offsets = memoryview(mapped)[_HEADER.size:offsets_end].cast('I')
+        if sys.byteorder != 'little':
+            offsets = array('I', offsets)
+            offsets.byteswap()
+        payload = pickle.loads(mapped[offsets_end:])
+    except Exception as e:
+        print(f"Could not read knowledge base artifact {path}: {e}")
+        return None
+
+    if params is not None and payload.get('params') != params:
+        print(f"Knowledge base artifact {path} was built with different settings, rebuilding...")
+        return None
+
+    payload['source_hash'] = digest.hex()
+    payload['chunk_offsets'] = offsets
+    return payload
+
@@ -0,0 +1,302 @@
+"""
+Registry of knowledge base collections.
+
+Besides the AAOIFI Standards, the advisor can search other documents, such
+as Shari'ah board resolutions, IFSB standards or internal product memos.
+Each one is a collection with its own text file (or PDF) and its own
+on-disk index, loaded as a PDFKnowledgeBase. Collections are listed in a
+JSON file (KB_COLLECTIONS, default data/collections.json):
+
+    [
+        {"name": "aaoifi", "title": "AAOIFI Standards",
+         "text_path": "data/AAOIFI-Standards.txt", "pdf_path": "data/AAOIFI-Standards.pdf"},
+        {"name": "ifsb", "title": "IFSB Standards", "text_path": "data/IFSB-Standards.txt"}
+    ]
+
+Relative paths are resolved against the project root. Optional keys are
+title (cited in context; default: the name), pdf_path, artifact_path,
+chunking, retrieval and embedder. Without the file the registry holds just
+the AAOIFI Standards.
+
+A search over several collections runs each collection's own search and
+merges the rankings with reciprocal-rank fusion, since BM25 scores from
+separately indexed documents aren't comparable.
+"""
+
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+from src.pdf_knowledge import (PDF_CONTEXT_CACHE_SIZE, PDF_CONTEXT_CANDIDATES, PROJECT_ROOT,
+                               ContextCache, PDFKnowledgeBase, context_budget, format_context)
+from src.search_index import reciprocal_rank_fusion
+from src.token_budget import get_token_counter
+
+KB_COLLECTIONS = os.getenv('KB_COLLECTIONS', str(PROJECT_ROOT / "data" / "collections.json"))
+
+COLLECTION_KEYS = ('name', 'title', 'text_path', 'pdf_path', 'artifact_path',
+                   'chunking', 'retrieval', 'embedder')
+
+# Used when there is no collections file
+DEFAULT_COLLECTIONS = [{'name': 'aaoifi', 'title': "AAOIFI Standards"}]
+
+
+def load_collections(path: Union[str, Path]) -> List[Dict]:
+    """
+    Read collection specs (PDFKnowledgeBase keyword arguments) from a JSON file.
+
+    :param path: Collections file; DEFAULT_COLLECTIONS if it doesn't exist
+    :return: One spec per collection, with absolute paths
+    :raises ValueError: If the file is malformed
+    """
+    path = Path(path)
+    if not path.exists():
+        return [dict(spec) for spec in DEFAULT_COLLECTIONS]
+
+    with open(path, 'r', encoding='utf-8') as f:
+        specs = json.load(f)
+    if not isinstance(specs, list) or not specs:
+        raise ValueError(f"{path}: expected a non-empty list of collections")
+
+    names = set()
+    for spec in specs:
+        if not isinstance(spec, dict) or not spec.get('name'):
+            raise ValueError(f"{path}: every collection needs a 'name'")
+        name = spec['name']
+        unknown = set(spec) - set(COLLECTION_KEYS)
+        if unknown:
+            raise ValueError(f"{path}: unknown keys {sorted(unknown)} in collection {name!r}")
+        if name in names:
+            raise ValueError(f"{path}: duplicate collection {name!r}")
+        names.add(name)
+        if not spec.get('text_path') and not spec.get('pdf_path'):
+            raise ValueError(f"{path}: collection {name!r} needs a text_path or pdf_path")
+
+        for key in ('text_path', 'pdf_path', 'artifact_path'):
+            if spec.get(key):
+                spec[key] = str(PROJECT_ROOT / spec[key])
+        if not spec.get('text_path'):
+            spec['text_path'] = str(Path(spec['pdf_path']).with_suffix('.txt'))
+        if not spec.get('pdf_path'):
+            spec['pdf_path'] = str(Path(spec['text_path']).with_suffix('.pdf'))
+    return specs
+
+
+class KnowledgeBaseRegistry:
+    """The configured collections, each a PDFKnowledgeBase with its own index."""
+
+    def __init__(self, specs: Optional[List[Dict]] = None):
+        """
+        :param specs: Collection specs (default: read from KB_COLLECTIONS)
+        """
+        if specs is None:
+            specs = load_collections(KB_COLLECTIONS)
+        self._collections: Dict[str, PDFKnowledgeBase] = {}
+        for spec in specs:
+            spec = dict(spec)
+            spec.setdefault('title', spec['name'])
+            self._collections[spec['name']] = PDFKnowledgeBase(**spec)
+        # The first collection, used where only one knowledge base is expected
+        self.default = next(iter(self._collections.values()))
+        # Context merged from several collections (single-collection
+        # lookups use that collection's own cache)
+        self.context_cache = ContextCache(PDF_CONTEXT_CACHE_SIZE)
+
+    @property
+    def names(self) -> List[str]:
+        return list(self._collections)
+
+    def __len__(self) -> int:
+        return len(self._collections)
+
+    def __iter__(self) -> Iterator[PDFKnowledgeBase]:
+        return iter(self._collections.values())
+
+    def get(self, name: str) -> PDFKnowledgeBase:
+        """The collection called name; raises ValueError if there is none."""
+        kb = self._collections.get(name)
+        if kb is None:
+            raise ValueError(f"Unknown collection {name!r}, expected one of {self.names}")
+        return kb
+
+    def select(self, collections: Optional[Sequence[str]] = None) -> List[PDFKnowledgeBase]:
+        """The named collections (all of them if None), in registry order."""
+        if collections is None:
+            return list(self)
+        wanted = {self.get(name).name for name in collections}
+        return [kb for kb in self if kb.name in wanted]
+
+    def warm(self) -> None:
+        """Start loading every collection in the background."""
+        for kb in self:
+            kb.warm()
+
+    def status(self) -> Dict[str, object]:
+        """
+        Loading state for readiness checks. With one collection, its own
+        status; otherwise the least-ready state plus each collection's status.
+        """
+        if len(self) == 1:
+            return self.default.status()
+        statuses = {kb.name: kb.status() for kb in self}
+        states = {status['state'] for status in statuses.values()}
+        for state in ('loading', 'idle', 'ready'):
+            if state in states:
+                break
+        else:
+            state = 'unavailable'
+        return {'state': state, 'collections': statuses}
+
+    def search(self, query: str, max_results: int = 3, collections: Optional[Sequence[str]] = None,
+               standard: Optional[int] = None, pages: Optional[Tuple[int, int]] = None) -> List[Dict]:
+        """
+        Search one or more collections (see PDFKnowledgeBase.search).
+
+        :param collections: Names of the collections to search (default: all)
+        :return: Results, best first; each carries its 'source', 'collection'
+                 and 'document'
+        """
+        kbs = self.select(collections)
+        if len(kbs) == 1:
+            return kbs[0].search(query, max_results, standard, pages)
+        return self._search_all(kbs, query, max_results, standard, pages)[0]
+
+    def _search_all(self, kbs: List[PDFKnowledgeBase], query: str, max_results: int,
+                    standard: Optional[int], pages: Optional[Tuple[int, int]]) -> Tuple[List[Dict], Tuple, bool]:
+        """
+        Search each collection and fuse the rankings.
+
+        :return: (results, content hash of each collection searched, complete)
+        """
+        rankings, hashes, complete = [], [], True
+        for kb in kbs:
+            results, source_hash, kb_complete = kb.retrieve(query, max_results, standard, pages)
+            rankings.append(results)
+            hashes.append(source_hash)
+            complete = complete and kb_complete
+        return _fuse(rankings, max_results), tuple(hashes), complete
+
+    def get_relevant_context_with_sources(self, query: str, max_chars: int = 2000,
+                                          collections: Optional[Sequence[str]] = None,
+                                          standard: Optional[int] = None,
+                                          pages: Optional[Tuple[int, int]] = None,
+                                          max_tokens: Optional[int] = None,
+                                          model: Optional[str] = None) -> Tuple[str, List[Dict]]:
+        """
+        Context and citations from one or more collections
+        (see PDFKnowledgeBase.get_relevant_context_with_sources).
+
+        :param collections: Names of the collections to search (default: all)
+        """
+        kbs = self.select(collections)
+        if len(kbs) == 1:
+            return kbs[0].get_relevant_context_with_sources(query, max_chars, standard, pages,
+                                                            max_tokens, model)
+
+        pages = tuple(pages) if pages is not None else None
+        hashes = tuple(kb.source_hash for kb in kbs)
+        token_counter = get_token_counter(model or "gpt-5.1") if max_tokens is not None else None
+        cache_key = ContextCache.key(query, context_budget(max_chars, max_tokens, token_counter), hashes,
+                                     (tuple(kb.name for kb in kbs), standard, pages))
+        if None not in hashes:
+            cached = self.context_cache.get(cache_key)
+            if cached is not None:
+                return cached
+
+        results, searched, complete = self._search_all(kbs, query, PDF_CONTEXT_CANDIDATES, standard, pages)
+        context, citations = format_context(results, max_chars, max_tokens, token_counter)
+        # Don't cache if a collection reloaded (or finished loading) meanwhile
+        if complete and searched == hashes:
+            self.context_cache.put(cache_key, context, citations)
+        return context, citations
+
+    def get_relevant_contexts_with_sources(self, queries: Sequence[str], max_chars: int = 2000,
+                                           collections: Optional[Sequence[str]] = None,
+                                           standard: Optional[int] = None,
+                                           pages: Optional[Tuple[int, int]] = None,
+                                           max_tokens: Optional[int] = None,
+                                           model: Optional[str] = None) -> List[Tuple[str, List[Dict]]]:
+        """
+        get_relevant_context_with_sources() for a batch of queries. Cached
+        contexts are reused and repeated queries are looked up once. The rest
+        are retrieved together, one pass per collection (see
+        PDFKnowledgeBase.retrieve_many).
+
+        :return: One (context, citations) per query, in order
+        """
+        kbs = self.select(collections)
+        pages = tuple(pages) if pages is not None else None
+        token_counter = get_token_counter(model or "gpt-5.1") if max_tokens is not None else None
+        budget = context_budget(max_chars, max_tokens, token_counter)
+        hashes = tuple(kb.source_hash for kb in kbs)
+        # The same cache entries as one-at-a-time lookups
+        if len(kbs) == 1:
+            cache, cache_hash, filters = kbs[0].context_cache, hashes[0], (standard, pages)
+        else:
+            cache, cache_hash, filters = self.context_cache, hashes, (tuple(kb.name for kb in kbs), standard, pages)
+        keys = [ContextCache.key(query, budget, cache_hash, filters) for query in queries]
+
+        found: Dict[Tuple, Tuple[str, List[Dict]]] = {}
+        if None not in hashes:
+            for key in dict.fromkeys(keys):
+                cached = cache.get(key)
+                if cached is not None:
+                    found[key] = cached
+
+        missing: Dict[Tuple, str] = {}
+        for key, query in zip(keys, queries):
+            if key not in found:
+                missing.setdefault(key, query)
+        if missing:
+            batch = list(missing.values())
+            retrieved = [kb.retrieve_many(batch, PDF_CONTEXT_CANDIDATES, standard, pages) for kb in kbs]
+            searched = tuple(source_hash for _, source_hash in retrieved)
+            for position, key in enumerate(missing):
+                results = _fuse([rankings[position] for rankings, _ in retrieved], PDF_CONTEXT_CANDIDATES)
+                found[key] = format_context(results, max_chars, max_tokens, token_counter)
+                # Don't cache if a collection reloaded (or finished loading) meanwhile
+                if None not in hashes and searched == hashes:
+                    cache.put(key, *found[key])
+
+        return [(found[key][0], [dict(citation) for citation in found[key][1]]) for key in keys]
+
+    def context_cache_stats(self) -> Dict[str, object]:
+        """Context cache stats summed over the registry and every collection."""
+        caches = [self.context_cache] + [kb.context_cache for kb in self]
+        totals: Dict[str, object] = {}
+        for stats in (cache.stats() for cache in caches):
+            for key, value in stats.items():
+                if key != 'hit_ratio':
+                    totals[key] = totals.get(key, 0) + value
+        lookups = totals.get('hits', 0) + totals.get('misses', 0)
+        totals['hit_ratio'] = round(totals.get('hits', 0) / lookups, 4) if lookups else 0.0
+        return totals
+
+
+def _fuse(rankings: List[List[Dict]], max_results: int) -> List[Dict]:
+    """Merge per-collection result lists with reciprocal-rank fusion."""
+    if len(rankings) == 1:
+        return rankings[0][:max_results]
+    fused = reciprocal_rank_fusion(
+        ([((position, rank), result['score']) for rank, result in enumerate(results)]
+         for position, results in enumerate(rankings)),
+        top_k=max_results,
+    )
+    return [rankings[position][rank] for (position, rank), _ in fused]
+
+
+# Global instance
+_registry: Optional[KnowledgeBaseRegistry] = None
+_registry_lock = threading.Lock()
+
+
+def get_registry() -> KnowledgeBaseRegistry:
+    """Get or create the global collection registry."""
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = KnowledgeBaseRegistry()
+    return _registry
@@ -0,0 +1,243 @@
+"""
+Knowledge base server: one process owns the loaded index, workers query it.
+
+By default every gunicorn worker loads its own copy of the knowledge base
+(see get_knowledge_base), so index memory and load time grow with the
+worker count. With KB_SERVER_SOCKET set, workers instead send their
+retrieval calls to a sidecar process over a Unix socket, and adding workers
+for model-bound concurrency adds no knowledge base memory.
+
+Run the sidecar next to the app:
+
+    python -m src.kb_server --socket /tmp/tyc-kb.sock
+
+or set KB_SERVER_SPAWN=true to have gunicorn start it (see gunicorn.conf.py).
+
+The module functions of pdf_knowledge (get_aaoifi_context,
+get_aaoifi_context_with_sources, get_aaoifi_contexts_with_sources and
+get_knowledge_base_status) keep their signatures and call the server when
+KB_SERVER_SOCKET is set. If it can't be reached, questions are answered
+without context, as when the knowledge base fails to load.
+
+Protocol: newline-delimited JSON over a persistent connection (one per
+worker thread). A request is {"method": ..., "params": {...}} and the reply
+{"result": ...} or {"error": "..."}. Methods: "context", "contexts" and
+"status", named after the pdf_knowledge functions they run.
+"""
+
+import argparse
+import json
+import os
+import signal
+import socket
+import socketserver
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from src.metrics import counter
+
+# Unix socket of the knowledge base server (unset: each worker loads its own knowledge base)
+KB_SERVER_SOCKET = os.getenv('KB_SERVER_SOCKET', '')
+
+# Seconds a worker waits for a reply before answering without context (longer than
+# PDF_READY_TIMEOUT, which the server may wait for a loading knowledge base)
+KB_SERVER_TIMEOUT = float(os.getenv('KB_SERVER_TIMEOUT', '10'))
+
+KB_SERVER_REQUESTS = counter(
+    'advisor_kb_server_requests_total',
+    'Knowledge base server calls from this worker, by method and result (ok, error)',
+    ('method', 'result'),
+)
+
+# Set in the server process, whose own calls must run locally
+_serving = False
+
+
+class KnowledgeBaseServerError(Exception):
+    """The knowledge base server could not be reached or failed the call."""
+
+
+class KnowledgeBaseClient:
+    """Calls a knowledge base server; thread-safe, with one connection per thread."""
+
+    def __init__(self, path: str, timeout: float = KB_SERVER_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.path)
+            except OSError:
+                sock.close()
+                raise
+            connection = self._local.connection = (sock, sock.makefile('rb'))
+        return connection
+
+    def _close(self) -> None:
+        connection = getattr(self._local, 'connection', None)
+        self._local.connection = None
+        if connection is not None:
+            connection[1].close()
+            connection[0].close()
+
+    def call(self, method: str, **params):
+        """Run a method on the server and return its result."""
+        payload = json.dumps({'method': method, 'params': params}).encode('utf-8') + b'\n'
+        # A kept-alive connection may have been closed by a server restart:
+        # retry once on a new one (every method is a read)
+        for attempt in range(2):
+            try:
+                sock, reader = self._connection()
+                sock.sendall(payload)
+                line = reader.readline()
+                if not line:
+                    raise ConnectionError("Connection closed by the knowledge base server")
+                break
+            except socket.timeout as e:
+                self._close()
+                KB_SERVER_REQUESTS.inc(method=method, result='error')
+                raise KnowledgeBaseServerError(f"No reply from {self.path} in {self.timeout} s") from e
+            except OSError as e:
+                self._close()
+                if attempt:
+                    KB_SERVER_REQUESTS.inc(method=method, result='error')
+                    raise KnowledgeBaseServerError(f"Could not reach {self.path}: {e}") from e
+
+        response = json.loads(line)
+        if 'error' in response:
+            KB_SERVER_REQUESTS.inc(method=method, result='error')
+            raise KnowledgeBaseServerError(response['error'])
+        KB_SERVER_REQUESTS.inc(method=method, result='ok')
+        return response['result']
+
+    def context(self, query: str, max_chars: int = 2000, **filters) -> Tuple[str, List[Dict]]:
+        """Remote get_aaoifi_context_with_sources()."""
+        context, citations = self.call('context', query=query, max_chars=max_chars, **filters)
+        return context, citations
+
+    def contexts(self, queries: List[str], max_chars: int = 2000, **filters) -> List[Tuple[str, List[Dict]]]:
+        """Remote get_aaoifi_contexts_with_sources()."""
+        return [(context, citations)
+                for context, citations in self.call('contexts', queries=queries, max_chars=max_chars, **filters)]
+
+    def status(self) -> Dict[str, object]:
+        """Remote get_knowledge_base_status()."""
+        return self.call('status')
+
+
+_client_lock = threading.Lock()
+_client: Optional[KnowledgeBaseClient] = None
+_client_pid: Optional[int] = None
+
+
+def get_client() -> Optional[KnowledgeBaseClient]:
+    """
+    This process's client of the knowledge base server, or None if workers
+    load their own knowledge base (KB_SERVER_SOCKET unset) or this is the server.
+    """
+    global _client, _client_pid
+    if not KB_SERVER_SOCKET or _serving:
+        return None
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _client_lock:
+            if _client is None or _client_pid != pid:
+                # A new process (e.g. a forked worker) doesn't reuse its parent's connections
+                _client = KnowledgeBaseClient(KB_SERVER_SOCKET)
+                _client_pid = pid
+    return _client
+
+
+def _filters(params: Dict) -> Dict:
+    pages = params.get('pages')
+    return {
+        'collections': params.get('collections'),
+        'standard': params.get('standard'),
+        'pages': tuple(pages) if pages is not None else None,
+        'max_tokens': params.get('max_tokens'),
+        'model': params.get('model'),
+    }
+
+
+def _dispatch(method: str, params: Dict):
+    from src.pdf_knowledge import (get_aaoifi_context_with_sources, get_aaoifi_contexts_with_sources,
+                                   get_knowledge_base_status)
+
+    if method == 'context':
+        return get_aaoifi_context_with_sources(params['query'], params.get('max_chars', 2000),
+                                               **_filters(params))
+    if method == 'contexts':
+        return get_aaoifi_contexts_with_sources(params['queries'], params.get('max_chars', 2000),
+                                                **_filters(params))
+    if method == 'status':
+        return get_knowledge_base_status()
+    raise ValueError(f"Unknown method {method!r}")
+
+
+class KnowledgeBaseRequestHandler(socketserver.StreamRequestHandler):
+    """Serves one worker thread's connection: a request per line, until it disconnects."""
+
+    def handle(self) -> None:
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                response = {'result': _dispatch(request['method'], request.get('params') or {})}
+            except Exception as e:
+                response = {'error': f"{type(e).__name__}: {e}"}
+            try:
+                self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+                self.wfile.flush()
+            except OSError:
+                return  # The worker gave up waiting (KB_SERVER_TIMEOUT) or exited
+
+
+class KnowledgeBaseServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt  # Stop serving and remove the socket, as on Ctrl-C
+
+
+def serve(path: str) -> None:
+    """Load the knowledge base and serve it on a Unix socket until interrupted."""
+    global _serving
+    _serving = True
+
+    from src.pdf_knowledge import warm_knowledge_base
+
+    if os.path.exists(path):
+        os.unlink(path)  # Left over from a previous run
+    server = KnowledgeBaseServer(path, KnowledgeBaseRequestHandler)
+    signal.signal(signal.SIGTERM, _interrupt)
+    os.chmod(path, 0o600)  # Only this user's workers
+    warm_knowledge_base()  # Loads in the background; 'status' reports progress
+    print(f"Knowledge base server listening on {path}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Serve the AAOIFI knowledge base to app workers")
+    parser.add_argument('--socket', default=KB_SERVER_SOCKET or '/tmp/tyc-kb.sock',
+                        help="Unix socket path (default: KB_SERVER_SOCKET)")
+    args = parser.parse_args()
+    serve(args.socket)
+
+
+if __name__ == "__main__":
+    # Run as src.kb_server, not __main__: the _serving flag pdf_knowledge checks is that module's
+    from src import kb_server
+
+    kb_server.main()
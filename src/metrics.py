@@ -0,0 +1,210 @@
+"""
+Lightweight in-process metrics.
+
+Counters, gauges and histograms with Prometheus-style names and labels,
+kept per process (each gunicorn worker has its own). Modules create their
+metrics at import time with counter()/gauge()/histogram(), which return the
+existing metric if one with the same name is already registered. A gauge
+can read its value from a function at scrape time, e.g. a cache's size.
+
+render_prometheus() writes them in the Prometheus text exposition format,
+which the app serves on /metrics.
+"""
+
+import threading
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# Latency buckets in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0)
+
+LabelValues = Tuple[str, ...]
+
+
+class Metric:
+    """Base class: a named family of time series keyed by label values."""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+
+class Counter(Metric):
+    """A monotonically increasing count."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def snapshot(self) -> Dict[LabelValues, float]:
+        with self._lock:
+            return dict(self._values)
+
+
+class Gauge(Metric):
+    """A value that goes up and down, set directly or read from a function when scraped."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+        self._function: Optional[Callable[[], Dict[LabelValues, float]]] = None
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function: Callable[[], Dict[LabelValues, float]]) -> None:
+        """
+        Read the values from function() at each snapshot instead. It returns
+        {label values: value}, e.g. {('memory',): 12}, or {(): 12} without labels.
+        """
+        self._function = function
+
+    def snapshot(self) -> Dict[LabelValues, float]:
+        if self._function is not None:
+            try:
+                return {tuple(str(v) for v in key): value for key, value in self._function().items()}
+            except Exception as e:
+                # A failing source must not break the whole scrape
+                print(f"Warning: Could not read gauge {self.name}: {e}")
+                return {}
+        with self._lock:
+            return dict(self._values)
+
+
+class Histogram(Metric):
+    """Observations counted into cumulative buckets, plus their sum."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: [count per bucket (last = +Inf)], sum, count
+        self._series: Dict[LabelValues, List] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        position = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][position] += 1
+            series[1] += value
+            series[2] += 1
+
+    def snapshot(self) -> Dict[LabelValues, Dict]:
+        """Per label set: cumulative bucket counts, sum and count."""
+        with self._lock:
+            result = {}
+            for key, (counts, total, count) in self._series.items():
+                cumulative, running = [], 0
+                for upper, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                    running += bucket_count
+                    cumulative.append((upper, running))
+                result[key] = {'buckets': cumulative, 'sum': total, 'count': count}
+            return result
+
+
+class Registry:
+    """All metrics of this process, by name."""
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.labelnames != metric.labelnames:
+                    raise ValueError(f"Metric {metric.name} already registered with a different type or labels")
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def metrics(self) -> List[Metric]:
+        with self._lock:
+            return list(self._metrics.values())
+
+
+REGISTRY = Registry()
+
+# Content-Type of render_prometheus() output
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+def _number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def render_prometheus(registry: Registry = REGISTRY) -> str:
+    """Every metric of a registry in the Prometheus text exposition format (version 0.0.4)."""
+    lines = []
+    for metric in sorted(registry.metrics(), key=lambda m: m.name):
+        lines.append(f"# HELP {metric.name} {_escape(metric.documentation)}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for key, value in sorted(metric.snapshot().items()):
+            if isinstance(metric, Histogram):
+                for upper, count in value['buckets']:
+                    labels = _labels(metric.labelnames + ('le',), key + (_number(upper),))
+                    lines.append(f"{metric.name}_bucket{labels} {count}")
+                labels = _labels(metric.labelnames, key)
+                lines.append(f"{metric.name}_sum{labels} {_number(value['sum'])}")
+                lines.append(f"{metric.name}_count{labels} {value['count']}")
+            else:
+                lines.append(f"{metric.name}{_labels(metric.labelnames, key)} {_number(value)}")
+    return '\n'.join(lines) + '\n'
+
+
+def counter(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+    """Get or create a counter in the global registry."""
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+    """Get or create a gauge in the global registry."""
+    return REGISTRY.register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name: str, documentation: str, labelnames: Sequence[str] = (),
+              buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    """Get or create a histogram in the global registry."""
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
@@ -0,0 +1,169 @@
+"""
+Page text extraction from the AAOIFI Standards PDF.
+
+Shared by the PDF fallback in PDFKnowledgeBase and by
+scripts/convert_pdf_to_text.py. Pages are extracted in ranges so they can be
+spread over a process pool: reader objects can't be sent between processes,
+so each worker opens the PDF itself (once) and returns only its pages' text.
+
+Extracted text is laid out as one block per non-empty page:
+
+    --- Page 12 ---
+    <page text>
+
+with blocks separated by a blank line (PAGE_SEPARATOR).
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from importlib.util import find_spec
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+PDF_BACKENDS = ('pypdf2', 'pdfplumber')
+
+PAGE_SEPARATOR = "\n\n"
+
+# (1-based page number, text); text is "" for blank or unreadable pages
+Page = Tuple[int, str]
+
+
+def pdf_backend() -> str:
+    """The installed PDF library to use: PyPDF2 if available, else pdfplumber."""
+    # Probe without importing: the library is imported where pages are read
+    if find_spec('PyPDF2') is not None:
+        return 'pypdf2'
+    if find_spec('pdfplumber') is not None:
+        return 'pdfplumber'
+    raise ImportError(
+        "Please install a PDF library: pip install PyPDF2 or pip install pdfplumber"
+    )
+
+
+# Open documents of this process. Parsing a large PDF's page tree costs more
+# than extracting a batch of its pages, so each process opens it only once.
+_documents: Dict[Tuple, Tuple[Sequence, Callable[[], None]]] = {}
+
+
+def _open_pages(pdf_path: str, backend: str) -> Sequence:
+    """The page sequence of a PDF, opened once per process (and per file version)."""
+    key = (os.path.abspath(pdf_path), backend, os.path.getmtime(pdf_path))
+    document = _documents.get(key)
+    if document is None:
+        close_documents()
+        if backend == 'pypdf2':
+            import PyPDF2
+
+            file = open(pdf_path, 'rb')
+            document = (PyPDF2.PdfReader(file).pages, file.close)
+        else:
+            import pdfplumber
+
+            pdf = pdfplumber.open(pdf_path)
+            document = (pdf.pages, pdf.close)
+        _documents[key] = document
+    return document[0]
+
+
+def close_documents() -> None:
+    """Close the PDFs this process has open."""
+    for _, close in _documents.values():
+        close()
+    _documents.clear()
+
+
+def format_page(page_number: int, text: str) -> str:
+    """A page block as it appears in the text file."""
+    return f"--- Page {page_number} ---\n{text}"
+
+
+def count_pages(pdf_path: str, backend: Optional[str] = None) -> int:
+    """Number of pages in the PDF."""
+    return len(_open_pages(pdf_path, backend or pdf_backend()))
+
+
+def extract_pages(pdf_path: str, start: int, end: int, backend: Optional[str] = None) -> List[Page]:
+    """
+    Extract pages [start, end) (0-based indices).
+
+    A page that fails to extract is reported and returned with empty text;
+    MemoryError and SystemExit propagate.
+
+    :return: One (page_number, text) per page, in order
+    """
+    backend = backend or pdf_backend()
+    pages = []
+
+    def extract(page_index: int, page) -> None:
+        try:
+            text = page.extract_text() or ""
+        except (MemoryError, SystemExit):
+            raise
+        except Exception as e:
+            print(f"  Warning: Could not extract page {page_index + 1}: {e}")
+            text = ""
+        pages.append((page_index + 1, text))
+
+    document_pages = _open_pages(pdf_path, backend)
+    for page_index in range(start, min(end, len(document_pages))):
+        page = document_pages[page_index]
+        extract(page_index, page)
+        if backend == 'pdfplumber':
+            page.close()  # pdfplumber caches each page's parsed layout
+
+    return pages
+
+
+def iter_page_batches(pdf_path: str, start: int, end: int, workers: int = 1,
+                      batch_size: int = 25, backend: Optional[str] = None) -> Iterator[List[Page]]:
+    """
+    Extract pages [start, end) in batches of ``batch_size``, in page order.
+
+    With ``workers`` > 1 the batches run on a process pool. At most
+    2 * workers batches are in flight, so memory stays bounded however large
+    the PDF is, and finished batches are yielded as soon as every earlier
+    batch is done.
+    """
+    backend = backend or pdf_backend()
+    ranges = [(s, min(s + batch_size, end)) for s in range(start, end, batch_size)]
+
+    if workers <= 1:
+        try:
+            for range_start, range_end in ranges:
+                yield extract_pages(pdf_path, range_start, range_end, backend)
+        finally:
+            close_documents()
+        return
+
+    # Don't hand an open document to the pool's forked children
+    close_documents()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = []
+        next_range = 0
+        while next_range < len(ranges) or pending:
+            while next_range < len(ranges) and len(pending) < 2 * workers:
+                range_start, range_end = ranges[next_range]
+                pending.append(pool.submit(extract_pages, pdf_path, range_start, range_end, backend))
+                next_range += 1
+            yield pending.pop(0).result()
+
+
+def extract_text(pdf_path: str, max_pages: Optional[int] = None, workers: int = 1,
+                 backend: Optional[str] = None) -> str:
+    """
+    Extract the whole PDF (or its first ``max_pages`` pages) as one string.
+
+    :return: Page blocks joined with PAGE_SEPARATOR
+    """
+    backend = backend or pdf_backend()
+    total_pages = count_pages(pdf_path, backend)
+    pages_to_process = min(total_pages, max_pages) if max_pages else total_pages
+    if pages_to_process < total_pages:
+        print(f"Warning: Processing only the first {pages_to_process} of {total_pages} pages")
+
+    blocks = []
+    for batch in iter_page_batches(pdf_path, 0, pages_to_process, workers=workers, backend=backend):
+        blocks.extend(format_page(number, text) for number, text in batch if text.strip())
+
+    if not blocks:
+        raise Exception("No text could be extracted from PDF")
+    return PAGE_SEPARATOR.join(blocks)
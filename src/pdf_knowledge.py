@@ -5,11 +5,27 @@ This module extracts and provides searchable access to the AAOIFI Standards PDF.
 Can be disabled via ENABLE_PDF_KNOWLEDGE environment variable (set to 'false' to disable).
 """
 
+import hashlib
+import mmap
 import os
 import sys
-from typing import List, Dict, Optional
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from array import array
+from typing import List, Dict, Optional, Sequence, Tuple
 from pathlib import Path
-import re
+
+from src.chunking import (CHUNKING_MODES, chunk_metadata, fixed_chunks,
+                          parse_structure, structured_chunks)
+from src.chunk_store import ChunkStore, PageIndex, byte_offsets, page_segments
+from src.kb_artifact import artifact_path_for, content_hash, read_artifact, save_artifact
+from src.metrics import counter, gauge
+from src.pdf_extract import extract_text
+from src.search_index import BM25Index, reciprocal_rank_fusion, tokenize
+from src.timing import span
+from src.token_budget import TokenCounter, get_token_counter
 
 # Get project root directory (parent of src/)
 PROJECT_ROOT = Path(__file__).parent.parent.resolve()
@@ -17,24 +33,310 @@ PROJECT_ROOT = Path(__file__).parent.parent.resolve()
 # Check if PDF knowledge base is enabled (default: True)
 PDF_ENABLED = os.getenv('ENABLE_PDF_KNOWLEDGE', 'true').lower() != 'false'
 
+# Pages read when falling back to parsing the PDF at runtime (unset: all).
+# Convert the PDF ahead of time instead (scripts/convert_pdf_to_text.py).
+PDF_MAX_PAGES = int(os.getenv('PDF_MAX_PAGES', '0')) or None
+
+# Chunking mode: 'fixed' (overlapping windows) or 'structured' (clause-aligned)
+PDF_CHUNKING = os.getenv('PDF_CHUNKING', 'fixed').lower()
+
+# Retrieval mode: 'lexical' (BM25), 'dense' (embeddings, see PDF_EMBEDDER)
+# or 'hybrid' (both, fused with reciprocal-rank fusion)
+RETRIEVAL_MODES = ('lexical', 'dense', 'hybrid')
+PDF_RETRIEVAL_MODE = os.getenv('PDF_RETRIEVAL_MODE', 'lexical').lower()
+
+# Hybrid mode: per-request latency budget, and threads shared by all requests
+PDF_RETRIEVAL_BUDGET_MS = float(os.getenv('PDF_RETRIEVAL_BUDGET_MS', '150'))
+PDF_RETRIEVAL_THREADS = int(os.getenv('PDF_RETRIEVAL_THREADS', '8'))
+
+# How long a search waits for a knowledge base that is still loading before
+# giving up (the answer is then generated without AAOIFI context)
+PDF_READY_TIMEOUT = float(os.getenv('PDF_READY_TIMEOUT', '5'))
+
+KB_NOT_READY = counter(
+    'kb_searches_not_ready_total',
+    'Searches that gave up waiting for the knowledge base to finish loading',
+)
+
+# How often (in seconds) a worker checks whether the text file or its artifact
+# changed on disk; a change is loaded in the background and swapped in
+# without a restart (0 disables)
+PDF_RELOAD_INTERVAL = float(os.getenv('PDF_RELOAD_INTERVAL', '30'))
+
+KB_RELOADS = counter(
+    'kb_reloads_total',
+    'Background knowledge base reloads by result (swapped, unchanged, error)',
+    ('result',),
+)
+
+# Memoized get_relevant_context results per knowledge base (0 disables)
+PDF_CONTEXT_CACHE_SIZE = int(os.getenv('PDF_CONTEXT_CACHE_SIZE', '1024'))
+
+CONTEXT_CACHE_LOOKUPS = counter(
+    'kb_context_cache_lookups_total',
+    'Retrieval context cache lookups by result (hit, miss)',
+    ('result',),
+)
+CONTEXT_CACHE_ENTRIES = gauge('kb_context_cache_entries', 'Retrieval contexts cached in this worker')
+CONTEXT_CACHE_BYTES = gauge('kb_context_cache_bytes', 'Approximate memory held by the retrieval context cache')
+
+# Passages retrieved per context lookup; the best of them that fit the
+# character or token budget are used
+PDF_CONTEXT_CANDIDATES = int(os.getenv('PDF_CONTEXT_CANDIDATES', '8'))
+
+# A passage that only fits the token budget cut shorter than this is left out
+MIN_PASSAGE_TOKENS = 48
+
+HYBRID_OUTCOMES = counter(
+    'kb_hybrid_retriever_outcomes_total',
+    'Hybrid retrieval outcomes per retriever: win (ranked the top fused result), timeout, error',
+    ('retriever', 'outcome'),
+)
+
+_retrieval_pool = None
+_retrieval_pool_lock = threading.Lock()
+
+
+def _get_retrieval_pool() -> ThreadPoolExecutor:
+    """Thread pool for concurrent retrievers, created lazily (after fork)."""
+    global _retrieval_pool
+    if _retrieval_pool is None:
+        with _retrieval_pool_lock:
+            if _retrieval_pool is None:
+                _retrieval_pool = ThreadPoolExecutor(max_workers=PDF_RETRIEVAL_THREADS,
+                                                     thread_name_prefix='kb-retrieval')
+    return _retrieval_pool
+
+
+class ContextCache:
+    """
+    Thread-safe LRU cache of formatted retrieval results:
+    (normalized query, budget, content hash, filters) -> (context, citations).
+
+    Keys include the hash of the knowledge base text, so a content change
+    can never serve stale context; the cache is also cleared on reload.
+    """
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple, Tuple[str, List[Dict]]]" = OrderedDict()
+        self._sizes: Dict[Tuple, int] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+
+    @staticmethod
+    def key(query: str, budget: Tuple, source_hash: Optional[str], filters: Tuple = ()) -> Tuple:
+        return (" ".join(query.lower().split()), budget, source_hash, filters)
+
+    def get(self, key: Tuple) -> Optional[Tuple[str, List[Dict]]]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        CONTEXT_CACHE_LOOKUPS.inc(result='miss' if value is None else 'hit')
+        if value is None:
+            return None
+        context, citations = value
+        return context, [dict(citation) for citation in citations]  # Callers may modify them
+
+    def put(self, key: Tuple, context: str, citations: List[Dict]) -> None:
+        if self.max_entries <= 0:
+            return
+        size = (sys.getsizeof(key[0]) + sys.getsizeof(context)
+                + sum(sys.getsizeof(c) + sum(sys.getsizeof(v) for v in c.values()) for c in citations))
+        with self._lock:
+            if key in self._entries:
+                self.bytes -= self._sizes[key]
+            self._entries[key] = (context, [dict(citation) for citation in citations])
+            self._entries.move_to_end(key)
+            self._sizes[key] = size
+            self.bytes += size
+            while len(self._entries) > self.max_entries:
+                old_key, _ = self._entries.popitem(last=False)
+                self.bytes -= self._sizes.pop(old_key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self.bytes = 0
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'bytes': self.bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+class IndexState:
+    """
+    Everything a search reads: chunks, page and clause metadata, the BM25
+    index and (once loaded) the dense index. A reload builds a complete new
+    state and swaps it in with a single assignment, so searches in flight
+    keep a consistent view of the old one.
+    """
+
+    def __init__(self, source_hash: Optional[str] = None, chunks: Sequence[str] = (),
+                 pages: Optional[PageIndex] = None, chunk_standards: Sequence[int] = (),
+                 chunk_sections: Sequence[str] = (), index: Optional[BM25Index] = None,
+                 previous_hash: Optional[str] = None, reused_chunks: Optional[Sequence[int]] = None,
+                 signature: Optional[Tuple] = None):
+        self.source_hash = source_hash
+        # Chunks are lazy views into the memory-mapped text (see ChunkStore)
+        self.chunks = chunks
+        self.pages = pages if pages is not None else PageIndex()
+        self.chunk_standards = chunk_standards
+        self.chunk_sections = chunk_sections
+        self.index = index
+        # Text the artifact was updated from, and which of its chunks were kept
+        # (lets the dense index carry embeddings over; see _load_dense)
+        self.previous_hash = previous_hash
+        self.reused_chunks = reused_chunks
+        # Files on disk this state was loaded from (see _files_signature)
+        self.signature = signature
+        self.dense = None  # DenseIndex, loaded on first dense search
+        self.dense_attempted = False
+        # Filter lookups, computed on first use (see chunk_ranges)
+        self._page_runs: Optional[List[Tuple[int, int, int]]] = None
+        self._standard_ranges: Optional[Dict[int, List[Tuple[int, int]]]] = None
+
+    def chunk_ranges(self, standard: Optional[int] = None,
+                     pages: Optional[Tuple[int, int]] = None) -> Optional[List[Tuple[int, int]]]:
+        """
+        Chunk id ranges matching a Shari'ah Standard number and/or an
+        inclusive page range, for searches to score only those chunks.
+
+        :return: Sorted [start, end) ranges, or None if there is no filter
+        """
+        ranges = None
+        if standard is not None:
+            if self._standard_ranges is None:
+                self._standard_ranges = {}
+                for number, start, end in _runs(self.chunk_standards):
+                    self._standard_ranges.setdefault(number, []).append((start, end))
+            ranges = self._standard_ranges.get(standard, [])
+        if pages is not None:
+            if self._page_runs is None:
+                # Chunks don't cross pages, so each page is one run of chunk ids
+                self._page_runs = _runs([self.pages.page_at(self.chunks.span(chunk_id)[0]) or 0
+                                         for chunk_id in range(len(self.chunks))])
+            first, last = pages
+            page_ranges = [(start, end) for number, start, end in self._page_runs
+                           if first <= number <= last]
+            ranges = page_ranges if ranges is None else _intersect(ranges, page_ranges)
+        return ranges
+
 
 class PDFKnowledgeBase:
     """
-    A simple knowledge base for searching AAOIFI Standards content.
+    A simple knowledge base for searching AAOIFI Standards content (or, as a
+    collection of the KnowledgeBaseRegistry, any other document).
     Reads from text file if available (faster), otherwise falls back to PDF parsing.
     """
 
     def __init__(self, pdf_path: Optional[str] = None, 
-                 text_path: Optional[str] = None):
+                 text_path: Optional[str] = None,
+                 artifact_path: Optional[str] = None,
+                 chunk_size: int = 1000, overlap: int = 200,
+                 chunking: Optional[str] = None,
+                 max_chunk_size: int = 1500, min_chunk_size: int = 400,
+                 retrieval: Optional[str] = None, embedder: Optional[str] = None,
+                 retrieval_budget_ms: Optional[float] = None,
+                 ready_timeout: Optional[float] = None,
+                 reload_interval: Optional[float] = None,
+                 name: str = 'aaoifi', title: str = "AAOIFI Standards"):
+        # Collection name and the document title cited in context
+        self.name = name
+        self.title = title
         # Use project root for data files
         if pdf_path is None:
             pdf_path = str(PROJECT_ROOT / "data" / "AAOIFI-Standards.pdf")
         if text_path is None:
             text_path = str(PROJECT_ROOT / "data" / "AAOIFI-Standards.txt")
+        if artifact_path is None:
+            artifact_path = str(artifact_path_for(text_path))
         self.pdf_path = pdf_path
         self.text_path = text_path
-        self.content = None
-        self.chunks = []
+        self.artifact_path = artifact_path
+        if chunking is None:
+            chunking = PDF_CHUNKING
+        if chunking not in CHUNKING_MODES:
+            raise ValueError(f"Unknown chunking mode {chunking!r}, expected one of {CHUNKING_MODES}")
+        self.chunking = chunking
+        self.chunk_size = chunk_size
+        self.overlap = overlap
+        self.max_chunk_size = max_chunk_size
+        self.min_chunk_size = min_chunk_size
+        if retrieval is None:
+            retrieval = PDF_RETRIEVAL_MODE
+        if retrieval not in RETRIEVAL_MODES:
+            raise ValueError(f"Unknown retrieval mode {retrieval!r}, expected one of {RETRIEVAL_MODES}")
+        self.retrieval = retrieval
+        if retrieval_budget_ms is None:
+            retrieval_budget_ms = PDF_RETRIEVAL_BUDGET_MS
+        self.retrieval_budget_ms = retrieval_budget_ms
+        if ready_timeout is None:
+            ready_timeout = PDF_READY_TIMEOUT
+        self.ready_timeout = ready_timeout
+        if reload_interval is None:
+            reload_interval = PDF_RELOAD_INTERVAL
+        self.reload_interval = reload_interval
+        self.embedder_name = embedder  # None: PDF_EMBEDDER env var
+        self.source = None  # 'text' or 'pdf' once loaded
+        self.load_seconds: Optional[float] = None
+        # Loading runs once, on a background thread started by warm()
+        self._load_lock = threading.Lock()
+        self._loader: Optional[threading.Thread] = None
+        self._loaded = threading.Event()     # Index loaded (or failed to)
+        self._warm_done = threading.Event()  # Dense index too, where used
+        self._dense_lock = threading.Lock()
+        self._state = IndexState()
+        # Reloads run on their own thread, checked for at most every reload_interval
+        self._reloader: Optional[threading.Thread] = None
+        self._next_reload_check = 0.0
+        self.context_cache = ContextCache(PDF_CONTEXT_CACHE_SIZE)
+        self._local = threading.local()  # Per-request flags (see _hybrid_search)
+
+    # The current state's contents; read self._state once instead when
+    # several of them must come from the same state
+    @property
+    def source_hash(self) -> Optional[str]:
+        return self._state.source_hash
+
+    @property
+    def chunks(self) -> Sequence[str]:
+        return self._state.chunks
+
+    @property
+    def pages(self) -> PageIndex:
+        return self._state.pages
+
+    @property
+    def chunk_standards(self) -> Sequence[int]:
+        return self._state.chunk_standards
+
+    @property
+    def chunk_sections(self) -> Sequence[str]:
+        return self._state.chunk_sections
+
+    @property
+    def index(self) -> Optional[BM25Index]:
+        return self._state.index
+
+    @property
+    def dense(self):
+        return self._state.dense
 
     def load_content(self) -> str:
         """
@@ -49,6 +351,7 @@ class PDFKnowledgeBase:
                 with open(text_path, 'r', encoding='utf-8') as f:
                     content = f.read()
                 if content.strip():
+                    self.source = 'text'
                     return content
                 else:
                     print("Text file is empty, falling back to PDF...")
@@ -58,7 +361,9 @@ class PDFKnowledgeBase:
         # Fallback to PDF parsing
         pdf_path = Path(self.pdf_path)
         print(f"Loading from PDF: {pdf_path}")
-        return self.load_pdf()
+        content = self.load_pdf()
+        self.source = 'pdf'
+        return content
 
     def load_pdf(self) -> str:
         """
@@ -66,279 +371,978 @@ class PDFKnowledgeBase:
         Returns the full text content.
         """
         try:
-            import PyPDF2
+            return extract_text(str(self.pdf_path), max_pages=PDF_MAX_PAGES)
+        except (MemoryError, SystemExit):
+            # Don't catch these - let them propagate
+            raise
         except ImportError:
+            raise
+        except Exception as e:
+            raise Exception(f"Failed to load PDF: {e}")
+
+    def chunk_offsets(self, text: str, chunk_size: int = 1000,
+                      overlap: int = 200) -> List[Tuple[int, int]]:
+        """
+        Compute (start, end) character offsets of overlapping chunks.
+
+        :param text: The text to chunk
+        :param chunk_size: Size of each chunk in characters
+        :param overlap: Overlap between chunks in characters
+        :return: List of (start, end) offsets into text
+        """
+        return fixed_chunks(text, chunk_size, overlap)
+
+    def chunk_text(self, text: str, chunk_size: int = 1000, overlap: int = 200) -> List[str]:
+        """
+        Split text into overlapping chunks for better search.
+
+        :param text: The text to chunk
+        :param chunk_size: Size of each chunk in characters
+        :param overlap: Overlap between chunks in characters
+        :return: List of text chunks
+        """
+        return [text[start:end] for start, end in self.chunk_offsets(text, chunk_size, overlap)]
+
+    def _index_params(self) -> Dict[str, object]:
+        """Build settings recorded in (and checked against) the artifact."""
+        if self.chunking == 'structured':
+            return {'chunking': 'structured', 'max_chunk_size': self.max_chunk_size,
+                    'min_chunk_size': self.min_chunk_size}
+        return {'chunking': 'fixed', 'chunk_size': self.chunk_size, 'overlap': self.overlap}
+
+    def _chunk_spans(self, text: str) -> List[Tuple[int, int]]:
+        """(start, end) character offsets of the chunks of one page."""
+        if self.chunking == 'structured':
+            return structured_chunks(text, self.max_chunk_size, self.min_chunk_size)
+        return self.chunk_offsets(text, self.chunk_size, self.overlap)
+
+    def build_index(self, content: str, previous: Optional[Dict] = None) -> Dict:
+        """
+        Chunk and index content.
+
+        Chunks never cross a page, so a page's chunks depend only on its own
+        text. Given the payload of an earlier build with the same settings,
+        pages whose content hash hasn't changed keep their chunks, postings
+        (and, later, embeddings); only changed pages are chunked and
+        tokenized again.
+
+        :param content: Full knowledge base text
+        :param previous: Payload of an earlier build (see read_artifact), or None
+        :return: Artifact payload describing the chunks and index
+        """
+        buffer = content.encode('utf-8')
+        segments = page_segments(buffer)
+        hashes = [hashlib.sha256(buffer[start:end]).digest() for start, end in segments]
+
+        previous_segments = {}
+        if previous is not None:
+            for position, digest in enumerate(previous['segment_hashes']):
+                previous_segments.setdefault(digest, position)
+
+        offsets = array('I')
+        segment_chunks = array('I', [0])
+        reused = array('i')  # Previous chunk id per chunk, -1 if new
+        new_texts = []
+        for (start, end), digest in zip(segments, hashes):
+            position = previous_segments.get(digest)
+            if position is not None:
+                shift = start - previous['segments'][2 * position]
+                first, last = previous['segment_chunks'][position:position + 2]
+                for chunk_id in range(first, last):
+                    offsets.append(previous['chunk_offsets'][2 * chunk_id] + shift)
+                    offsets.append(previous['chunk_offsets'][2 * chunk_id + 1] + shift)
+                    reused.append(chunk_id)
+            else:
+                text = buffer[start:end].decode('utf-8')
+                spans = self._chunk_spans(text)
+                for chunk_start, chunk_end in spans:
+                    new_texts.append(text[chunk_start:chunk_end])
+                    reused.append(-1)
+                for offset in byte_offsets(text, spans):
+                    offsets.append(start + offset)
+            segment_chunks.append(len(offsets) // 2)
+
+        # Standards and clauses carry over page breaks, so they are resolved
+        # over the whole text (cheap next to tokenizing and embedding)
+        boundaries = parse_structure(content)
+        boundary_bytes = byte_offsets(content, [(b.offset, b.offset) for b in boundaries])
+        boundaries = [b._replace(offset=boundary_bytes[2 * i]) for i, b in enumerate(boundaries)]
+        spans = [(offsets[i], offsets[i + 1]) for i in range(0, len(offsets), 2)]
+        standards, sections = chunk_metadata(boundaries, spans)
+
+        kept = sum(1 for chunk_id in reused if chunk_id >= 0)
+        if kept:
+            changed = sum(1 for digest in hashes if digest not in previous_segments)
+            print(f"Reusing {kept} of {len(reused)} chunks ({changed} of {len(segments)} pages changed)")
+            index = BM25Index.update(BM25Index.from_dict(previous['index']), reused, new_texts)
+        else:
+            index = BM25Index.build(new_texts)
+
+        pages = PageIndex.build(buffer)
+        return {
+            'params': self._index_params(),
+            'chunk_offsets': offsets,
+            'chunk_standards': array('H', standards),
+            'chunk_sections': sections,
+            'page_offsets': pages.offsets,
+            'page_numbers': pages.numbers,
+            'segments': array('I', [offset for span in segments for offset in span]),
+            'segment_hashes': hashes,
+            'segment_chunks': segment_chunks,
+            'previous_hash': previous['source_hash'] if kept else None,
+            'reused_chunks': reused,
+            'index': index.to_dict(),
+        }
+
+    def _map_text_file(self) -> Optional[mmap.mmap]:
+        """
+        Memory-map the text file read-only.
+        Returns None if it is missing, empty or unreadable.
+        """
+        text_path = Path(self.text_path)
+        if not text_path.exists():
+            return None
+        try:
+            print(f"Loading from text file: {text_path}")
+            with open(text_path, 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as e:
+            # mmap raises ValueError for empty files
+            print(f"Error reading text file: {e}, falling back to PDF...")
+            return None
+        if not mapped[:4096].strip():
+            print("Text file is empty, falling back to PDF...")
+            return None
+        return mapped
+
+    def _files_signature(self) -> Tuple:
+        """Identity of the text file and artifact on disk, to notice when either is replaced."""
+        signature = []
+        for path in (self.text_path, self.artifact_path):
             try:
-                import pdfplumber
-                return self._extract_with_pdfplumber()
-            except ImportError:
-                raise ImportError(
-                    "Please install a PDF library: pip install PyPDF2 or pip install pdfplumber"
-                )
+                stat = os.stat(path)
+                signature.append((stat.st_ino, stat.st_size, stat.st_mtime_ns))
+            except OSError:
+                signature.append(None)
+        return tuple(signature)
 
-        return self._extract_with_pypdf2()
+    @span('kb_build')
+    def _build_state(self, reloading: bool = False) -> Optional[IndexState]:
+        """
+        Load the chunk store and index, preferring the memory-mapped text file
+        plus its precompiled artifact. A stale artifact is updated (only the
+        pages that changed are re-indexed) and saved; a missing one is built.
 
-    def _extract_with_pypdf2(self) -> str:
-        """Extract text using PyPDF2."""
-        import PyPDF2
+        :param reloading: Called for a reload: without a usable text file,
+                          return None instead of parsing the PDF
+        :return: A complete new IndexState (not yet in use)
+        """
+        signature = self._files_signature()
+        mapped = self._map_text_file()
 
-        text_content = []
-        max_pages = 50  # Reduced to prevent memory issues
+        if mapped is not None:
+            self.source = 'text'
+            source_hash = content_hash(mapped)
+            payload = read_artifact(self.artifact_path, self._index_params())
+            if payload is not None and payload['source_hash'] != source_hash:
+                print(f"Knowledge base artifact {self.artifact_path} is stale, updating...")
+                previous, payload = payload, None
+            else:
+                previous = None
+            if payload is None:
+                print("Building AAOIFI Standards index...")
+                payload = self.build_index(str(mapped, 'utf-8'), previous)
+                try:
+                    save_artifact(self.artifact_path, source_hash, payload)
+                    signature = self._files_signature()  # Don't reload our own artifact
+                except OSError as e:
+                    print(f"Warning: could not save knowledge base artifact: {e}")
+            chunks = ChunkStore(mapped, payload['chunk_offsets'])
+        elif reloading:
+            return None
+        else:
+            print(f"Loading from PDF: {self.pdf_path}")
+            content = self.load_pdf()
+            self.source = 'pdf'
+            source_hash = content_hash(content)
+            payload = self.build_index(content)
+            chunks = ChunkStore.from_text(content, payload['chunk_offsets'])
+            signature = None  # Nothing on disk to watch
 
-        pdf_path = Path(self.pdf_path)
+        return IndexState(
+            source_hash=source_hash,
+            chunks=chunks,
+            pages=PageIndex(payload['page_offsets'], payload['page_numbers']),
+            chunk_standards=payload['chunk_standards'],
+            chunk_sections=payload['chunk_sections'],
+            index=BM25Index.from_dict(payload['index']) if len(chunks) else None,
+            previous_hash=payload['previous_hash'],
+            reused_chunks=payload['reused_chunks'],
+            signature=signature,
+        )
+
+    def warm(self) -> None:
+        """
+        Start loading the index on a background thread and return at once.
+        Safe to call any number of times, from any thread: loading runs once.
+        In dense and hybrid modes the dense index is loaded next; searches
+        use BM25 until it is ready.
+        """
+        with self._load_lock:
+            if self._loader is not None:
+                return
+            self._loader = threading.Thread(target=self._warm, name='kb-warm', daemon=True)
+            self._loader.start()
+
+    def _warm(self) -> None:
         try:
-            with open(pdf_path, 'rb') as file:
-                pdf_reader = PyPDF2.PdfReader(file)
-                total_pages = len(pdf_reader.pages)
-                pages_to_process = min(total_pages, max_pages)
-
-                failure_count = 0
-                max_failures = 5
-                for page_num in range(pages_to_process):
-                    try:
-                        page = pdf_reader.pages[page_num]
-                        # Wrap in try-catch to handle memory errors during extraction
-                        try:
-                            text = page.extract_text()
-                            if text and text.strip():
-                                text_content.append(
-                                    f"--- Page {page_num + 1} ---\n{text}")
-                                failure_count = 0  # Reset on success
-                        except (MemoryError, SystemExit) as e:
-                            # Critical memory/system errors - stop immediately
-                            print(
-                                f"Critical error extracting page {page_num + 1}: {e}")
-                            raise
-                        except Exception as e:
-                            failure_count += 1
-                            if failure_count >= max_failures:
-                                print(
-                                    f"Too many extraction failures ({failure_count}), stopping")
-                                break
-                            continue
-                    except (MemoryError, SystemExit) as e:
-                        # Critical errors - stop processing
-                        raise
-                    except Exception as e:
-                        failure_count += 1
-                        if failure_count >= max_failures:
-                            print(
-                                f"Too many page failures ({failure_count}), stopping")
-                            break
-                        continue
-
-                if pages_to_process < total_pages:
-                    print(
-                        f"Warning: Processed only first {pages_to_process} of {total_pages} pages to save memory")
-        except (MemoryError, SystemExit) as e:
-            # Don't catch these - let them propagate
-            raise
+            self._load_once()
+            if self.index is not None and self.retrieval in ('dense', 'hybrid'):
+                self._ensure_dense(self._state)
+        finally:
+            self._warm_done.set()
+
+    def _load_once(self) -> None:
+        """Load, chunk and index the content (runs on the warm() thread)."""
+        start = time.perf_counter()
+        try:
+            print("Loading AAOIFI Standards content...")
+            self._state = self._build_state()
+            if self._state.index is None:
+                print("Warning: Content is empty")
+        except (MemoryError, SystemExit, KeyboardInterrupt) as e:
+            # Critical errors - mark as failed and don't retry
+            print(f"Critical error loading PDF: {e}")
         except Exception as e:
-            raise Exception(f"Failed to load PDF: {e}")
+            print(f"Error loading PDF: {e}")
+        finally:
+            self.load_seconds = time.perf_counter() - start
+            self._loaded.set()  # Never retry a failed load
+
+    @property
+    def is_ready(self) -> bool:
+        """True once loading has finished (whether or not it succeeded)."""
+        return self._loaded.is_set()
+
+    def wait_ready(self, timeout: Optional[float] = None) -> bool:
+        """
+        Start loading if needed and wait for it to finish.
+
+        :param timeout: Seconds to wait (None: no limit)
+        :return: True if there is an index to search
+        """
+        if not self._loaded.is_set():
+            self.warm()
+            if not self._loaded.wait(timeout):
+                return False
+        return self.index is not None
 
-        if not text_content:
-            raise Exception("No text could be extracted from PDF")
+    def _ensure_loaded(self) -> bool:
+        """
+        Wait (up to ready_timeout) for the index on behalf of a search.
+        Returns True if there is an index to search.
+        """
+        with span('kb_wait'):
+            ready = self.wait_ready(self.ready_timeout)
+        if ready:
+            self._check_for_changes()
+            return True
+        if not self._loaded.is_set():
+            KB_NOT_READY.inc()
+        return False
 
-        return "\n\n".join(text_content)
+    def _check_for_changes(self) -> None:
+        """
+        At most every reload_interval, check whether the text file or the
+        artifact was replaced on disk, and if so reload on a background
+        thread. Searches keep using the current state meanwhile.
+        """
+        if not self.reload_interval or self._state.signature is None:
+            return
+        now = time.monotonic()
+        if now < self._next_reload_check:
+            return
+        with self._load_lock:
+            if now < self._next_reload_check or (self._reloader is not None and self._reloader.is_alive()):
+                return
+            self._next_reload_check = now + self.reload_interval
+            if self._files_signature() == self._state.signature:
+                return
+            self._reloader = threading.Thread(target=self.reload, name='kb-reload', daemon=True)
+            self._reloader.start()
 
-    def _extract_with_pdfplumber(self) -> str:
-        """Extract text using pdfplumber (better for complex PDFs)."""
-        import pdfplumber
+    def reload(self) -> bool:
+        """
+        Load the text file and artifact from disk again and swap them in.
 
-        text_content = []
-        max_pages = 50  # Reduced to prevent memory issues
+        A changed text file is re-indexed incrementally. The dense index (if
+        in use) is loaded before the swap, so searches never fall back to BM25
+        on the way. On any error the current state stays in use.
 
-        pdf_path = Path(self.pdf_path)
+        :return: True if a new state was swapped in
+        """
+        current = self._state
         try:
-            with pdfplumber.open(pdf_path) as pdf:
-                total_pages = len(pdf.pages)
-                pages_to_process = min(total_pages, max_pages)
-
-                failure_count = 0
-                max_failures = 5
-                for page_num in range(pages_to_process):
-                    try:
-                        page = pdf.pages[page_num]
-                        # Wrap in try-catch to handle memory errors during extraction
-                        try:
-                            text = page.extract_text()
-                            if text and text.strip():
-                                text_content.append(
-                                    f"--- Page {page_num + 1} ---\n{text}")
-                                failure_count = 0  # Reset on success
-                        except (MemoryError, SystemExit) as e:
-                            # Critical memory/system errors - stop immediately
-                            print(
-                                f"Critical error extracting page {page_num + 1}: {e}")
-                            raise
-                        except Exception as e:
-                            failure_count += 1
-                            if failure_count >= max_failures:
-                                print(
-                                    f"Too many extraction failures ({failure_count}), stopping")
-                                break
-                            continue
-                    except (MemoryError, SystemExit) as e:
-                        # Critical errors - stop processing
-                        raise
-                    except Exception as e:
-                        failure_count += 1
-                        if failure_count >= max_failures:
-                            print(
-                                f"Too many page failures ({failure_count}), stopping")
-                            break
-                        continue
-
-                if pages_to_process < total_pages:
-                    print(
-                        f"Warning: Processed only first {pages_to_process} of {total_pages} pages to save memory")
-        except (MemoryError, SystemExit) as e:
-            # Don't catch these - let them propagate
-            raise
+            state = self._build_state(reloading=True)
+            if state is None or state.index is None:
+                print("Warning: reloaded knowledge base is empty, keeping the current index")
+                KB_RELOADS.inc(result='error')
+                return False
+            if state.source_hash == current.source_hash:
+                state.dense, state.dense_attempted = current.dense, current.dense_attempted
+            elif current.dense_attempted:
+                self._ensure_dense(state)
         except Exception as e:
-            raise Exception(f"Failed to load PDF with pdfplumber: {e}")
+            print(f"Error reloading knowledge base: {e}, keeping the current index")
+            KB_RELOADS.inc(result='error')
+            return False
 
-        if not text_content:
-            raise Exception("No text could be extracted from PDF")
+        self._state = state
+        if state.source_hash != current.source_hash:
+            self.context_cache.clear()
+            print(f"✓ Knowledge base reloaded ({len(state.chunks)} chunks)")
+            KB_RELOADS.inc(result='swapped')
+        else:
+            KB_RELOADS.inc(result='unchanged')
+        return True
 
-        return "\n\n".join(text_content)
+    def status(self) -> Dict[str, object]:
+        """Loading state for readiness checks: idle, loading, ready or unavailable."""
+        if self._loaded.is_set():
+            state = 'ready' if self.index is not None else 'unavailable'
+        elif self._loader is not None:
+            state = 'loading'
+        else:
+            state = 'idle'
+        return {
+            'state': state,
+            'source': self.source,
+            'chunks': len(self.chunks),
+            'retrieval': self.retrieval,
+            'dense_loaded': self.dense is not None,
+            'source_hash': self.source_hash[:12] if self.source_hash else None,
+            'load_seconds': round(self.load_seconds, 3) if self.load_seconds is not None else None,
+        }
 
-    def chunk_text(self, text: str, chunk_size: int = 1000, overlap: int = 200) -> List[str]:
+    def _ensure_dense(self, state: IndexState) -> bool:
         """
-        Split text into overlapping chunks for better search.
+        Load (or build and save) the dense index of a state on first use.
+        Returns False if dense retrieval is unavailable, in which case
+        search falls back to BM25.
+        """
+        if not state.dense_attempted:
+            with self._dense_lock:
+                if not state.dense_attempted:
+                    # Other threads search with BM25 until this finishes
+                    state.dense_attempted = True
+                    self._load_dense(state)
 
-        :param text: The text to chunk
-        :param chunk_size: Size of each chunk in characters
-        :param overlap: Overlap between chunks in characters
-        :return: List of text chunks
+        return state.dense is not None
+
+    def _load_dense(self, state: IndexState) -> None:
         """
-        chunks = []
-        start = 0
+        Load the dense index of a state, or update or build (and save) it;
+        leaves state.dense None on failure.
 
-        while start < len(text):
-            end = start + chunk_size
-            chunk = text[start:end]
-            chunks.append(chunk)
-            start = end - overlap  # Overlap for context
+        If the artifact was updated from an earlier text whose dense index is
+        still on disk, embeddings of the chunks it kept are carried over and
+        only the new chunks are embedded.
+        """
+        try:
+            from src.dense_index import DenseIndex, dense_paths
+            from src.embeddings import get_embedder
 
-        return chunks
+            embedder = get_embedder(self.embedder_name)
+            matrix_path, meta_path = dense_paths(self.artifact_path, embedder)
+            params = self._index_params()
+            on_disk = state.signature is not None
+            dense = None
+            if on_disk:
+                dense = DenseIndex.load(matrix_path, meta_path, embedder, state.source_hash, params)
+            if dense is None and on_disk and state.previous_hash is not None:
+                previous = DenseIndex.load(matrix_path, meta_path, embedder, state.previous_hash, params)
+                if previous is not None:
+                    new_chunks = [chunk_id for chunk_id, reused in enumerate(state.reused_chunks) if reused < 0]
+                    print(f"Updating dense index: embedding {len(new_chunks)} new chunks...")
+                    dense = DenseIndex.update(previous, state.reused_chunks,
+                                              (state.chunks[chunk_id] for chunk_id in new_chunks))
+                    self._save_dense(dense, matrix_path, meta_path, state.source_hash, params)
+            if dense is None:
+                print(f"Building dense index with the {embedder.name} embedder...")
+                dense = DenseIndex.build(embedder, state.chunks)
+                if on_disk:
+                    self._save_dense(dense, matrix_path, meta_path, state.source_hash, params)
+            state.dense = dense
+        except ImportError as e:
+            print(f"Dense retrieval unavailable ({e}), using BM25. Install numpy to enable it.")
+        except Exception as e:
+            print(f"Error loading dense index: {e}, using BM25")
 
-    def search(self, query: str, max_results: int = 3) -> List[Dict[str, str]]:
+    @staticmethod
+    def _save_dense(dense, matrix_path: Path, meta_path: Path, source_hash: str,
+                    params: Dict[str, object]) -> None:
+        try:
+            dense.save(matrix_path, meta_path, source_hash, params)
+        except OSError as e:
+            print(f"Warning: could not save dense index: {e}")
+
+    def load(self) -> bool:
+        """
+        Load the chunk store and index now and wait for them (and for the
+        dense index too in dense and hybrid retrieval modes).
+        Returns True if there is an index to search.
+        """
+        self.warm()
+        self._warm_done.wait()
+        return self.index is not None
+
+    def search(self, query: str, max_results: int = 3, standard: Optional[int] = None,
+               pages: Optional[Tuple[int, int]] = None) -> List[Dict[str, str]]:
         """
         Search for relevant content in the PDF.
-        Returns a list of relevant text chunks.
+        Returns the highest-scoring chunks ranked by BM25, by embedding
+        similarity in 'dense' mode, or by reciprocal-rank fusion of both in
+        'hybrid' mode.
+
+        Filters are applied before scoring: only the postings (and embedding
+        rows) of matching chunks are read.
 
         :param query: Search query
         :param max_results: Maximum number of results to return
-        :return: List of dictionaries with 'text' and 'page' info
+        :param standard: Only search chunks of this Shari'ah Standard number
+        :param pages: Only search chunks on pages (first, last), inclusive
+        :return: List of dictionaries with 'text', 'score', 'page' (first page),
+                 'page_range' (e.g. "53-54" for chunks spanning pages),
+                 'standard' (Shari'ah Standard number), 'section' (clause),
+                 the provenance: 'source' (document title), 'collection'
+                 and 'document' (file name), and 'span' (byte offsets
+                 in the text)
         """
-        if self.content is None:
-            try:
-                print("Loading AAOIFI Standards content...")
-                self.content = self.load_content()  # Uses text file if available
-                if not self.content:
-                    print("Warning: Content is empty")
-                    self.content = ""  # Mark as attempted
-                    self.chunks = []
-                    return []
-                self.chunks = self.chunk_text(self.content)
-            except (MemoryError, SystemExit, KeyboardInterrupt) as e:
-                # Critical errors - mark as failed and don't retry
-                print(f"Critical error loading PDF: {e}")
-                self.content = ""  # Mark as attempted to prevent retries
-                self.chunks = []
-                return []
-            except Exception as e:
-                print(f"Error loading PDF: {e}")
-                self.content = ""  # Mark as attempted to prevent retries
-                self.chunks = []
-                return []
-
-        query_lower = query.lower()
-        query_terms = query_lower.split()
-
-        # Score chunks based on term frequency
-        scored_chunks = []
-        for i, chunk in enumerate(self.chunks):
-            chunk_lower = chunk.lower()
-            score = sum(chunk_lower.count(term) for term in query_terms)
-            if score > 0:
-                # Extract page number if available
-                page_match = re.search(r'--- Page (\d+) ---', chunk)
-                page = page_match.group(1) if page_match else "Unknown"
-                scored_chunks.append({
-                    'text': chunk,
-                    'score': score,
-                    'page': page
-                })
-
-        # Sort by score and return top results
-        scored_chunks.sort(key=lambda x: x['score'], reverse=True)
-        return scored_chunks[:max_results]
-
-    def get_relevant_context(self, query: str, max_chars: int = 2000) -> str:
+        if not self._ensure_loaded():
+            return []
+        return self._search(self._state, query, max_results, standard, pages)
+
+    def retrieve(self, query: str, max_results: int = 5, standard: Optional[int] = None,
+                 pages: Optional[Tuple[int, int]] = None) -> Tuple[List[Dict], Optional[str], bool]:
+        """
+        search() for callers that memoize the results (see kb_registry).
+
+        :return: (results, content hash of the index searched, complete);
+                 complete is False if a hybrid retriever missed its budget,
+                 in which case the results shouldn't be cached
+        """
+        if not self._ensure_loaded():
+            return [], None, False
+        state = self._state
+        self._local.degraded = False
+        results = self._search(state, query, max_results, standard, pages)
+        return results, state.source_hash, not self._local.degraded
+
+    @span('search')
+    def retrieve_many(self, queries: Sequence[str], max_results: int = 5, standard: Optional[int] = None,
+                      pages: Optional[Tuple[int, int]] = None) -> Tuple[List[List[Dict]], Optional[str]]:
+        """
+        retrieve() for a batch of queries in one pass over one index state.
+
+        Filters are resolved once, and dense retrieval embeds and scores every
+        query together (see DenseIndex.search_many). Hybrid mode has no latency
+        budget here: batches are for throughput, so both retrievers always finish.
+
+        :return: (one result list per query, content hash of the index searched)
+        """
+        if not self._ensure_loaded():
+            return [[] for _ in queries], None
+        state = self._state
+        ranges = state.chunk_ranges(standard, pages)
+        if ranges is not None and not ranges:
+            return [[] for _ in queries], state.source_hash
+
+        if self.retrieval == 'hybrid' and self._ensure_dense(state):
+            depth = max(4 * max_results, 20)
+            dense_hits = self._dense_search_many(state, queries, depth, ranges)
+            hits = [reciprocal_rank_fusion([state.index.search(query, depth, ranges), dense],
+                                           top_k=max_results)
+                    for query, dense in zip(queries, dense_hits)]
+        elif self.retrieval == 'dense' and self._ensure_dense(state):
+            hits = self._dense_search_many(state, queries, max_results, ranges)
+        else:
+            hits = [state.index.search(query, top_k=max_results, ranges=ranges) for query in queries]
+
+        return [[self._result(state, chunk_id, score) for chunk_id, score in query_hits]
+                for query_hits in hits], state.source_hash
+
+    @span('search')
+    def _search(self, state: IndexState, query: str, max_results: int,
+                standard: Optional[int] = None, pages: Optional[Tuple[int, int]] = None) -> List[Dict]:
+        """search() against one state, which may already have been swapped out."""
+        ranges = state.chunk_ranges(standard, pages)
+        if ranges is not None and not ranges:
+            return []
+
+        if self.retrieval == 'hybrid' and self._ensure_dense(state):
+            hits = self._hybrid_search(state, query, max_results, ranges)
+        elif self.retrieval == 'dense' and self._ensure_dense(state):
+            hits = self._dense_search_many(state, [query], max_results, ranges)[0]
+        else:
+            # Score chunks with BM25 over the inverted index
+            hits = state.index.search(query, top_k=max_results, ranges=ranges)
+
+        return [self._result(state, chunk_id, score) for chunk_id, score in hits]
+
+    @staticmethod
+    def _dense_search_many(state: IndexState, queries: Sequence[str], top_k: int,
+                           ranges: Optional[List[Tuple[int, int]]] = None) -> List[List[Tuple[int, float]]]:
+        """
+        state.dense.search_many(), except that with a lexical embedder a query
+        sharing no word with the chunks gets no results: it would only score
+        on hash collisions, where BM25 finds nothing.
+        """
+        if state.dense.embedder.lexical:
+            known = [any(state.index.document_frequency(token) for token in tokenize(query))
+                     for query in queries]
+        else:
+            known = [True] * len(queries)
+        hits = iter(state.dense.search_many([q for q, k in zip(queries, known) if k], top_k, ranges))
+        return [next(hits) if k else [] for k in known]
+
+    def _hybrid_search(self, state: IndexState, query: str, max_results: int,
+                       ranges: Optional[List[Tuple[int, int]]] = None) -> List[Tuple[int, float]]:
+        """
+        Run BM25 and dense retrieval concurrently and fuse their rankings.
+
+        A retriever that misses the latency budget is dropped and the other's
+        results are used alone; only if both miss it do we wait for whichever
+        finishes first.
+        """
+        depth = max(4 * max_results, 20)  # Fuse deeper lists than we return
+        pool = _get_retrieval_pool()
+        futures = {
+            'lexical': pool.submit(state.index.search, query, depth, ranges),
+            'dense': pool.submit(lambda: self._dense_search_many(state, [query], depth, ranges)[0]),
+        }
+
+        on_time, _ = wait(futures.values(), timeout=self.retrieval_budget_ms / 1000)
+        done = on_time or wait(futures.values(), return_when=FIRST_COMPLETED)[0]
+
+        rankings = {}
+        for name, future in futures.items():
+            if future not in on_time:
+                HYBRID_OUTCOMES.inc(retriever=name, outcome='timeout')
+            if future not in done:
+                continue
+            if future.exception() is not None:
+                print(f"Warning: {name} retrieval failed: {future.exception()}")
+                HYBRID_OUTCOMES.inc(retriever=name, outcome='error')
+            else:
+                rankings[name] = future.result()
+        if len(rankings) < len(futures):
+            self._local.degraded = True  # Don't memoize a partial result
+
+        fused = reciprocal_rank_fusion(rankings.values(), top_k=max_results)
+        if fused:
+            # Credit the retriever(s) that ranked the top fused result highest
+            top_id = fused[0][0]
+            ranks = {name: next((rank for rank, (doc_id, _) in enumerate(ranking) if doc_id == top_id), depth)
+                     for name, ranking in rankings.items()}
+            best = min(ranks.values())
+            winners = [name for name, rank in ranks.items() if rank == best]
+            HYBRID_OUTCOMES.inc(retriever=winners[0] if len(winners) == 1 else 'both', outcome='win')
+        return fused
+
+    def _result(self, state: IndexState, chunk_id: int, score: float) -> Dict:
+        """Build a search result dict for a chunk."""
+        span = state.chunks.span(chunk_id)
+        first, last = state.pages.page_range(*span)
+        return {
+            'text': state.chunks[chunk_id],
+            'score': score,
+            'page': str(first) if first is not None else "Unknown",
+            'page_range': _page_label(first, last),
+            'standard': state.chunk_standards[chunk_id] or None,
+            'section': state.chunk_sections[chunk_id] or None,
+            'source': self.title,
+            'collection': self.name,
+            'document': Path(self.text_path if self.source == 'text' else self.pdf_path).name,
+            'span': span,
+        }
+
+    def get_relevant_context(self, query: str, max_chars: int = 2000, standard: Optional[int] = None,
+                             pages: Optional[Tuple[int, int]] = None, max_tokens: Optional[int] = None,
+                             model: Optional[str] = None) -> str:
         """
         Get relevant context from the PDF for a given query.
         Returns formatted text that can be added to the prompt.
 
         :param query: The user's question or topic
         :param max_chars: Maximum characters to return
+        :param standard: Only use passages from this Shari'ah Standard number
+        :param pages: Only use passages on pages (first, last), inclusive
+        :param max_tokens: Token budget (in the tokens of ``model``); replaces max_chars
+        :param model: Model whose tokenizer counts max_tokens
         :return: Formatted context string
         """
-        results = self.search(query, max_results=5)
+        return self.get_relevant_context_with_sources(query, max_chars, standard, pages,
+                                                      max_tokens, model)[0]
+
+    def get_relevant_context_with_sources(self, query: str, max_chars: int = 2000,
+                                          standard: Optional[int] = None,
+                                          pages: Optional[Tuple[int, int]] = None,
+                                          max_tokens: Optional[int] = None,
+                                          model: Optional[str] = None) -> Tuple[str, List[Dict]]:
+        """
+        Like get_relevant_context, but also returns a citation for every
+        passage included in the context.
 
-        if not results:
-            return ""
+        :param query: The user's question or topic
+        :param max_chars: Maximum characters to return
+        :param standard: Only use passages from this Shari'ah Standard number
+        :param pages: Only use passages on pages (first, last), inclusive
+        :param max_tokens: Token budget (in the tokens of ``model``); replaces max_chars
+        :param model: Model whose tokenizer counts max_tokens
+        :return: (formatted context string, list of citation dicts with
+                 'source', 'collection', 'document', 'page', 'standard' and 'section')
+        """
+        if not self._ensure_loaded():
+            return "", []
+
+        # Retries, double-submits and popular questions repeat exact queries
+        pages = tuple(pages) if pages is not None else None
+        state = self._state
+        token_counter = get_token_counter(model or "gpt-5.1") if max_tokens is not None else None
+        cache_key = ContextCache.key(query, context_budget(max_chars, max_tokens, token_counter),
+                                     state.source_hash, (standard, pages))
+        cached = self.context_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        self._local.degraded = False
+        results = self._search(state, query, PDF_CONTEXT_CANDIDATES, standard, pages)
+        context, citations = format_context(results, max_chars, max_tokens, token_counter)
+        if not self._local.degraded:
+            self.context_cache.put(cache_key, context, citations)
+        return context, citations
+
+
+def context_budget(max_chars: int, max_tokens: Optional[int] = None,
+                   token_counter: Optional[TokenCounter] = None) -> Tuple:
+    """The part of a context cache key describing the size limit."""
+    if max_tokens is None:
+        return ('chars', max_chars)
+    return ('tokens', max_tokens, token_counter.encoding_name)
 
-        context_parts = []
-        total_chars = 0
 
-        for result in results:
-            text = result['text']
-            page = result['page']
+@span('format_context')
+def format_context(results: List[Dict], max_chars: int = 2000, max_tokens: Optional[int] = None,
+                   token_counter: Optional[TokenCounter] = None) -> Tuple[str, List[Dict]]:
+    """
+    Format search results as prompt context, each passage headed by its
+    citation, e.g. "[AAOIFI Standards - Standard No. (1) 2/3 - Page 54]".
+
+    Text a better-ranked passage already covers is left out first (see
+    dedupe_results). With ``max_tokens``, passages are packed best first
+    into that many tokens: one that doesn't fit is cut at a sentence
+    boundary if enough of it fits, otherwise skipped for a shorter one.
+
+    :param results: Search results (see PDFKnowledgeBase.search), best first
+    :param max_chars: Maximum characters of passage text
+    :param max_tokens: Token budget for the whole context; replaces max_chars
+    :param token_counter: Counts max_tokens (required with it)
+    :return: (formatted context string, list of citation dicts)
+    """
+    context_parts = []
+    citations = []
+    total_chars = 0
+    total_tokens = 0
 
+    for result in dedupe_results(results):
+        text = result['text']
+        page = result.get('page_range', result['page'])
+        citation = result['source']
+        if result.get('standard'):
+            citation += f" - Standard No. ({result['standard']})"
+            if result.get('section'):
+                citation += f" {result['section']}"
+        header = f"[{citation} - Page {page}]\n"
+
+        if max_tokens is not None:
+            # Every passage after the first also pays for its separator
+            overhead = token_counter.count(("\n\n" if context_parts else "") + header)
+            tokens = overhead + token_counter.count(text)
+            if total_tokens + tokens > max_tokens:
+                room = max_tokens - total_tokens - overhead - 1  # 1 for the "..."
+                if room < MIN_PASSAGE_TOKENS:
+                    continue
+                text = token_counter.truncate(text, room) + "..."
+                tokens = overhead + token_counter.count(text)
+            total_tokens += tokens
+        elif total_chars + len(text) > max_chars:
             # Truncate if needed
-            if total_chars + len(text) > max_chars:
-                remaining = max_chars - total_chars
-                text = text[:remaining] + "..."
+            remaining = max_chars - total_chars
+            text = text[:remaining] + "..."
+
+        context_parts.append(header + text)
+        citations.append({
+            'source': result['source'],
+            'collection': result['collection'],
+            'document': result['document'],
+            'page': page,
+            'standard': result.get('standard'),
+            'section': result.get('section'),
+        })
+        total_chars += len(text)
+
+        if max_tokens is None and total_chars >= max_chars:
+            break
 
-            context_parts.append(f"[AAOIFI Standards - Page {page}]\n{text}")
-            total_chars += len(text)
+    return "\n\n".join(context_parts), citations
 
-            if total_chars >= max_chars:
-                break
 
-        return "\n\n".join(context_parts)
+def dedupe_results(results: List[Dict]) -> List[Dict]:
+    """
+    Search results without repeated text, best first.
+
+    Chunks overlap (and neighbouring chunks are often retrieved together), so
+    the parts of a passage that better-ranked passages of the same document
+    already cover are cut off, keeping the largest part left (a passage that
+    contains a better one keeps its longer side). A passage left with nothing
+    new is dropped, as is one whose text exactly repeats another's.
+    """
+    kept = []
+    seen = set()
+    covered: Dict[Tuple[str, str], List[Tuple[int, int]]] = {}
+    for result in results:
+        span = result.get('span')
+        if span is not None:
+            spans = covered.setdefault((result.get('collection'), result.get('document')), [])
+            part = _uncovered(tuple(span), spans)
+            if part is None:
+                continue
+            if part != tuple(span):
+                raw = result['text'].encode('utf-8')
+                # Spans are byte offsets: widen the cut to whole characters
+                first, last = part[0] - span[0], part[1] - span[0]
+                while first > 0 and _is_continuation(raw[first]):
+                    first -= 1
+                while last < len(raw) and _is_continuation(raw[last]):
+                    last += 1
+                part = (span[0] + first, span[0] + last)
+                result = dict(result, text=raw[first:last].decode('utf-8').strip(), span=part)
+            spans.append(part)
+
+        normalized = " ".join(result['text'].lower().split())
+        if not normalized or normalized in seen:
+            continue
+        seen.add(normalized)
+        kept.append(result)
+    return kept
+
+
+def _uncovered(span: Tuple[int, int], spans: List[Tuple[int, int]]) -> Optional[Tuple[int, int]]:
+    """The largest part of ``span`` that none of ``spans`` overlaps, or None."""
+    parts = [span]
+    for kept_start, kept_end in spans:
+        remaining = []
+        for start, end in parts:
+            if kept_end <= start or end <= kept_start:
+                remaining.append((start, end))
+                continue
+            if start < kept_start:
+                remaining.append((start, kept_start))
+            if kept_end < end:
+                remaining.append((kept_end, end))
+        parts = remaining
+    return max(parts, key=lambda part: part[1] - part[0], default=None)
+
+
+def _is_continuation(byte: int) -> bool:
+    """Whether a UTF-8 byte continues a multi-byte character (10xxxxxx)."""
+    return byte & 0xC0 == 0x80
 
 
-# Global instance
-_knowledge_base = None
+def _runs(values: Sequence[int]) -> List[Tuple[int, int, int]]:
+    """(value, start, end) for each run of equal consecutive values."""
+    runs = []
+    start = 0
+    for position in range(1, len(values) + 1):
+        if position == len(values) or values[position] != values[start]:
+            runs.append((values[start], start, position))
+            start = position
+    return runs
+
+
+def _intersect(a: List[Tuple[int, int]], b: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """Intersection of two sorted lists of [start, end) ranges."""
+    result = []
+    i = j = 0
+    while i < len(a) and j < len(b):
+        start, end = max(a[i][0], b[j][0]), min(a[i][1], b[j][1])
+        if start < end:
+            result.append((start, end))
+        if a[i][1] < b[j][1]:
+            i += 1
+        else:
+            j += 1
+    return result
+
+
+def _page_label(first: Optional[int], last: Optional[int]) -> str:
+    """Human-readable page citation, e.g. "53" or "53-54"."""
+    if first is None:
+        return "Unknown"
+    if last is None or last == first:
+        return str(first)
+    return f"{first}-{last}"
+
+
+def get_context_cache_stats() -> Dict[str, object]:
+    """
+    Retrieval context cache stats over all collections: entries,
+    approximate memory footprint in bytes, hits, misses and hit ratio.
+    Empty if PDF is disabled or the knowledge base server holds the cache.
+    """
+    if not PDF_ENABLED or _kb_client() is not None:
+        return {}
+    from src.kb_registry import get_registry
+
+    return get_registry().context_cache_stats()
+
+
+def _context_cache_gauge(field: str) -> Dict[Tuple, float]:
+    stats = get_context_cache_stats()
+    return {(): stats[field]} if stats else {}
+
+
+CONTEXT_CACHE_ENTRIES.set_function(lambda: _context_cache_gauge('entries'))
+CONTEXT_CACHE_BYTES.set_function(lambda: _context_cache_gauge('bytes'))
+
+
+def _kb_client():
+    """The knowledge base server client, if this worker queries one (see kb_server)."""
+    from src.kb_server import get_client
+
+    return get_client()
 
 
 def get_knowledge_base() -> PDFKnowledgeBase:
-    """Get or create the global knowledge base instance."""
-    global _knowledge_base
-    if _knowledge_base is None:
-        _knowledge_base = PDFKnowledgeBase()
-    return _knowledge_base
+    """The global knowledge base: the first collection of the registry (see kb_registry)."""
+    from src.kb_registry import get_registry
 
+    return get_registry().default
 
-def get_aaoifi_context(query: str, max_chars: int = 2000) -> str:
+
+def warm_knowledge_base() -> Optional[PDFKnowledgeBase]:
+    """
+    Start loading every collection in the background, so the first
+    question doesn't pay for it. Call once per worker process, after fork
+    (see gunicorn.conf.py). Does nothing if PDF is disabled or the
+    knowledge base server loads it.
+    """
+    if not PDF_ENABLED or _kb_client() is not None:
+        return None
+    from src.kb_registry import get_registry
+
+    registry = get_registry()
+    registry.warm()
+    return registry.default
+
+
+def get_knowledge_base_status() -> Dict[str, object]:
+    """Loading state of the collections (see KnowledgeBaseRegistry.status)."""
+    if not PDF_ENABLED:
+        return {'state': 'disabled'}
+    client = _kb_client()
+    if client is not None:
+        try:
+            return client.status()
+        except Exception as e:
+            # Not started yet (or restarting): not ready, as while loading
+            return {'state': 'connecting', 'error': str(e)}
+    from src.kb_registry import get_registry
+
+    return get_registry().status()
+
+
+def get_aaoifi_context(query: str, max_chars: int = 2000, **filters) -> str:
     """
     Convenience function to get AAOIFI context for a query.
     Returns empty string if PDF cannot be loaded (graceful failure).
 
     :param query: The user's question
     :param max_chars: Maximum characters to return
+    :param filters: collections, standard, pages, max_tokens and/or model
+                    (see KnowledgeBaseRegistry.get_relevant_context_with_sources)
     :return: Formatted context string (empty if PDF unavailable)
     """
-    # Check if PDF is disabled via environment variable
+    return get_aaoifi_context_with_sources(query, max_chars, **filters)[0]
+
+
+def get_aaoifi_context_with_sources(query: str, max_chars: int = 2000,
+                                    collections: Optional[Sequence[str]] = None,
+                                    standard: Optional[int] = None,
+                                    pages: Optional[Tuple[int, int]] = None,
+                                    max_tokens: Optional[int] = None,
+                                    model: Optional[str] = None) -> Tuple[str, List[Dict]]:
+    """
+    Like get_aaoifi_context, but also returns citations for the passages used.
+    Searches every configured collection unless ``collections`` names some,
+    on the knowledge base server if KB_SERVER_SOCKET is set (see kb_server).
+    Returns ("", []) if PDF is disabled or cannot be loaded.
+
+    :param query: The user's question
+    :param max_chars: Maximum characters to return
+    :param collections: Names of the collections to search (default: all)
+    :param standard: Only use passages from this Shari'ah Standard number
+    :param pages: Only use passages on pages (first, last), inclusive
+    :param max_tokens: Token budget (in the tokens of ``model``); replaces max_chars
+    :param model: Model whose tokenizer counts max_tokens
+    :return: (formatted context string, list of citation dicts)
+    """
     if not PDF_ENABLED:
-        return ""
+        return "", []
 
     try:
-        kb = get_knowledge_base()
-        return kb.get_relevant_context(query, max_chars)
+        client = _kb_client()
+        if client is not None:
+            return client.context(query, max_chars, collections=collections, standard=standard,
+                                  pages=pages, max_tokens=max_tokens, model=model)
+
+        from src.kb_registry import get_registry
+
+        return get_registry().get_relevant_context_with_sources(
+            query, max_chars, collections=collections, standard=standard, pages=pages,
+            max_tokens=max_tokens, model=model)
+    except Exception as e:
+        print(f"Warning: Could not get AAOIFI context: {e}")
+        return "", []
+
+
+def get_aaoifi_contexts_with_sources(queries: Sequence[str], max_chars: int = 2000,
+                                     collections: Optional[Sequence[str]] = None,
+                                     standard: Optional[int] = None,
+                                     pages: Optional[Tuple[int, int]] = None,
+                                     max_tokens: Optional[int] = None,
+                                     model: Optional[str] = None) -> List[Tuple[str, List[Dict]]]:
+    """
+    get_aaoifi_context_with_sources() for a batch of queries, retrieved in
+    one pass (see KnowledgeBaseRegistry.get_relevant_contexts_with_sources).
+    Returns ("", []) for every query if PDF is disabled or cannot be loaded.
+
+    :return: One (formatted context string, list of citation dicts) per query
+    """
+    if not PDF_ENABLED:
+        return [("", []) for _ in queries]
+
+    try:
+        client = _kb_client()
+        if client is not None:
+            return client.contexts(list(queries), max_chars, collections=collections, standard=standard,
+                                   pages=pages, max_tokens=max_tokens, model=model)
+
+        from src.kb_registry import get_registry
+
+        return get_registry().get_relevant_contexts_with_sources(
+            queries, max_chars, collections=collections, standard=standard, pages=pages,
+            max_tokens=max_tokens, model=model)
     except Exception as e:
         print(f"Warning: Could not get AAOIFI context: {e}")
-        return ""  # Return empty string to allow app to continue without PDF
+        return [("", []) for _ in queries]
@@ -0,0 +1,194 @@
+"""
+Opt-in profiling of production /ask requests.
+
+A request is profiled if it is picked at random (PROFILE_SAMPLE_RATE, e.g.
+0.01 for 1%) or sends an "X-Profile: <PROFILE_TOKEN>" header. The header
+profiles a slow question on demand, without a restart. Each profile is
+written to PROFILE_DIR, named after the time and the request ID:
+
+  - 'sample' mode (default): a thread samples the request thread's stack
+    every PROFILE_INTERVAL_MS and writes the counts as collapsed stacks
+    (<time>-<request id>.collapsed), one "frame;frame;... count" line per
+    stack. Overhead is a few percent and independent of how many Python
+    calls the request makes. Render with flamegraph.pl or speedscope.
+  - 'cprofile' mode: deterministic cProfile of the request thread, written
+    as pstats (<time>-<request id>.pstats). Exact call counts, but it slows
+    call-heavy code down several times. View with snakeviz or pstats.
+
+One request per process is profiled at a time (cProfile can't run twice at
+once); requests picked while another is being profiled go unprofiled.
+Under ASGI the request's thread is the event loop's, so its profile also
+includes the other requests the loop runs meanwhile.
+Only the newest PROFILE_MAX_FILES profiles are kept.
+"""
+
+import cProfile
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter as StackCounts
+from pathlib import Path
+from typing import Optional
+
+from src.metrics import counter
+
+PROJECT_ROOT = Path(__file__).parent.parent.resolve()
+
+PROFILE_MODES = ('sample', 'cprofile')
+
+# Fraction of /ask requests profiled at random (0: only on request, see PROFILE_TOKEN)
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_MODE = os.getenv('PROFILE_MODE', 'sample').lower()
+PROFILE_INTERVAL_MS = float(os.getenv('PROFILE_INTERVAL_MS', '5'))
+PROFILE_DIR = Path(os.getenv('PROFILE_DIR', str(PROJECT_ROOT / 'data' / 'profiles')))
+PROFILE_MAX_FILES = int(os.getenv('PROFILE_MAX_FILES', '500'))
+
+# Requests with the header "X-Profile: <PROFILE_TOKEN>" are always profiled
+# (unset: the header is ignored)
+PROFILE_TOKEN = os.getenv('PROFILE_TOKEN', '')
+
+PROFILES = counter(
+    'advisor_profiles_total',
+    'Requests picked for profiling, by mode and result (written, busy, error)',
+    ('mode', 'result'),
+)
+
+# One profile at a time per process
+_busy = threading.Lock()
+
+
+def _frame_name(code) -> str:
+    filename = code.co_filename
+    try:
+        filename = str(Path(filename).resolve().relative_to(PROJECT_ROOT))
+    except ValueError:
+        filename = Path(filename).name
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """Counts the stacks of one thread, sampled at a fixed interval by a background thread."""
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: StackCounts = StackCounts()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        names = {}  # Code object -> frame name, so each is formatted once
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                name = names.get(code)
+                if name is None:
+                    name = names[code] = _frame_name(code)
+                stack.append(name)
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+                self.samples += 1
+
+    def write(self, path: Path) -> None:
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class RequestProfile:
+    """The profile of one request on the current thread: start(), then stop() to write it."""
+
+    def __init__(self, request_id: str, mode: str = PROFILE_MODE):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profile mode {mode!r}, expected one of {PROFILE_MODES}")
+        self.request_id = request_id
+        self.mode = mode
+        self.path: Optional[Path] = None
+        self._profiler = None
+
+    def start(self) -> None:
+        if self.mode == 'cprofile':
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        else:
+            self._profiler = StackSampler(threading.get_ident(), PROFILE_INTERVAL_MS / 1000)
+            self._profiler.start()
+
+    def stop(self) -> Optional[Path]:
+        """Stop profiling and write the profile; returns its path (None if writing failed)."""
+        if self.mode == 'cprofile':
+            self._profiler.disable()
+        else:
+            self._profiler.stop()
+
+        extension = 'pstats' if self.mode == 'cprofile' else 'collapsed'
+        path = PROFILE_DIR / f"{time.strftime('%Y%m%d-%H%M%S')}-{self.request_id}.{extension}"
+        try:
+            PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+            if self.mode == 'cprofile':
+                self._profiler.dump_stats(str(path))
+            else:
+                self._profiler.write(path)
+            _prune(PROFILE_DIR, PROFILE_MAX_FILES)
+        except OSError as e:
+            print(f"Warning: Could not write profile {path}: {e}")
+            PROFILES.inc(mode=self.mode, result='error')
+            return None
+        PROFILES.inc(mode=self.mode, result='written')
+        self.path = path
+        return path
+
+
+def _prune(directory: Path, keep: int) -> None:
+    """Delete all but the newest ``keep`` profiles."""
+    profiles = sorted((p for p in directory.iterdir() if p.suffix in ('.collapsed', '.pstats')),
+                      key=lambda p: p.stat().st_mtime)
+    for old in profiles[:max(0, len(profiles) - keep)]:
+        try:
+            old.unlink()
+        except OSError:
+            pass
+
+
+def start_profile(request_id: str, profile_header: Optional[str] = None) -> Optional[RequestProfile]:
+    """
+    Start profiling the current request if it is picked (see the module
+    docstring). Returns the running profile, or None; the caller must call
+    finish_profile() with it when the request is done.
+    """
+    requested = bool(PROFILE_TOKEN) and profile_header == PROFILE_TOKEN
+    if not requested and not (PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE):
+        return None
+    if not _busy.acquire(blocking=False):
+        PROFILES.inc(mode=PROFILE_MODE, result='busy')
+        return None
+    try:
+        profile = RequestProfile(request_id)
+        profile.start()
+    except Exception as e:
+        _busy.release()
+        print(f"Warning: Could not start profiler: {e}")
+        PROFILES.inc(mode=PROFILE_MODE, result='error')
+        return None
+    return profile
+
+
+def finish_profile(profile: RequestProfile) -> Optional[Path]:
+    """Stop a profile from start_profile() and write it; returns its path."""
+    try:
+        return profile.stop()
+    finally:
+        _busy.release()
@@ -0,0 +1,260 @@
+"""
+Inverted index with BM25 scoring for the AAOIFI knowledge base.
+
+The index is built once from the chunk list produced by PDFKnowledgeBase and
+maps each token to a postings list of (chunk id, term frequency) pairs, so a
+query only touches the postings of its own terms instead of every chunk.
+"""
+
+import heapq
+import math
+import re
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from operator import itemgetter
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+# Very common English words carry almost no BM25 weight but have the longest
+# postings lists, so they are dropped at both index and query time.
+STOPWORDS = frozenset("""
+a an and are as at be been but by can could do does for from had has have how
+i if in into is it its may me might my no not of on or our shall should so
+such than that the their them then there these they this those to was we were
+what when where whether which who will with would you your
+""".split())
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Split text into lowercase word tokens, dropping stopwords.
+
+    :param text: Text to tokenize
+    :return: List of tokens in document order
+    """
+    return [t for t in TOKEN_PATTERN.findall(text.lower()) if t not in STOPWORDS]
+
+
+class BM25Index:
+    """
+    An in-memory inverted index over a fixed list of documents (chunks).
+
+    Postings are stored CSR-style: the postings of term ``t`` are
+    ``doc_ids[offsets[t]:offsets[t + 1]]`` with matching ``tfs``. Flat
+    ``array('I')`` storage keeps the index compact and makes loading it from
+    the on-disk artifact close to a memcpy.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.terms: Dict[str, int] = {}
+        self.offsets = array('I', [0])
+        self.doc_ids = array('I')
+        self.tfs = array('I')
+        self.doc_lengths = array('I')
+        self.avg_doc_length = 0.0
+        # Per-document BM25 length normalisation: k1 * (1 - b + b * dl / avgdl)
+        self._norms = array('d')
+
+    @property
+    def num_docs(self) -> int:
+        return len(self.doc_lengths)
+
+    @property
+    def num_terms(self) -> int:
+        return len(self.terms)
+
+    @classmethod
+    def build(cls, documents: Iterable[str], k1: float = 1.5, b: float = 0.75) -> "BM25Index":
+        """
+        Build an index from an iterable of document strings.
+
+        :param documents: Documents in id order (document id = position)
+        :return: A ready-to-query BM25Index
+        """
+        index = cls(k1=k1, b=b)
+        postings: Dict[str, List[Tuple[int, int]]] = {}
+
+        for doc_id, text in enumerate(documents):
+            index._add_document(postings, doc_id, text)
+
+        index._set_postings(postings)
+        return index
+
+    @classmethod
+    def update(cls, previous: "BM25Index", reused: Sequence[int],
+               documents: Iterable[str]) -> "BM25Index":
+        """
+        Build an index that carries postings over from a previous one.
+
+        Documents that are unchanged keep their postings and lengths (with
+        their ids renumbered); only the new documents are tokenized.
+
+        :param previous: Index the reused documents come from
+        :param reused: For every document id of the new index, the previous
+                       id it is a copy of, or -1 for a new document
+        :param documents: Texts of the new (-1) documents, in id order
+        :return: A ready-to-query BM25Index with the same k1 and b
+        """
+        index = cls(k1=previous.k1, b=previous.b)
+        renumber = array('i', [-1]) * previous.num_docs
+        for doc_id, previous_id in enumerate(reused):
+            if previous_id >= 0:
+                renumber[previous_id] = doc_id
+
+        postings: Dict[str, List[Tuple[int, int]]] = {}
+        for term, term_id in previous.terms.items():
+            start, end = previous.offsets[term_id], previous.offsets[term_id + 1]
+            entries = [(renumber[doc_id], tf)
+                       for doc_id, tf in zip(previous.doc_ids[start:end], previous.tfs[start:end])
+                       if renumber[doc_id] >= 0]
+            if entries:
+                postings[term] = entries
+
+        documents = iter(documents)
+        for doc_id, previous_id in enumerate(reused):
+            if previous_id >= 0:
+                index.doc_lengths.append(previous.doc_lengths[previous_id])
+            else:
+                index._add_document(postings, doc_id, next(documents))
+
+        for entries in postings.values():
+            entries.sort()  # New documents were appended after the carried-over ones
+        index._set_postings(postings)
+        return index
+
+    def _add_document(self, postings: Dict[str, List[Tuple[int, int]]], doc_id: int, text: str) -> None:
+        counts = Counter(tokenize(text))
+        self.doc_lengths.append(sum(counts.values()))
+        for token, tf in counts.items():
+            postings.setdefault(token, []).append((doc_id, tf))
+
+    def _set_postings(self, postings: Dict[str, List[Tuple[int, int]]]) -> None:
+        """Lay out per-term postings lists as CSR arrays."""
+        for term_id, (token, entries) in enumerate(postings.items()):
+            self.terms[token] = term_id
+            for doc_id, tf in entries:
+                self.doc_ids.append(doc_id)
+                self.tfs.append(tf)
+            self.offsets.append(len(self.doc_ids))
+
+        self._finalize()
+
+    def to_dict(self) -> Dict:
+        """Plain-data representation used by the on-disk artifact."""
+        return {
+            'k1': self.k1,
+            'b': self.b,
+            'terms': list(self.terms),
+            'offsets': self.offsets,
+            'doc_ids': self.doc_ids,
+            'tfs': self.tfs,
+            'doc_lengths': self.doc_lengths,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "BM25Index":
+        """Rebuild an index from to_dict() output."""
+        index = cls(k1=data['k1'], b=data['b'])
+        index.terms = {term: term_id for term_id, term in enumerate(data['terms'])}
+        index.offsets = data['offsets']
+        index.doc_ids = data['doc_ids']
+        index.tfs = data['tfs']
+        index.doc_lengths = data['doc_lengths']
+        index._finalize()
+        return index
+
+    def _finalize(self) -> None:
+        """Compute the average document length and per-document norms."""
+        total = sum(self.doc_lengths)
+        self.avg_doc_length = total / len(self.doc_lengths) if self.doc_lengths else 0.0
+        avgdl = self.avg_doc_length or 1.0
+        self._norms = array('d', (
+            self.k1 * (1 - self.b + self.b * length / avgdl)
+            for length in self.doc_lengths
+        ))
+
+    def _postings_spans(self, term_id: int,
+                        ranges: Optional[Sequence[Tuple[int, int]]]) -> List[Tuple[int, int]]:
+        """Slices of a term's postings whose document ids fall in ranges (all if None)."""
+        start, end = self.offsets[term_id], self.offsets[term_id + 1]
+        if ranges is None:
+            return [(start, end)]
+        spans = []
+        for low, high in ranges:
+            span_start = bisect_left(self.doc_ids, low, start, end)
+            span_end = bisect_left(self.doc_ids, high, span_start, end)
+            if span_end > span_start:
+                spans.append((span_start, span_end))
+        return spans
+
+    def document_frequency(self, token: str) -> int:
+        term_id = self.terms.get(token)
+        if term_id is None:
+            return 0
+        return self.offsets[term_id + 1] - self.offsets[term_id]
+
+    def idf(self, token: str) -> float:
+        """BM25 inverse document frequency (always non-negative)."""
+        df = self.document_frequency(token)
+        if df == 0:
+            return 0.0
+        return math.log(1 + (self.num_docs - df + 0.5) / (df + 0.5))
+
+    def search(self, query: str, top_k: int = 3,
+               ranges: Optional[Sequence[Tuple[int, int]]] = None) -> List[Tuple[int, float]]:
+        """
+        Score documents against a query.
+
+        :param query: Free-text query
+        :param top_k: Number of results to return
+        :param ranges: Only score documents in these [start, end) id ranges.
+                       Postings are sorted by document id, so each range is
+                       found by bisection and postings outside it are never read
+        :return: List of (doc_id, score) pairs, best first
+        """
+        query_terms = Counter(tokenize(query))
+        if not query_terms or top_k <= 0:
+            return []
+
+        k1 = self.k1
+        norms = self._norms
+        scores: Dict[int, float] = {}
+
+        for term, qtf in query_terms.items():
+            term_id = self.terms.get(term)
+            if term_id is None:
+                continue
+            weight = self.idf(term) * qtf
+            for start, end in self._postings_spans(term_id, ranges):
+                for doc_id, tf in zip(self.doc_ids[start:end], self.tfs[start:end]):
+                    scores[doc_id] = scores.get(doc_id, 0.0) + \
+                        weight * tf * (k1 + 1) / (tf + norms[doc_id])
+
+        return heapq.nlargest(top_k, scores.items(), key=itemgetter(1))
+
+
+def reciprocal_rank_fusion(rankings: Iterable[List[Tuple[int, float]]], k: int = 60,
+                           top_k: Optional[int] = None) -> List[Tuple[int, float]]:
+    """
+    Fuse several ranked result lists with reciprocal-rank fusion.
+
+    Each document scores ``sum(1 / (k + rank))`` over the lists it appears in
+    (rank starting at 1), so only ranks matter and retrievers with
+    incomparable score scales can be combined.
+
+    :param rankings: Ranked (doc_id, score) lists, best first
+    :param k: Damping constant (60 in the original RRF paper)
+    :param top_k: Number of fused results to return (None for all)
+    :return: List of (doc_id, fused score) pairs, best first
+    """
+    fused: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, (doc_id, _) in enumerate(ranking, start=1):
+            fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (k + rank)
+
+    ordered = sorted(fused.items(), key=itemgetter(1), reverse=True)
+    return ordered if top_k is None else ordered[:top_k]
@@ -0,0 +1,426 @@
+"""
+Server-side conversation sessions.
+
+Instead of resending the whole chat history with every question, a client
+sends a session ID and the advisor rebuilds the history from the session
+store. A session is an append-only log of turns (the question as asked,
+without the retrieved context, and the answer) plus a rolling summary.
+Once the turns not yet summarized exceed SESSION_SUMMARY_TOKENS, all but
+the last SESSION_KEEP_TURNS are folded into the summary by a background
+model call and dropped from the log. The history sent to the model is the
+summary followed by the recent turns, so it stays bounded however long the
+conversation runs.
+
+Sessions expire after SESSION_TTL seconds without activity, and the least
+recently used are evicted beyond SESSION_MAX_SESSIONS.
+
+Backends (SESSION_STORE env var):
+
+  - memory: per-process LRU dict (default); with several workers, a
+            session only lives in the worker that served it, so
+            gunicorn.conf.py makes sqlite the default for more than one
+  - sqlite: on-disk tables shared by every worker on the host, with turns
+            stored zlib-compressed
+  - off:    sessions disabled (session IDs are ignored)
+"""
+
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from src.metrics import counter, gauge
+from src.token_budget import get_token_counter
+
+BACKENDS = ('memory', 'sqlite')
+
+SESSION_STORE = os.getenv('SESSION_STORE', 'memory').lower()
+SESSION_TTL = int(os.getenv('SESSION_TTL', str(24 * 3600)))
+SESSION_MAX_SESSIONS = int(os.getenv('SESSION_MAX_SESSIONS', '10000'))
+SESSION_STORE_PATH = os.getenv(
+    'SESSION_STORE_PATH', str(Path(__file__).parent.parent / "data" / "sessions.sqlite3"))
+
+# Summarize once the unsummarized turns exceed this many tokens, keeping the
+# most recent turns verbatim
+SESSION_SUMMARY_TOKENS = int(os.getenv('SESSION_SUMMARY_TOKENS', '2000'))
+SESSION_KEEP_TURNS = int(os.getenv('SESSION_KEEP_TURNS', '3'))
+SESSION_SUMMARY_MODEL = os.getenv('SESSION_SUMMARY_MODEL', 'gpt-5-mini')
+
+SUMMARY_PROMPT = """You maintain the running summary of a conversation between a user and \
+TYC - Islamic Finance Advisor. Merge the previous summary and the new turns into one \
+updated summary of at most 200 words. Keep the user's situation and goals, the products \
+and AAOIFI standards discussed, and the conclusions reached; drop pleasantries and \
+repetition. Reply with the summary only."""
+
+SESSION_SUMMARIES = counter(
+    'advisor_session_summaries_total',
+    'Rolling session summaries by result (ok, error)',
+    ('result',),
+)
+SESSIONS = gauge('advisor_sessions', 'Conversation sessions held by the session store', ('backend',))
+
+_SESSION_ID = re.compile(r"[A-Za-z0-9_-]{1,128}")
+
+# (sequence number, question, answer)
+Turn = Tuple[int, str, str]
+
+
+def new_session_id() -> str:
+    """A random, unguessable session ID."""
+    return uuid.uuid4().hex
+
+
+def is_valid_session_id(session_id) -> bool:
+    """Session IDs are 1-128 letters, digits, '-' or '_'."""
+    return isinstance(session_id, str) and _SESSION_ID.fullmatch(session_id) is not None
+
+
+class Session:
+    """A session's rolling summary and the turns after it."""
+
+    __slots__ = ('session_id', 'summary', 'turns')
+
+    def __init__(self, session_id: str, summary: str = "", turns: Optional[List[Turn]] = None):
+        self.session_id = session_id
+        self.summary = summary
+        self.turns = turns or []
+
+
+class SessionBackend:
+    """Storage for sessions: a summary and an append-only turn log each."""
+
+    name = "base"
+
+    def get(self, session_id: str) -> Optional[Session]:
+        """The session (refreshing its TTL), or None if unknown or expired."""
+        raise NotImplementedError
+
+    def append(self, session_id: str, question: str, answer: str) -> None:
+        """Log a turn, creating the session if needed."""
+        raise NotImplementedError
+
+    def compact(self, session_id: str, summary: str, through: int) -> None:
+        """Replace the summary and drop the turns it now covers (sequence <= through)."""
+        raise NotImplementedError
+
+    def delete(self, session_id: str) -> None:
+        raise NotImplementedError
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+
+class _Record:
+    __slots__ = ('summary', 'turns', 'next_seq', 'expires_at')
+
+    def __init__(self, expires_at: float):
+        self.summary = ""
+        self.turns: List[Turn] = []
+        self.next_seq = 1
+        self.expires_at = expires_at
+
+
+class MemoryBackend(SessionBackend):
+    """Per-process LRU dict."""
+
+    name = "memory"
+
+    def __init__(self, max_sessions: int = 10000, ttl: int = SESSION_TTL):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions: "OrderedDict[str, _Record]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _live(self, session_id: str) -> Optional[_Record]:
+        record = self._sessions.get(session_id)
+        if record is None:
+            return None
+        now = time.time()
+        if record.expires_at <= now:
+            del self._sessions[session_id]
+            return None
+        record.expires_at = now + self.ttl
+        self._sessions.move_to_end(session_id)
+        return record
+
+    def get(self, session_id: str) -> Optional[Session]:
+        with self._lock:
+            record = self._live(session_id)
+            if record is None:
+                return None
+            return Session(session_id, record.summary, list(record.turns))
+
+    def append(self, session_id: str, question: str, answer: str) -> None:
+        with self._lock:
+            record = self._live(session_id)
+            if record is None:
+                record = self._sessions[session_id] = _Record(time.time() + self.ttl)
+            record.turns.append((record.next_seq, question, answer))
+            record.next_seq += 1
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def compact(self, session_id: str, summary: str, through: int) -> None:
+        with self._lock:
+            record = self._sessions.get(session_id)
+            if record is None:
+                return
+            record.summary = summary
+            record.turns = [turn for turn in record.turns if turn[0] > through]
+
+    def delete(self, session_id: str) -> None:
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+
+class SQLiteBackend(SessionBackend):
+    """
+    Sessions in a SQLite file (WAL mode), shared by all worker processes on
+    the host and kept across restarts.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path: str, max_sessions: int = 10000, ttl: int = SESSION_TTL):
+        self.path = path
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=5.0)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                " id TEXT PRIMARY KEY, summary TEXT NOT NULL, next_seq INTEGER NOT NULL,"
+                " expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS sessions_accessed ON sessions (accessed_at)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS turns ("
+                " session_id TEXT NOT NULL, seq INTEGER NOT NULL,"
+                " question BLOB NOT NULL, answer BLOB NOT NULL,"
+                " PRIMARY KEY (session_id, seq)) WITHOUT ROWID"
+            )
+
+    def get(self, session_id: str) -> Optional[Session]:
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT summary FROM sessions WHERE id = ? AND expires_at > ?", (session_id, now)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE sessions SET accessed_at = ?, expires_at = ? WHERE id = ?",
+                               (now, now + self.ttl, session_id))
+            turns = self._conn.execute(
+                "SELECT seq, question, answer FROM turns WHERE session_id = ? ORDER BY seq", (session_id,)
+            ).fetchall()
+        return Session(session_id, row[0], [(seq, _unpack(question), _unpack(answer))
+                                            for seq, question, answer in turns])
+
+    def append(self, session_id: str, question: str, answer: str) -> None:
+        now = time.time()
+        with self._lock, self._conn:
+            # An expired session starts over
+            self._conn.execute("DELETE FROM turns WHERE session_id IN"
+                               " (SELECT id FROM sessions WHERE id = ? AND expires_at <= ?)", (session_id, now))
+            self._conn.execute("DELETE FROM sessions WHERE id = ? AND expires_at <= ?", (session_id, now))
+            self._conn.execute("INSERT OR IGNORE INTO sessions VALUES (?, '', 1, ?, ?)",
+                               (session_id, now + self.ttl, now))
+            # Claims the sequence number under the database write lock
+            self._conn.execute(
+                "UPDATE sessions SET next_seq = next_seq + 1, accessed_at = ?, expires_at = ? WHERE id = ?",
+                (now, now + self.ttl, session_id))
+            seq = self._conn.execute("SELECT next_seq - 1 FROM sessions WHERE id = ?", (session_id,)).fetchone()[0]
+            self._conn.execute("INSERT INTO turns VALUES (?, ?, ?, ?)",
+                               (session_id, seq, _pack(question), _pack(answer)))
+            self._evict(now)
+
+    def _evict(self, now: float) -> None:
+        """Drop expired sessions and the least recently used beyond max_sessions."""
+        stale = ("SELECT id FROM sessions WHERE expires_at <= ? UNION"
+                 " SELECT id FROM (SELECT id FROM sessions ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)")
+        self._conn.execute(f"DELETE FROM turns WHERE session_id IN ({stale})", (now, self.max_sessions))
+        self._conn.execute(f"DELETE FROM sessions WHERE id IN ({stale})", (now, self.max_sessions))
+
+    def compact(self, session_id: str, summary: str, through: int) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE sessions SET summary = ? WHERE id = ?", (summary, session_id))
+            self._conn.execute("DELETE FROM turns WHERE session_id = ? AND seq <= ?", (session_id, through))
+
+    def delete(self, session_id: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM turns WHERE session_id = ?", (session_id,))
+            self._conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+
+def _pack(text: str) -> bytes:
+    return zlib.compress(text.encode('utf-8'))
+
+
+def _unpack(blob: bytes) -> str:
+    return zlib.decompress(blob).decode('utf-8')
+
+
+class SessionStore:
+    """Sessions on a backend, with rolling summarization of long histories."""
+
+    def __init__(self, backend: SessionBackend, summary_tokens: int = SESSION_SUMMARY_TOKENS,
+                 keep_turns: int = SESSION_KEEP_TURNS, summary_model: str = SESSION_SUMMARY_MODEL):
+        self.backend = backend
+        self.summary_tokens = summary_tokens
+        self.keep_turns = keep_turns
+        self.summary_model = summary_model
+        self._summarizing = set()
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def history(self, session_id: str) -> List[Dict]:
+        """
+        Chat history for the next question of a session: the recent turns,
+        with the summary of earlier turns (if any) leading the first user
+        message. Empty for a new or expired session.
+
+        The summary is part of a user turn rather than a system message of
+        its own, so the model reads it as context, not as instructions, and
+        the system message stays the same for every session (the cached
+        prompt prefix). It only changes when older turns are summarized.
+        """
+        session = self.backend.get(session_id)
+        if session is None:
+            return []
+        messages = []
+        for _, question, answer in session.turns:
+            messages.append({"role": "user", "content": question})
+            messages.append({"role": "assistant", "content": answer})
+        if session.summary:
+            summary = f"Summary of our earlier conversation:\n{session.summary}"
+            if messages:
+                messages[0] = {"role": "user", "content": f"{summary}\n\n---\n\n{messages[0]['content']}"}
+            else:
+                messages.append({"role": "user", "content": summary})
+        return messages
+
+    def record(self, session_id: str, question: str, answer: str) -> None:
+        """Log a turn, and summarize older turns in the background if the log has grown too long."""
+        self.backend.append(session_id, question, answer)
+
+        session = self.backend.get(session_id)
+        if session is None or len(session.turns) <= self.keep_turns:
+            return
+        token_counter = get_token_counter(self.summary_model)
+        tokens = sum(token_counter.count(question) + token_counter.count(answer)
+                     for _, question, answer in session.turns)
+        if tokens <= self.summary_tokens:
+            return
+
+        with self._lock:
+            if session_id in self._summarizing:
+                return
+            self._summarizing.add(session_id)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="session-summary")
+        self._executor.submit(self._summarize, session_id)
+
+    def _summarize(self, session_id: str) -> None:
+        """Fold all but the most recent turns into the session's summary."""
+        try:
+            session = self.backend.get(session_id)
+            if session is None or len(session.turns) <= self.keep_turns:
+                return
+            older = session.turns[:-self.keep_turns] if self.keep_turns else session.turns
+            transcript = "\n\n".join(f"User: {question}\nAdvisor: {answer}" for _, question, answer in older)
+            content = (f"Previous summary:\n{session.summary or '(none)'}\n\n"
+                       f"New turns:\n{transcript}")
+
+            # Lazy import: tyc_advisor imports this module
+            from src.tyc_advisor import get_openai_client
+
+            response = get_openai_client().chat.completions.create(
+                model=self.summary_model,
+                messages=[{"role": "system", "content": SUMMARY_PROMPT},
+                          {"role": "user", "content": content}],
+            )
+            summary = (response.choices[0].message.content or "").strip()
+            if not summary:
+                raise ValueError("empty summary")
+            self.backend.compact(session_id, summary, older[-1][0])
+            SESSION_SUMMARIES.inc(result='ok')
+        except Exception as e:
+            # The turns stay in the log; the prompt token cap still bounds the history
+            print(f"Warning: Could not summarize session {session_id}: {e}")
+            SESSION_SUMMARIES.inc(result='error')
+        finally:
+            with self._lock:
+                self._summarizing.discard(session_id)
+
+    def delete(self, session_id: str) -> None:
+        self.backend.delete(session_id)
+
+    def stats(self) -> Dict[str, object]:
+        summaries = SESSION_SUMMARIES.snapshot()
+        return {
+            'backend': self.backend.name,
+            'sessions': len(self.backend),
+            'summaries': int(summaries.get(('ok',), 0)),
+            'summary_errors': int(summaries.get(('error',), 0)),
+        }
+
+
+def create_backend(name: str) -> SessionBackend:
+    """Backend by name (one of BACKENDS), configured from the environment."""
+    if name == 'memory':
+        return MemoryBackend(SESSION_MAX_SESSIONS, SESSION_TTL)
+    if name == 'sqlite':
+        return SQLiteBackend(SESSION_STORE_PATH, SESSION_MAX_SESSIONS, SESSION_TTL)
+    raise ValueError(f"Unknown session store {name!r}, expected one of {BACKENDS}")
+
+
+# Global instance
+_session_store: Optional[SessionStore] = None
+_session_store_lock = threading.Lock()
+_session_store_disabled = SESSION_STORE in ('', '0', 'false', 'off', 'none')
+
+
+def get_session_store() -> Optional[SessionStore]:
+    """The process-wide session store, or None if sessions are disabled."""
+    global _session_store, _session_store_disabled
+    if _session_store is None and not _session_store_disabled:
+        with _session_store_lock:
+            if _session_store is None and not _session_store_disabled:
+                try:
+                    _session_store = SessionStore(create_backend(SESSION_STORE))
+                except Exception as e:
+                    # Questions are still answered, just without session history
+                    print(f"Warning: sessions disabled: {e}")
+                    _session_store_disabled = True
+    return _session_store
+
+
+def get_session_stats() -> Dict[str, object]:
+    """Size and summarization counts of the session store (empty if disabled)."""
+    store = get_session_store()
+    return store.stats() if store is not None else {}
+
+
+def _sessions_gauge() -> Dict[Tuple[str], int]:
+    stats = get_session_stats()
+    return {(stats['backend'],): stats['sessions']} if stats else {}
+
+
+SESSIONS.set_function(_sessions_gauge)
@@ -0,0 +1,102 @@
+"""
+Per-request timing spans.
+
+Each stage of answering a question is timed with span():
+
+    with span('search'):
+        ...
+
+or, for a whole function, @span('search'). Every span is observed in the
+advisor_stage_seconds histogram. Spans that run inside a request started
+with start_timing() are also added up for that request, so the app can
+send the breakdown to the client in a Server-Timing header. The request's
+timings live in a context variable: they follow the request into asyncio
+tasks and, through contextvars.copy_context(), into worker threads.
+
+Stages (nested ones are included in their parent's time):
+
+    retrieval        AAOIFI context for the question, of which
+      kb_wait        waiting for the knowledge base to load
+      search         ranking passages
+      format_context packing passages into the token budget
+    session          reading and writing the session history
+    prompt           composing the messages (token counting, history fit)
+    answer_cache     answer cache lookups and stores
+    model            the OpenAI call, until the complete answer
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, Optional
+
+from src.metrics import histogram
+
+STAGE_SECONDS = histogram(
+    'advisor_stage_seconds',
+    'Time spent per stage of answering a question (see src/timing.py)',
+    ('stage',),
+)
+
+
+class RequestTimings:
+    """Seconds spent per stage during one request, in the order the stages first ran."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self._stages: Dict[str, float] = {}
+        self._lock = threading.Lock()  # Spans may end on other threads
+
+    def add(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self._stages[stage] = self._stages.get(stage, 0.0) + seconds
+
+    def as_ms(self) -> Dict[str, float]:
+        """Milliseconds per stage, plus 'total' since the request started."""
+        with self._lock:
+            timings = {stage: round(seconds * 1000, 1) for stage, seconds in self._stages.items()}
+        timings['total'] = round((time.perf_counter() - self.start) * 1000, 1)
+        return timings
+
+    def server_timing(self) -> str:
+        """The timings as a Server-Timing header value."""
+        return ", ".join(f"{stage};dur={ms}" for stage, ms in self.as_ms().items())
+
+
+_current: ContextVar[Optional[RequestTimings]] = ContextVar('request_timings', default=None)
+
+
+def start_timing() -> RequestTimings:
+    """Start collecting the spans of a request (in the current context)."""
+    timings = RequestTimings()
+    _current.set(timings)
+    return timings
+
+
+def stop_timing() -> None:
+    """Stop collecting spans in the current context (a worker thread's next request starts afresh)."""
+    _current.set(None)
+
+
+def current_timings() -> Optional[RequestTimings]:
+    """The timings of the request being served, if one was started."""
+    return _current.get()
+
+
+def record(stage: str, seconds: float) -> None:
+    """Record a stage timed by the caller."""
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    timings = _current.get()
+    if timings is not None:
+        timings.add(stage, seconds)
+
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    """Time a block (or, as a decorator, each call of a function) as a stage."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
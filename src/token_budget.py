@@ -0,0 +1,162 @@
+"""
+Token counting for prompt budgets.
+
+Prompt size is what each request pays for and what drives model latency,
+so retrieved context and chat history are budgeted in the model's own
+tokens rather than in characters. Counts come from tiktoken when it is
+installed and the model's encoding can be loaded (o200k_base for models
+tiktoken doesn't know yet). Otherwise they are estimated: one token per
+punctuation mark and per four characters of each word, which errs on the
+high side so a budget is never exceeded.
+"""
+
+import re
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# Encoding for models tiktoken has no mapping for (the GPT-4o/GPT-5 family)
+DEFAULT_ENCODING = 'o200k_base'
+
+# Chat format overhead: tokens around each message, and priming the reply
+MESSAGE_OVERHEAD = 3
+REPLY_OVERHEAD = 3
+
+_PIECES = re.compile(r"\w+|[^\w\s]")
+_SENTENCE_END = re.compile(r"[.!?;:](?=\s)|\n")
+
+
+def _load_encoding(model: str):
+    """The tiktoken encoding for a model, or None if tiktoken (or its data) is unavailable."""
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding(DEFAULT_ENCODING)
+    except Exception as e:
+        # Encodings are downloaded on first use, which fails offline
+        print(f"Warning: Could not load tokenizer for {model} ({e}); estimating token counts")
+        return None
+
+
+class TokenCounter:
+    """Counts and truncates text in a model's tokens."""
+
+    def __init__(self, model: str):
+        self.model = model
+        self._encoding = _load_encoding(model)
+        # Part of cache keys: contexts packed with different tokenizers differ
+        self.encoding_name = self._encoding.name if self._encoding is not None else 'estimate'
+
+    def count(self, text: str) -> int:
+        """Number of tokens in text."""
+        if not text:
+            return 0
+        if self._encoding is not None:
+            return len(self._encoding.encode(text, disallowed_special=()))
+        return sum(_estimate(piece) for piece in _PIECES.findall(text))
+
+    def count_messages(self, messages: Sequence[Dict]) -> int:
+        """Prompt tokens of a list of chat messages, including the chat format overhead."""
+        return sum(MESSAGE_OVERHEAD + self.count(message.get('content') or '')
+                   for message in messages) + REPLY_OVERHEAD
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """
+        The longest prefix of text that fits in max_tokens, cut back to the
+        end of a sentence if one ends in its second half, else to a word.
+        """
+        if max_tokens <= 0:
+            return ""
+        if self._encoding is not None:
+            tokens = self._encoding.encode(text, disallowed_special=())
+            if len(tokens) <= max_tokens:
+                return text
+            # A cut inside a multi-byte character decodes to U+FFFD
+            prefix = self._encoding.decode(tokens[:max_tokens]).rstrip('�')
+        else:
+            used = 0
+            prefix = text
+            for match in _PIECES.finditer(text):
+                used += _estimate(match.group())
+                if used > max_tokens:
+                    prefix = text[:match.start()]
+                    break
+            else:
+                return text
+
+        sentence_ends = [match.end() for match in _SENTENCE_END.finditer(prefix)]
+        if sentence_ends and sentence_ends[-1] >= len(prefix) // 2:
+            return prefix[:sentence_ends[-1]].rstrip()
+        if not text[len(prefix):len(prefix) + 1].isspace():
+            # Don't end on part of a word
+            space = max(prefix.rfind(' '), prefix.rfind('\n'))
+            if space > 0:
+                prefix = prefix[:space]
+        return prefix.rstrip()
+
+
+def _estimate(piece: str) -> int:
+    return (len(piece) + 3) // 4 if piece[0].isalnum() or piece[0] == '_' else 1
+
+
+_counters: Dict[str, TokenCounter] = {}
+_counters_lock = threading.Lock()  # Guards _model_locks only
+_model_locks: Dict[str, threading.Lock] = {}
+
+
+def get_token_counter(model: str) -> TokenCounter:
+    """The shared token counter for a model."""
+    counter = _counters.get(model)
+    if counter is None:
+        with _counters_lock:
+            lock = _model_locks.setdefault(model, threading.Lock())
+        # Loading an encoding may download it: only requests for this model wait
+        with lock:
+            counter = _counters.get(model)
+            if counter is None:
+                counter = _counters[model] = TokenCounter(model)
+    return counter
+
+
+def warm_token_counters(models: Sequence[str]) -> threading.Thread:
+    """
+    Load the tokenizers of models in the background, so the first request
+    doesn't wait for the encoding download. Call once per worker process.
+    """
+    thread = threading.Thread(target=lambda: [get_token_counter(model) for model in models],
+                              name='tokenizer-warmup', daemon=True)
+    thread.start()
+    return thread
+
+
+def fit_history(history: Optional[List[Dict]], budget: int,
+                counter: TokenCounter) -> Tuple[List[Dict], int]:
+    """
+    The most recent part of a chat history that fits in a token budget.
+
+    Older messages are dropped first, and the kept history never starts
+    with an assistant reply.
+
+    :param history: Messages, oldest first
+    :param budget: Tokens available for the history
+    :param counter: Token counter of the model
+    :return: (kept messages, tokens they use)
+    """
+    if not history:
+        return [], 0
+    kept_from = len(history)
+    used = 0
+    for position in range(len(history) - 1, -1, -1):
+        tokens = MESSAGE_OVERHEAD + counter.count(history[position].get('content') or '')
+        if used + tokens > budget:
+            break
+        used += tokens
+        kept_from = position
+    while kept_from < len(history) and history[kept_from].get('role') == 'assistant':
+        used -= MESSAGE_OVERHEAD + counter.count(history[kept_from].get('content') or '')
+        kept_from += 1
+    return list(history[kept_from:]), used
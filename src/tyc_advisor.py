@@ -1,7 +1,22 @@
-from openai import OpenAI
+from openai import APIConnectionError, AsyncOpenAI, InternalServerError, OpenAI, RateLimitError
 from dotenv import load_dotenv
-from typing import Optional, List, Dict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import AsyncIterator, Callable, Optional, List, Dict, Iterator, Sequence, Tuple, Union
+import asyncio
+import contextvars
+import functools
+import httpx
+import json
 import os
+import random
+import threading
+import time
+
+from src.answer_cache import get_answer_cache
+from src.metrics import counter, histogram
+from src.sessions import get_session_store
+from src.timing import current_timings, record, span
+from src.token_budget import fit_history, get_token_counter
 
 # Load environment variables from .env file
 load_dotenv()
@@ -16,12 +31,172 @@ except ImportError:
 
 # Import PDF knowledge base
 try:
-    from src.pdf_knowledge import get_aaoifi_context
+    from src.pdf_knowledge import get_aaoifi_context_with_sources, get_aaoifi_contexts_with_sources
     PDF_AVAILABLE = True
 except ImportError:
     PDF_AVAILABLE = False
     print("Warning: pdf_knowledge module not available. PDF context will not be included.")
 
+# Instructions for every request. They are part of the system message, which
+# is byte-identical across requests so the provider can cache it as a prompt
+# prefix; everything that varies goes in the last message (see _compose_messages).
+CONTEXT_INSTRUCTIONS = """When a user message starts with "Relevant context from AAOIFI Standards", \
+use that context to inform your answer to the question that follows it, when relevant. \
+Each passage is headed by its source, standard, section and page."""
+
+SYSTEM_MESSAGE = {"role": "system", "content": f"{TYC_SYSTEM_PROMPT.rstrip()}\n\n{CONTEXT_INSTRUCTIONS}"}
+
+# Connection pool settings for the shared OpenAI client (one pool per worker process)
+OPENAI_MAX_CONNECTIONS = int(os.getenv('OPENAI_MAX_CONNECTIONS', '100'))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv('OPENAI_MAX_KEEPALIVE_CONNECTIONS', '20'))
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv('OPENAI_KEEPALIVE_EXPIRY', '60'))
+OPENAI_TIMEOUT = float(os.getenv('OPENAI_TIMEOUT', '120'))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv('OPENAI_CONNECT_TIMEOUT', '10'))
+
+# Sent as prompt_cache_key, so requests sharing the system prompt are routed
+# to the same provider prompt cache (unset: not sent)
+OPENAI_PROMPT_CACHE_KEY = os.getenv('OPENAI_PROMPT_CACHE_KEY', '')
+
+# Threads for AAOIFI retrieval in the async advisor (keeps the event loop free)
+ADVISOR_RETRIEVAL_THREADS = int(os.getenv('ADVISOR_RETRIEVAL_THREADS', '8'))
+
+# ask_many(): concurrent model calls per batch, and retries of a call that is
+# rate limited or fails transiently
+ADVISOR_BATCH_CONCURRENCY = int(os.getenv('ADVISOR_BATCH_CONCURRENCY', '8'))
+ADVISOR_BATCH_MAX_RETRIES = int(os.getenv('ADVISOR_BATCH_MAX_RETRIES', '6'))
+
+# Token budget for AAOIFI passages in each prompt, counted with the model's tokenizer
+ADVISOR_CONTEXT_TOKENS = int(os.getenv('ADVISOR_CONTEXT_TOKENS', '800'))
+
+# Largest prompt sent to a model, in tokens; the oldest chat history is
+# dropped to fit. ADVISOR_PROMPT_TOKEN_CAPS sets it per model, e.g.
+# "gpt-5-mini=4000,gpt-5.1=12000".
+ADVISOR_PROMPT_TOKEN_CAP = int(os.getenv('ADVISOR_PROMPT_TOKEN_CAP', '8000'))
+ADVISOR_PROMPT_TOKEN_CAPS = {
+    model.strip(): int(cap)
+    for model, _, cap in (item.partition('=') for item in os.getenv('ADVISOR_PROMPT_TOKEN_CAPS', '').split(','))
+    if cap.strip()
+}
+
+PROMPT_TOKENS = counter(
+    'advisor_prompt_tokens_total',
+    'Prompt tokens sent to the model by part (system, history, context, question)',
+    ('model', 'part'),
+)
+
+HISTORY_DROPPED = counter(
+    'advisor_history_messages_dropped_total',
+    'Chat history messages left out of prompts to fit the prompt token cap',
+    ('model',),
+)
+
+API_PROMPT_TOKENS = counter(
+    'advisor_api_prompt_tokens_total',
+    'Prompt tokens reported by the API, by whether the provider served them from its prompt cache',
+    ('model', 'cache'),
+)
+
+COMPLETION_TOKENS = counter(
+    'advisor_completion_tokens_total',
+    'Completion tokens reported by the API',
+    ('model',),
+)
+
+MODEL_CALL_SECONDS = histogram(
+    'advisor_model_call_seconds',
+    'Model call time until the complete answer, by provider prompt cache result (hit, miss, unknown)',
+    ('model', 'prompt_cache'),
+)
+
+TIME_TO_FIRST_TOKEN = histogram(
+    'advisor_time_to_first_token_seconds',
+    'Time from a streamed ask() call to its first token, including retrieval',
+    ('model',),
+)
+
+
+class RateLimitBackoff:
+
+    """
+
+    Retry policy shared by the model calls of one batch.
+
+    A 429 pauses every call of the batch, not just the one that got it, for
+    as long as the API asked (Retry-After), or with exponential backoff and
+    jitter if it didn't say. Connection errors and 5xx responses are retried
+    with the same backoff, but only delay the call that failed.
+
+    """
+
+    RETRYABLE = (RateLimitError, InternalServerError, APIConnectionError)
+
+    def __init__(self, max_retries: int = ADVISOR_BATCH_MAX_RETRIES, base_delay: float = 1.0,
+                 max_delay: float = 60.0):
+
+        self.max_retries = max_retries
+
+        self.base_delay = base_delay
+
+        self.max_delay = max_delay
+
+        self.rate_limited = 0
+
+        self._resume_at = 0.0
+
+        self._lock = threading.Lock()
+
+    def _delay(self, error: Exception, attempt: int) -> float:
+        """Seconds to wait before retrying after an error; pauses the batch on a 429."""
+
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+        headers = getattr(getattr(error, "response", None), "headers", None) or {}
+        try:
+            if headers.get("retry-after-ms"):
+                delay = float(headers["retry-after-ms"]) / 1000
+            elif headers.get("retry-after"):
+                delay = float(headers["retry-after"])
+        except ValueError:
+            pass  # An HTTP date: keep the backoff
+
+        delay = min(delay, self.max_delay)
+
+        if isinstance(error, RateLimitError):
+            with self._lock:
+                self.rate_limited += 1
+                self._resume_at = max(self._resume_at, time.monotonic() + delay)
+
+        return delay
+
+    def _paused(self) -> float:
+        """Seconds left in a batch-wide pause."""
+
+        return max(0.0, self._resume_at - time.monotonic())
+
+    def call(self, create: Callable, **params):
+        """create(**params), retried as described above."""
+
+        for attempt in range(self.max_retries + 1):
+            time.sleep(self._paused())
+            try:
+                return create(**params)
+            except self.RETRYABLE as e:
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(self._delay(e, attempt))
+
+    async def call_async(self, create: Callable, **params):
+        """await create(**params), retried as described above."""
+
+        for attempt in range(self.max_retries + 1):
+            await asyncio.sleep(self._paused())
+            try:
+                return await create(**params)
+            except self.RETRYABLE as e:
+                if attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(self._delay(e, attempt))
+
 
 class TYCIslamicFinanceAdvisor:
 
@@ -41,6 +216,8 @@ class TYCIslamicFinanceAdvisor:
 
         model: str = "gpt-5.1",
 
+        client: Optional[OpenAI] = None,
+
     ):
         """
 
@@ -48,9 +225,12 @@ class TYCIslamicFinanceAdvisor:
 
         :param model:   Base model to use, e.g. "gpt-5.1" or "gpt-4.1-mini"
 
+        :param client:  Existing OpenAI client to reuse (see get_openai_client);
+                        if None, a new client is created
+
         """
 
-        self.client = OpenAI(api_key=api_key)
+        self.client = client if client is not None else OpenAI(api_key=api_key)
 
         self.model = model
 
@@ -68,7 +248,11 @@ class TYCIslamicFinanceAdvisor:
 
         use_pdf_context: bool = True,
 
-    ) -> str:
+        stream: bool = False,
+
+        session_id: Optional[str] = None,
+
+    ) -> Union[str, Iterator[str]]:
         """
 
         Send a question to the TYC Islamic Finance Advisor.
@@ -89,41 +273,566 @@ class TYCIslamicFinanceAdvisor:
 
         :param use_pdf_context: Whether to include relevant AAOIFI Standards PDF context (default: True).
 
+        :param stream: If True, return a generator of reply text deltas instead (see ask_stream).
+
+        :param session_id: Continue this server-side session (see src/sessions.py): its
+                           history replaces ``history``, and the new turn is logged to it.
+
         :return: Assistant reply as a string.
 
         """
 
+        if stream:
+            return (event['content'] for event in self.ask_stream(
+                user_message, history=history, max_tokens=max_tokens,
+                temperature=temperature, use_pdf_context=use_pdf_context, session_id=session_id,
+            ) if event['type'] == 'delta')
+
+        return self.ask_with_usage(user_message, history, max_tokens, temperature, use_pdf_context,
+                                   session_id)[0]
+
+    def ask_with_usage(
+
+        self,
+
+        user_message: str,
+
+        history: Optional[List[Dict]] = None,
+
+        max_tokens: Optional[int] = None,
+
+        temperature: float = 0.3,
+
+        use_pdf_context: bool = True,
+
+        session_id: Optional[str] = None,
+
+    ) -> Tuple[str, Dict]:
+        """
+
+        Like ask() without streaming, but also reports the request's prompt tokens.
+
+        :return: (assistant reply, usage dict; see _compose_messages, plus the
+                 'prompt_tokens', 'cached_tokens' (served from the provider's
+                 prompt cache) and 'completion_tokens' the API reported,
+                 and 'cached' if the answer came from the answer cache)
+
+        """
+
+        pdf_context, _ = self._retrieve_context(user_message, use_pdf_context)
+
+        return self._answer(user_message, history, pdf_context, max_tokens, temperature, session_id)
+
+    def ask_many(
+
+        self,
+
+        questions: Sequence[str],
+
+        max_tokens: Optional[int] = None,
+
+        temperature: float = 0.3,
+
+        use_pdf_context: bool = True,
+
+        concurrency: int = ADVISOR_BATCH_CONCURRENCY,
+
+    ) -> Iterator[Dict]:
+        """
+
+        Answer a batch of independent questions, e.g. product descriptions to screen.
+
+        Retrieval runs for all questions in one pass (repeated questions are
+        looked up once); the model calls then run concurrently, at most
+        ``concurrency`` at a time, with rate-limited calls retried under a
+        backoff shared by the batch (see RateLimitBackoff).
+
+        :return: One result per question, yielded as each completes (so not in order):
+
+          {"index": i, "question": ..., "answer": ..., "citations": [...], "usage": {...}}
+          {"index": i, "question": ..., "error": "..."}                 if the call failed
+
+        """
+
+        contexts = self._retrieve_contexts(questions, use_pdf_context)
+
+        backoff = RateLimitBackoff()
+
+        # The batch does its own retries
+        client = self.client.with_options(max_retries=0)
+
+        def create(**params):
+            return backoff.call(client.chat.completions.create, **params)
+
+        pool = ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(questions))),
+                                  thread_name_prefix="advisor-batch")
+        try:
+            futures = {
+                pool.submit(self._answer, question, None, contexts[index][0], max_tokens, temperature,
+                            None, create): index
+                for index, question in enumerate(questions)
+            }
+            for future in as_completed(futures):
+                index = futures[future]
+                try:
+                    answer, usage = future.result()
+                except Exception as e:
+                    yield {"index": index, "question": questions[index], "error": f"{type(e).__name__}: {e}"}
+                    continue
+                yield {"index": index, "question": questions[index], "answer": answer,
+                       "citations": contexts[index][1], "usage": usage}
+        finally:
+            # Stop at once if the consumer goes away
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def batch_requests(
+
+        self,
+
+        questions: Sequence[str],
+
+        max_tokens: Optional[int] = None,
+
+        temperature: float = 0.3,
+
+        use_pdf_context: bool = True,
+
+    ) -> Iterator[Dict]:
+        """
+
+        OpenAI Batch API requests for a batch of questions, for runs that can
+        wait up to a day at a lower price (see scripts/batch_questions.py).
+
+        :return: One request per question, with custom_id "question-<index>":
+
+          {"custom_id": ..., "method": "POST", "url": "/v1/chat/completions", "body": {...}}
+
+        """
+
+        contexts = self._retrieve_contexts(questions, use_pdf_context)
+
+        for index, question in enumerate(questions):
+            messages, _ = self._compose_messages(question, None, contexts[index][0])
+            yield {
+                "custom_id": f"question-{index}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": self._request_params(messages, max_tokens, temperature),
+            }
+
+    def write_batch_file(self, questions: Sequence[str], path: str, **kwargs) -> int:
+        """
+
+        Write batch_requests() as a Batch API input file (JSONL).
+
+        :return: Number of requests written
+
+        """
+
+        count = 0
+        with open(path, "w", encoding="utf-8") as f:
+            for line in self.batch_requests(questions, **kwargs):
+                f.write(json.dumps(line, ensure_ascii=False) + "\n")
+                count += 1
+        return count
+
+    def _answer(
+
+        self,
+
+        user_message: str,
+
+        history: Optional[List[Dict]],
+
+        pdf_context: str,
+
+        max_tokens: Optional[int],
+
+        temperature: float,
+
+        session_id: Optional[str] = None,
+
+        create: Optional[Callable] = None,
+
+    ) -> Tuple[str, Dict]:
+        """
+
+        ask_with_usage() once the context has been retrieved: answer cache,
+        then model call.
+
+        :param create: Replaces client.chat.completions.create (ask_many retries through it)
+
+        """
+
+        history = self._session_history(session_id, history)
+
+        messages, usage = self._compose_messages(user_message, history, pdf_context)
+
+        cache, scope = self._cache_scope(messages[1:-1], pdf_context, max_tokens, temperature)
+        if cache is not None:
+            answer = cache.get(user_message, scope)
+            if answer is not None:
+                self._record_turn(session_id, user_message, answer)
+                return answer, dict(usage, cached=True)
+
+        request_params = self._request_params(messages, max_tokens, temperature)
+
+        call_start = time.perf_counter()
+
+        response = (create or self.client.chat.completions.create)(**request_params)
+
+        answer = response.choices[0].message.content
+
+        usage = self._record_usage(usage, response.usage, time.perf_counter() - call_start)
+
+        if cache is not None:
+            cache.set(user_message, scope, answer)
+
+        self._record_turn(session_id, user_message, answer)
+
+        return answer, usage
+
+    def ask_stream(
+
+        self,
+
+        user_message: str,
+
+        history: Optional[List[Dict]] = None,
+
+        max_tokens: Optional[int] = None,
+
+        temperature: float = 0.3,
+
+        use_pdf_context: bool = True,
+
+        session_id: Optional[str] = None,
+
+    ) -> Iterator[Dict]:
+        """
+
+        Stream an answer as a sequence of events.
+
+        Takes the same arguments as ask() and yields, in order:
+
+          {"type": "citations", "citations": [...]}   AAOIFI passages used as context
+          {"type": "delta", "content": "..."}         one per token delta
+          {"type": "done", "ttft_ms": ..., "total_ms": ..., "usage": {...}, "timings_ms": {...}}
+
+        with usage as returned by ask_with_usage(), and timings_ms the time
+        per stage of the request if it is being timed (see src/timing.py).
+
+        """
+
+        start = time.perf_counter()
+
+        pdf_context, citations = self._retrieve_context(user_message, use_pdf_context)
+
+        yield {"type": "citations", "citations": citations}
+
+        history = self._session_history(session_id, history)
+
+        messages, usage = self._compose_messages(user_message, history, pdf_context)
+
+        cache, scope = self._cache_scope(messages[1:-1], pdf_context, max_tokens, temperature)
+        if cache is not None:
+            answer = cache.get(user_message, scope)
+            if answer is not None:
+                self._record_turn(session_id, user_message, answer)
+                yield from self._cached_events(answer, start, usage)
+                return
+
+        request_params = self._request_params(messages, max_tokens, temperature)
+        request_params["stream"] = True
+        request_params["stream_options"] = {"include_usage": True}
+
+        ttft = None
+        parts = []
+        reported = None
+        call_start = time.perf_counter()
+        stream = self.client.chat.completions.create(**request_params)
+        try:
+            for chunk in stream:
+                if getattr(chunk, "usage", None) is not None:
+                    reported = chunk.usage  # Sent last, with no choices
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if not delta:
+                    continue
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+                    TIME_TO_FIRST_TOKEN.observe(ttft, model=self.model)
+                parts.append(delta)
+                yield {"type": "delta", "content": delta}
+        finally:
+            # Release the connection if the consumer stops early (client disconnect)
+            stream.close()
+
+        # Only complete answers reach this point
+        usage = self._record_usage(usage, reported, time.perf_counter() - call_start)
+
+        if cache is not None:
+            cache.set(user_message, scope, "".join(parts))
+
+        self._record_turn(session_id, user_message, "".join(parts))
+
+        yield {
+            "type": "done",
+            "ttft_ms": round(ttft * 1000, 1) if ttft is not None else None,
+            "total_ms": round((time.perf_counter() - start) * 1000, 1),
+            "usage": usage,
+            "timings_ms": _stage_timings(),
+        }
+
+    def _cached_events(self, answer: str, start: float, usage: Dict) -> Iterator[Dict]:
+        """ask_stream() events for an answer served from the cache."""
+
+        ttft = time.perf_counter() - start
+        TIME_TO_FIRST_TOKEN.observe(ttft, model=self.model)
+
+        yield {"type": "delta", "content": answer}
+
+        yield {
+            "type": "done",
+            "ttft_ms": round(ttft * 1000, 1),
+            "total_ms": round((time.perf_counter() - start) * 1000, 1),
+            "cached": True,
+            "usage": dict(usage, cached=True),
+            "timings_ms": _stage_timings(),
+        }
+
+    @span('session')
+    def _session_history(self, session_id: Optional[str], history: Optional[List[Dict]]) -> Optional[List[Dict]]:
+        """The history for a request: the session's if one is given (and sessions are enabled)."""
+
+        store = get_session_store() if session_id is not None else None
+
+        if store is None:
+            return history
+
+        return store.history(session_id)
+
+    @span('session')
+    def _record_turn(self, session_id: Optional[str], user_message: str, answer: str) -> None:
+        """Log a question and its answer to the session, if any."""
+
+        store = get_session_store() if session_id is not None else None
+
+        if store is None:
+            return
+
+        try:
+            store.record(session_id, user_message, answer)
+        except Exception as e:
+            # The answer is still returned, just not remembered
+            print(f"Warning: Could not record turn for session {session_id}: {e}")
+
+    def _cache_scope(
+
+        self,
+
+        history: Optional[List[Dict]],
+
+        pdf_context: str,
+
+        max_tokens: Optional[int],
+
+        temperature: float,
+
+    ):
+        """
+
+        The answer cache (None if disabled) and the cache scope for a request:
+        everything besides the question that shapes the answer.
+
+        """
+
+        cache = get_answer_cache()
+
+        if cache is None:
+            return None, None
+
+        params = self._request_params([], max_tokens, temperature)
+        params.pop("messages")
+
+        return cache, cache.scope(self.model, SYSTEM_MESSAGE["content"], pdf_context, history, params)
+
+    @span('retrieval')
+    def _retrieve_context(self, user_message: str, use_pdf_context: bool) -> Tuple[str, List[Dict]]:
+        """
+
+        Look up AAOIFI context for a question (blocking: runs the knowledge base search).
+
+        :return: (context text, citations); empty if disabled or unavailable
+
+        """
+
+        if not (use_pdf_context and PDF_AVAILABLE):
+            return "", []
+
+        try:
+            return get_aaoifi_context_with_sources(
+                user_message, max_tokens=ADVISOR_CONTEXT_TOKENS, model=self.model)
+        except (MemoryError, SystemExit) as e:
+            # Critical errors - disable PDF for future requests
+            print(f"Critical error with PDF: {e}. PDF context disabled.")
+            # Continue without PDF context
+            return "", []
+        except Exception as e:
+            # Continue without PDF context - app should work without it
+            print(f"Warning: retrieval failed, answering without PDF context: {e}")
+            return "", []
+
+    @span('retrieval')
+    def _retrieve_contexts(self, questions: Sequence[str], use_pdf_context: bool) -> List[Tuple[str, List[Dict]]]:
+        """
+
+        _retrieve_context() for a batch of questions, in one retrieval pass.
+
+        """
+
+        if not (use_pdf_context and PDF_AVAILABLE):
+            return [("", []) for _ in questions]
+
+        try:
+            return get_aaoifi_contexts_with_sources(
+                list(questions), max_tokens=ADVISOR_CONTEXT_TOKENS, model=self.model)
+        except Exception as e:
+            print(f"Warning: batch retrieval failed, answering without PDF context: {e}")
+            return [("", []) for _ in questions]
+
+    @span('prompt')
+    def _compose_messages(
+
+        self,
+
+        user_message: str,
+
+        history: Optional[List[Dict]],
+
+        pdf_context: str,
+
+    ) -> Tuple[List[Dict], Dict]:
+        """
+
+        Chat messages for a question and its (possibly empty) AAOIFI context.
+
+        Laid out for provider prompt caching, which reuses the longest prefix
+        an earlier prompt shares: the system message comes first and never
+        changes, then the history (a conversation's prefix from one turn to
+        the next), and last the retrieved context followed by the question.
+
+        The prompt is kept within the model's prompt token cap by dropping the
+        oldest history messages that don't fit.
+
+        :return: (messages, usage dict with the prompt's estimated token counts:
+                 'estimated_prompt_tokens', 'system_tokens', 'history_tokens',
+                 'context_tokens', 'question_tokens', 'history_messages' kept,
+                 'history_dropped', 'prompt_token_cap' and 'tokenizer')
+
+        """
+
         # Build the user message with PDF context if available
         enhanced_message = user_message
 
-        if use_pdf_context and PDF_AVAILABLE:
-            try:
-                pdf_context = get_aaoifi_context(user_message, max_chars=2000)
-                if pdf_context and pdf_context.strip():
-                    enhanced_message = f"""{user_message}
-
----
-Relevant context from AAOIFI Standards:
+        if pdf_context and pdf_context.strip():
+            enhanced_message = f"""Relevant context from AAOIFI Standards:
 {pdf_context}
 ---
-Please use the above AAOIFI Standards context to inform your answer when relevant."""
-            except (MemoryError, SystemExit) as e:
-                # Critical errors - disable PDF for future requests
-                print(f"Critical error with PDF: {e}. PDF context disabled.")
-                # Continue without PDF context
-            except Exception as e:
-                # Silently continue without PDF context - app should work without it
-                pass
 
-        messages = [{"role": "system", "content": TYC_SYSTEM_PROMPT}]
+{user_message}"""
+
+        system_message = SYSTEM_MESSAGE
+
+        question = {"role": "user", "content": enhanced_message}
+
+        token_counter = get_token_counter(self.model)
+
+        cap = ADVISOR_PROMPT_TOKEN_CAPS.get(self.model, ADVISOR_PROMPT_TOKEN_CAP)
+
+        fixed_tokens = token_counter.count_messages([system_message, question])
+
+        # assume history already alternates between user/assistant
+
+        kept, history_tokens = fit_history(history, cap - fixed_tokens, token_counter)
+
+        messages = [system_message] + kept + [question]
+
+        question_tokens = token_counter.count(user_message)
+
+        context_tokens = token_counter.count(enhanced_message) - question_tokens
+
+        usage = {
+            "estimated_prompt_tokens": fixed_tokens + history_tokens,
+            "system_tokens": token_counter.count(SYSTEM_MESSAGE["content"]),
+            "history_tokens": history_tokens,
+            "context_tokens": context_tokens,
+            "question_tokens": question_tokens,
+            "history_messages": len(kept),
+            "history_dropped": len(history or []) - len(kept),
+            "prompt_token_cap": cap,
+            "tokenizer": token_counter.encoding_name,
+        }
+
+        return messages, usage
+
+    def _record_usage(self, usage: Dict, reported, seconds: float) -> Dict:
+        """
+
+        Count a prompt sent to the model in the metrics, and add the token
+        counts the API reported for it (None if it reported none).
+
+        :param usage: Estimated usage from _compose_messages
+        :param reported: The response's usage object (may be None)
+        :param seconds: Duration of the model call
+
+        """
 
-        if history:
+        for part in ("system", "history", "context", "question"):
+            PROMPT_TOKENS.inc(usage[f"{part}_tokens"], model=self.model, part=part)
 
-            # assume history already alternates between user/assistant
+        if usage["history_dropped"]:
+            HISTORY_DROPPED.inc(usage["history_dropped"], model=self.model)
 
-            messages.extend(history)
+        prompt_tokens = getattr(reported, "prompt_tokens", None)
 
-        messages.append({"role": "user", "content": enhanced_message})
+        cached_tokens = getattr(getattr(reported, "prompt_tokens_details", None), "cached_tokens", None)
+
+        if prompt_tokens is not None:
+            API_PROMPT_TOKENS.inc(cached_tokens or 0, model=self.model, cache="cached")
+            API_PROMPT_TOKENS.inc(prompt_tokens - (cached_tokens or 0), model=self.model, cache="uncached")
+
+        prompt_cache = "unknown" if cached_tokens is None else "hit" if cached_tokens else "miss"
+
+        MODEL_CALL_SECONDS.observe(seconds, model=self.model, prompt_cache=prompt_cache)
+
+        record("model", seconds)
+
+        completion_tokens = getattr(reported, "completion_tokens", None)
+
+        if completion_tokens is not None:
+            COMPLETION_TOKENS.inc(completion_tokens, model=self.model)
+
+        return dict(
+            usage,
+            prompt_tokens=prompt_tokens,
+            cached_tokens=cached_tokens,
+            completion_tokens=completion_tokens,
+        )
+
+    def _request_params(
+
+        self,
+
+        messages: List[Dict],
+
+        max_tokens: Optional[int],
+
+        temperature: float,
+
+    ) -> Dict:
+        """Chat Completions request parameters for this advisor's model."""
 
         # Build request parameters
         request_params = {
@@ -138,9 +847,461 @@ Please use the above AAOIFI Standards context to inform your answer when relevan
         if max_tokens is not None:
             request_params["max_tokens"] = max_tokens
 
-        response = self.client.chat.completions.create(**request_params)
+        if OPENAI_PROMPT_CACHE_KEY:
+            request_params["prompt_cache_key"] = OPENAI_PROMPT_CACHE_KEY
+
+        return request_params
+
+
+class AsyncTYCIslamicFinanceAdvisor(TYCIslamicFinanceAdvisor):
+
+    """
+
+    asyncio variant of the advisor, for serving under an ASGI server.
+
+    Model calls go through AsyncOpenAI, so an in-flight request only holds a
+    coroutine, not a worker. AAOIFI retrieval is blocking, CPU-bound work and
+    runs in a thread pool instead of on the event loop.
+
+    """
+
+    def __init__(
+
+        self,
+
+        api_key: Optional[str] = None,
+
+        model: str = "gpt-5.1",
+
+        client: Optional[AsyncOpenAI] = None,
+
+    ):
+        """
+
+        :param api_key: OpenAI API key (if None, uses OPENAI_API_KEY env var)
+
+        :param model:   Base model to use, e.g. "gpt-5.1" or "gpt-4.1-mini"
+
+        :param client:  Existing AsyncOpenAI client to reuse (see get_async_openai_client);
+                        if None, a new client is created
+
+        """
+
+        self.client = client if client is not None else AsyncOpenAI(api_key=api_key)
+
+        self.model = model
+
+    async def ask(
+
+        self,
+
+        user_message: str,
+
+        history: Optional[List[Dict]] = None,
+
+        max_tokens: Optional[int] = None,
+
+        temperature: float = 0.3,
+
+        use_pdf_context: bool = True,
+
+        session_id: Optional[str] = None,
+
+    ) -> str:
+        """
+
+        Send a question to the TYC Islamic Finance Advisor.
+
+        Takes the same arguments as TYCIslamicFinanceAdvisor.ask(); use
+        ask_stream() for streaming.
+
+        :return: Assistant reply as a string.
+
+        """
+
+        return (await self.ask_with_usage(user_message, history, max_tokens, temperature, use_pdf_context,
+                                          session_id))[0]
+
+    async def ask_with_usage(
+
+        self,
+
+        user_message: str,
+
+        history: Optional[List[Dict]] = None,
+
+        max_tokens: Optional[int] = None,
+
+        temperature: float = 0.3,
+
+        use_pdf_context: bool = True,
+
+        session_id: Optional[str] = None,
+
+    ) -> Tuple[str, Dict]:
+        """
+
+        Like ask(), but also reports the request's prompt tokens
+        (see TYCIslamicFinanceAdvisor.ask_with_usage()).
+
+        """
+
+        pdf_context, _ = await self._retrieve_context_async(user_message, use_pdf_context)
+
+        return await self._answer_async(user_message, history, pdf_context, max_tokens, temperature, session_id)
+
+    async def ask_many(
+
+        self,
+
+        questions: Sequence[str],
+
+        max_tokens: Optional[int] = None,
+
+        temperature: float = 0.3,
+
+        use_pdf_context: bool = True,
+
+        concurrency: int = ADVISOR_BATCH_CONCURRENCY,
+
+    ) -> AsyncIterator[Dict]:
+        """
+
+        Answer a batch of independent questions, yielding results as they
+        complete (see TYCIslamicFinanceAdvisor.ask_many()).
+
+        """
+
+        if use_pdf_context and PDF_AVAILABLE:
+            contexts = await _run_blocking(self._retrieve_contexts, questions, use_pdf_context)
+        else:
+            contexts = [("", []) for _ in questions]
+
+        backoff = RateLimitBackoff()
+
+        # The batch does its own retries
+        client = self.client.with_options(max_retries=0)
+
+        def create(**params):
+            return backoff.call_async(client.chat.completions.create, **params)
+
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+
+        async def answer(index: int) -> Dict:
+            question = questions[index]
+            async with semaphore:
+                try:
+                    reply, usage = await self._answer_async(question, None, contexts[index][0], max_tokens,
+                                                            temperature, None, create)
+                except Exception as e:
+                    return {"index": index, "question": question, "error": f"{type(e).__name__}: {e}"}
+            return {"index": index, "question": question, "answer": reply,
+                    "citations": contexts[index][1], "usage": usage}
+
+        tasks = [asyncio.ensure_future(answer(index)) for index in range(len(questions))]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            # Stop at once if the consumer goes away
+            for task in tasks:
+                task.cancel()
+
+    async def _answer_async(
+
+        self,
+
+        user_message: str,
+
+        history: Optional[List[Dict]],
+
+        pdf_context: str,
+
+        max_tokens: Optional[int],
+
+        temperature: float,
+
+        session_id: Optional[str] = None,
+
+        create: Optional[Callable] = None,
+
+    ) -> Tuple[str, Dict]:
+        """TYCIslamicFinanceAdvisor._answer() for the async client."""
+
+        if session_id is not None:
+            history = await _run_blocking(self._session_history, session_id, history)
+
+        messages, usage = self._compose_messages(user_message, history, pdf_context)
+
+        cache, scope = self._cache_scope(messages[1:-1], pdf_context, max_tokens, temperature)
+        if cache is not None:
+            answer = await _run_blocking(cache.get, user_message, scope)
+            if answer is not None:
+                if session_id is not None:
+                    await _run_blocking(self._record_turn, session_id, user_message, answer)
+                return answer, dict(usage, cached=True)
+
+        request_params = self._request_params(messages, max_tokens, temperature)
+
+        call_start = time.perf_counter()
+
+        response = await (create or self.client.chat.completions.create)(**request_params)
+
+        answer = response.choices[0].message.content
+
+        usage = self._record_usage(usage, response.usage, time.perf_counter() - call_start)
+
+        if cache is not None:
+            await _run_blocking(cache.set, user_message, scope, answer)
+
+        if session_id is not None:
+            await _run_blocking(self._record_turn, session_id, user_message, answer)
+
+        return answer, usage
+
+    async def ask_stream(
+
+        self,
+
+        user_message: str,
+
+        history: Optional[List[Dict]] = None,
+
+        max_tokens: Optional[int] = None,
+
+        temperature: float = 0.3,
+
+        use_pdf_context: bool = True,
+
+        session_id: Optional[str] = None,
+
+    ) -> AsyncIterator[Dict]:
+        """
+
+        Stream an answer as a sequence of events (same events as
+        TYCIslamicFinanceAdvisor.ask_stream()).
+
+        """
+
+        start = time.perf_counter()
+
+        pdf_context, citations = await self._retrieve_context_async(user_message, use_pdf_context)
+
+        yield {"type": "citations", "citations": citations}
+
+        if session_id is not None:
+            history = await _run_blocking(self._session_history, session_id, history)
+
+        messages, usage = self._compose_messages(user_message, history, pdf_context)
+
+        cache, scope = self._cache_scope(messages[1:-1], pdf_context, max_tokens, temperature)
+        if cache is not None:
+            answer = await _run_blocking(cache.get, user_message, scope)
+            if answer is not None:
+                if session_id is not None:
+                    await _run_blocking(self._record_turn, session_id, user_message, answer)
+                for event in self._cached_events(answer, start, usage):
+                    yield event
+                return
+
+        request_params = self._request_params(messages, max_tokens, temperature)
+        request_params["stream"] = True
+        request_params["stream_options"] = {"include_usage": True}
+
+        ttft = None
+        parts = []
+        reported = None
+        call_start = time.perf_counter()
+        stream = await self.client.chat.completions.create(**request_params)
+        try:
+            async for chunk in stream:
+                if getattr(chunk, "usage", None) is not None:
+                    reported = chunk.usage  # Sent last, with no choices
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if not delta:
+                    continue
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+                    TIME_TO_FIRST_TOKEN.observe(ttft, model=self.model)
+                parts.append(delta)
+                yield {"type": "delta", "content": delta}
+        finally:
+            # Release the connection if the consumer stops early (client disconnect)
+            await stream.close()
+
+        # Only complete answers reach this point
+        usage = self._record_usage(usage, reported, time.perf_counter() - call_start)
+
+        if cache is not None:
+            await _run_blocking(cache.set, user_message, scope, "".join(parts))
+
+        if session_id is not None:
+            await _run_blocking(self._record_turn, session_id, user_message, "".join(parts))
+
+        yield {
+            "type": "done",
+            "ttft_ms": round(ttft * 1000, 1) if ttft is not None else None,
+            "total_ms": round((time.perf_counter() - start) * 1000, 1),
+            "usage": usage,
+            "timings_ms": _stage_timings(),
+        }
+
+    async def _retrieve_context_async(self, user_message: str, use_pdf_context: bool) -> Tuple[str, List[Dict]]:
+        """_retrieve_context() moved off the event loop."""
+
+        if not (use_pdf_context and PDF_AVAILABLE):
+            return "", []
+
+        return await _run_blocking(self._retrieve_context, user_message, use_pdf_context)
+
+
+_client_lock = threading.Lock()
+_shared_client: Optional[OpenAI] = None
+_shared_client_pid: Optional[int] = None
+_advisors: Dict[str, TYCIslamicFinanceAdvisor] = {}
+
+_async_client: Optional[AsyncOpenAI] = None
+_async_client_loop: Optional[asyncio.AbstractEventLoop] = None
+_async_client_closer = None  # Closes _async_client when its loop shuts down, see _close_with_loop
+_async_advisors: Dict[str, AsyncTYCIslamicFinanceAdvisor] = {}
+
+_retrieval_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _http_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=OPENAI_MAX_CONNECTIONS,
+        max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+    )
+
+
+def _http_timeout() -> httpx.Timeout:
+    return httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT)
+
+
+def _get_retrieval_executor() -> ThreadPoolExecutor:
+    """Thread pool the async advisor runs AAOIFI retrieval on."""
+    global _retrieval_executor
+    if _retrieval_executor is None:
+        with _client_lock:
+            if _retrieval_executor is None:
+                _retrieval_executor = ThreadPoolExecutor(
+                    max_workers=ADVISOR_RETRIEVAL_THREADS, thread_name_prefix="advisor-retrieval",
+                )
+    return _retrieval_executor
+
+
+async def _run_blocking(func, *args):
+    """Run a blocking call (retrieval, cache I/O) on the retrieval thread pool."""
+    loop = asyncio.get_running_loop()
+    # In the caller's context, so its spans count towards the request's timings
+    call = functools.partial(contextvars.copy_context().run, func, *args)
+    return await loop.run_in_executor(_get_retrieval_executor(), call)
+
+
+def _stage_timings() -> Optional[Dict[str, float]]:
+    """Milliseconds per stage of the request being served, if it is being timed."""
+    timings = current_timings()
+    return timings.as_ms() if timings is not None else None
+
+
+def get_openai_client() -> OpenAI:
+    """
+    Get the process-wide OpenAI client.
+
+    The client keeps a pool of keep-alive HTTP connections, so requests reuse
+    warm TCP+TLS connections instead of handshaking each time. It is thread-safe
+    (and gevent-safe once sockets are monkey-patched). A client inherited
+    across fork() is never reused: each worker process builds its own pool.
+    """
+    global _shared_client, _shared_client_pid
+    pid = os.getpid()
+    if _shared_client is None or _shared_client_pid != pid:
+        with _client_lock:
+            if _shared_client is None or _shared_client_pid != pid:
+                http_client = httpx.Client(limits=_http_limits(), timeout=_http_timeout())
+                _shared_client = OpenAI(http_client=http_client)
+                _shared_client_pid = pid
+                _advisors.clear()
+    return _shared_client
+
+
+def get_advisor(model: str = "gpt-5.1") -> TYCIslamicFinanceAdvisor:
+    """
+    Get the shared advisor for a model, creating it on first use.
+    Advisors hold no per-request state, so one instance per model serves
+    every request thread in the process.
+    """
+    client = get_openai_client()
+    advisor = _advisors.get(model)
+    if advisor is None or advisor.client is not client:
+        with _client_lock:
+            advisor = _advisors.get(model)
+            if advisor is None or advisor.client is not client:
+                advisor = TYCIslamicFinanceAdvisor(model=model, client=client)
+                _advisors[model] = advisor
+    return advisor
+
+
+def get_async_openai_client() -> AsyncOpenAI:
+    """
+    Get the AsyncOpenAI client for the running event loop.
+
+    Async connections belong to the loop that opened them, so the client is
+    rebuilt if it is requested from a different loop (or process), and
+    closed on its own loop: when that loop shuts down (asyncio.run() does on
+    exit), or right away if it is still running in another thread.
+    Must be called from a coroutine.
+    """
+    global _async_client, _async_client_loop, _async_client_closer
+    loop = asyncio.get_running_loop()
+    if _async_client is None or _async_client_loop is not loop:
+        old_client, old_loop = _async_client, _async_client_loop
+        if old_client is not None and old_loop.is_running() and not old_loop.is_closed():
+            asyncio.run_coroutine_threadsafe(old_client.close(), old_loop)
+
+        http_client = httpx.AsyncClient(limits=_http_limits(), timeout=_http_timeout())
+        _async_client = AsyncOpenAI(http_client=http_client)
+        _async_client_loop = loop
+        _async_client_closer = _close_with_loop(_async_client)
+        # Started, the generator is registered with the loop, which finalizes it before closing
+        loop.create_task(_async_client_closer.__anext__())
+        _async_advisors.clear()
+    return _async_client
+
+
+async def _close_with_loop(client: AsyncOpenAI) -> AsyncIterator[None]:
+    """Waits until its loop shuts down its async generators, then closes client on that loop."""
+    try:
+        yield
+    finally:
+        await client.close()
+
+
+def get_async_advisor(model: str = "gpt-5.1") -> AsyncTYCIslamicFinanceAdvisor:
+    """
+    Get the shared async advisor for a model on the running event loop.
+    Must be called from a coroutine.
+    """
+    client = get_async_openai_client()
+    advisor = _async_advisors.get(model)
+    if advisor is None:
+        advisor = _async_advisors[model] = AsyncTYCIslamicFinanceAdvisor(model=model, client=client)
+    return advisor
+
 
-        return response.choices[0].message.content
+async def close_async_clients() -> None:
+    """Close the async client's connections (call on server shutdown)."""
+    global _async_client, _async_client_loop, _async_client_closer
+    if _async_client is not None:
+        await _async_client.close()
+    _async_client = None
+    _async_client_loop = None
+    _async_client_closer = None
+    _async_advisors.clear()
 
 
 if __name__ == "__main__":
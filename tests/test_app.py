@@ -0,0 +1,17 @@
+import pytest
+
+from src.app import app
+
+
+@pytest.fixture
+def client():
+    return app.test_client()
+
+
+@pytest.mark.parametrize('route', ['/ask', '/ask/stream'])
+@pytest.mark.parametrize('question', [5, ['x'], {'text': 'x'}, None, '  '])
+def test_question_must_be_a_non_empty_string(client, route, question):
+    response = client.post(route, json={'question': question})
+
+    assert response.status_code == 400
+    assert response.get_json() == {'error': 'Please provide a question'}
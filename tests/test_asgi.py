@@ -0,0 +1,30 @@
+import asyncio
+import json
+
+import pytest
+
+from src.asgi import app
+
+
+def post(path, body):
+    """Run one POST through the ASGI app: (status, decoded JSON body)."""
+    messages = [{'type': 'http.request', 'body': json.dumps(body).encode('utf-8'), 'more_body': False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {'type': 'http', 'method': 'POST', 'path': path,
+             'headers': [(b'content-type', b'application/json')]}
+    asyncio.run(app(scope, receive, send))
+    body = b''.join(message.get('body', b'') for message in sent if message['type'] == 'http.response.body')
+    return sent[0]['status'], json.loads(body)
+
+
+@pytest.mark.parametrize('path', ['/ask', '/ask/stream'])
+@pytest.mark.parametrize('question', [5, ['x'], {'text': 'x'}])
+def test_non_string_question_is_a_bad_request(path, question):
+    assert post(path, {'question': question}) == (400, {'error': 'Please provide a question'})
@@ -0,0 +1,37 @@
+from src.chunking import chunk_metadata, parse_structure
+
+# Page 479 of data/AAOIFI-Standards.txt: Standard 17's running header, then a
+# cross-reference to Standard 5 that starts a line
+PAGE_479 = (
+    "--- Page 479 ---\n"
+    "Shari’ah Standard No. (17): Investment SukukShari’ah Standard No. (17): Investment Sukuk\n"
+    "478478other than torts and negligence nor that he guarantees other than torts and negligence nor that he guarantees \n"
+    "to an independent third party to provide a guarantee to an independent third party to provide a guarantee \n"
+    "free of charge, while taking into account item 7/6 of free of charge, while taking into account item 7/6 of \n"
+    "Shari’ah Standard No. (5) on Guarantees. It is also Shari’ah Standard No. (5) on Guarantees. It is also \n"
+    "permitted to the issuer of the certificate to offer permitted to the issuer of the certificate to offer \n"
+)
+
+
+def test_cross_reference_does_not_start_a_standard():
+    boundaries = parse_structure(PAGE_479)
+
+    assert [b.standard for b in boundaries if b.new_standard] == [17]
+    assert {b.standard for b in boundaries} == {17}
+
+
+def test_chunks_after_a_cross_reference_keep_their_standard():
+    heading = PAGE_479.index("Shari’ah")
+    cross_reference = PAGE_479.index("Shari’ah Standard No. (5) on")
+    spans = [(heading, cross_reference), (cross_reference, len(PAGE_479))]
+
+    standards, _ = chunk_metadata(parse_structure(PAGE_479), spans)
+
+    assert list(standards) == [17, 17]
+
+
+def test_heading_at_the_start_of_a_page_body():
+    # Structured chunking parses each page's text without its marker
+    body = PAGE_479.split("\n", 1)[1]
+
+    assert [b.standard for b in parse_structure(body) if b.new_standard] == [17]